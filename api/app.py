@@ -1,19 +1,143 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import requests
+import hashlib
 import json
+import os
+import itertools
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import math as Math
 
+from cache_warmup import CacheWarmup
+import batch_query
+import compression
+import feature_export
+import flatgeobuf
+import geoserver_client
+from feature_count import FeatureCounter
+from feature_mirror import FeatureMirror
+from geojson_stream import CHUNK_SIZE, FeatureStream, GeoJSONStreamError, iter_chunks
+import geometry_simplify
+from layer_schema import LayerSchemaRegistry
+from pagination_cursor import InvalidCursor, decode_cursor, encode_cursor, keyset_filter, pick_sort_key
+from prefetch import Prefetcher
+import request_metrics
+import vector_tile
+import request_deadline
+from response_cache import CachedResponse, ResponseCache, make_key
+from single_flight import SingleFlight
+import spatial_filter
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Counts request body parsing and response serialization as request stages"""
+
+    def loads(self, s, **kwargs):
+        with request_metrics.stage("parse"):
+            return super().loads(s, **kwargs)
+
+    def dumps(self, obj, **kwargs):
+        with request_metrics.stage("serialize"):
+            return super().dumps(obj, **kwargs)
+
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 CORS(app)  # Enable CORS for all routes
 
 # GeoServer configuration
-GEOSERVER_BASE_URL = "http://20.20.152.180:8181/geoserver"
+GEOSERVER_BASE_URL = os.environ.get("GEOSERVER_URL", "http://20.20.152.180:8181/geoserver")
 WORKSPACE = "Picarro"
 WFS_URL = f"{GEOSERVER_BASE_URL}/{WORKSPACE}/wfs"
 
+# Cached DescribeFeatureType results (geometry field, attribute types, native CRS) per layer
+layer_schemas = LayerSchemaRegistry(WFS_URL)
+
+# Cached resultType=hits feature counts per (layer, CQL filter)
+feature_counts = FeatureCounter(WFS_URL)
+
+# In-process cache of WFS GetFeature responses
+FEATURE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+FEATURE_CACHE_TTL = 120  # Default seconds a cached GetFeature response stays valid
+FEATURE_CACHE_LAYER_TTLS = {
+    "Picarro:Boundary": 3600,  # Boundaries rarely change
+}
+feature_cache = ResponseCache(max_bytes=FEATURE_CACHE_MAX_BYTES, default_ttl=FEATURE_CACHE_TTL)
+
+# Identical GetFeature requests in flight at the same time share one GeoServer call
+feature_flights = SingleFlight("wfs_getfeature")
+
+# Finished Mapbox Vector Tiles per (layer, z, x, y)
+VECTOR_TILE_CACHE_MAX_BYTES = 128 * 1024 * 1024
+VECTOR_TILE_CACHE_TTL = 300  # Seconds; layers in FEATURE_CACHE_LAYER_TTLS use their own TTL
+VECTOR_TILE_MAX_FEATURES = 10000  # maxFeatures of the GetFeature request behind one tile
+VECTOR_TILE_BROWSER_MAX_AGE = 60  # Cache-Control max-age, in seconds
+vector_tile_cache = ResponseCache(max_bytes=VECTOR_TILE_CACHE_MAX_BYTES, default_ttl=VECTOR_TILE_CACHE_TTL)
+vector_tile_flights = SingleFlight("vector_tile")
+
+# After a page is served, the next page is loaded into feature_cache in the background
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") != "0"
+PREFETCH_MAX_IN_FLIGHT = int(os.environ.get("PREFETCH_MAX_IN_FLIGHT", "4"))  # Further prefetches are skipped, not queued
+PREFETCH_TTL = 30  # Seconds a prefetched page stays cached if nobody asks for it
+PREFETCH_TIMEOUT = 30  # Seconds a prefetch may take
+PREFETCH_PREVIOUS = False  # Also prefetch page N-1 (for clients that page backwards)
+page_prefetcher = Prefetcher("page-prefetch", max_in_flight=PREFETCH_MAX_IN_FLIGHT, ttl=PREFETCH_TTL)
+
+# Concurrent per-layer queries for the spatial-query endpoints
+LAYER_QUERY_WORKERS = int(os.environ.get("LAYER_QUERY_WORKERS", "8"))  # start_servers.py --async raises this
+LAYER_QUERY_TIMEOUT = 45  # Default seconds each layer may take before it is reported as timed out
+_layer_executor = ThreadPoolExecutor(max_workers=LAYER_QUERY_WORKERS, thread_name_prefix="layer-query")
+
+# End-to-end deadline per request (see request_deadline.py), in seconds. Clients can ask for
+# their own with the X-Request-Timeout header or a "timeout" parameter. None: no deadline.
+REQUEST_DEADLINES = {
+    "/api/spatial-query": 60,
+    "/api/spatial-query-paginated": 60,
+    "/api/spatial-query-batch": 120,
+    "/api/spatial-query-export": None,  # Exports stream for as long as they need
+    "/api/features": 30,
+    "/api/features/count": 15,
+    "/api/tiles/<layer_id>/<int:z>/<int:x>/<int:y>.mvt": 20,
+}
+DEFAULT_REQUEST_DEADLINE = 30
+MIN_CALL_SECONDS = 0.5  # Time assumed for an upstream call whose latency has not been observed yet
+
+# Bulk exports (/api/spatial-query-export) walk all pages of a query, a few at a time
+EXPORT_PAGE_SIZE = 1000  # Features per GetFeature page
+EXPORT_PARALLEL_PAGES = 4  # Page requests in flight per export
+EXPORT_PAGE_TIMEOUT = 120  # Seconds per page request
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", "8"))  # Page requests in flight across all exports
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export-page")
+
+# Batch spatial queries (/api/spatial-query-batch): many geometries, one GetFeature per group of them
+BATCH_MAX_GEOMETRIES = 200
+BATCH_GROUP_MAX_GEOMETRIES = 25  # INTERSECTS terms OR-ed into one CQL filter
+BATCH_GROUP_MAX_CHARS = 6000  # WKT characters per grouped filter, so GetFeature URLs stay within GeoServer's limits
+BATCH_MAX_FEATURES = 5000  # maxFeatures of each grouped GetFeature request
+
+# Keyset pagination sort key per layer; layers not listed use an id-like attribute from their schema
+CURSOR_SORT_KEYS = {}
+MAX_PAGE_SIZE = 1000  # Largest pageSize of /api/spatial-query-paginated, also for pages continued from a cursor
+
+# Optional in-process mirror of rarely-changing layers, answering spatial queries without GeoServer.
+# Set MIRROR_LAYERS to a comma-separated list of layer ids to enable it.
+MIRROR_LAYERS = [layer_id.strip() for layer_id in os.environ.get("MIRROR_LAYERS", "").split(",") if layer_id.strip()]
+MIRROR_REFRESH_SECONDS = int(os.environ.get("MIRROR_REFRESH_SECONDS", "3600"))
+feature_mirror = FeatureMirror(WFS_URL, MIRROR_LAYERS, MIRROR_REFRESH_SECONDS,
+                               sort_key_for=lambda layer_id: pick_sort_key(layer_schemas.get(layer_id), CURSOR_SORT_KEYS.get(layer_id)))
+
+# Cache warm-up after start: layer schemas, unfiltered counts and the first page of every layer.
+# /api/ready answers 503 until it has finished (or WARMUP_TIMEOUT has passed).
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") != "0"
+WARMUP_TIMEOUT = int(os.environ.get("WARMUP_TIMEOUT", "60"))
+WARMUP_PAGE_SIZE = 100  # Default pageSize of /api/features
+cache_warmup = CacheWarmup(timeout=WARMUP_TIMEOUT, ready_dir=os.environ.get("API_READY_DIR"))
+
+# Per-stage request timings behind /api/performance and /api/metrics
+request_stats = request_metrics.MetricsRegistry()
+
 # Available layers configuration
 AVAILABLE_LAYERS = [
     {"id": "Picarro:Boundary", "name": "Boundary", "visible": True},
@@ -30,11 +154,61 @@ def health_check():
         "endpoints": [
             "/api/layers",
             "/api/spatial-query",
+            "/api/spatial-query-export",
             "/api/features",
-            "/api/performance"
+            "/api/features/count",
+            "/api/tiles/<layer>/<z>/<x>/<y>.mvt",
+            "/api/performance",
+            "/api/metrics"
         ]
     })
 
+@app.before_request
+def start_request_timer():
+    """Time every /api/* request by stage"""
+    if request.path.startswith("/api/") and request.url_rule is not None:
+        g.request_timer, g.request_timer_token = request_stats.begin(request.url_rule.rule)
+
+@app.before_request
+def start_request_deadline():
+    """Deadline budget for /api/* requests, from the client or the endpoint's default"""
+    if not request.path.startswith("/api/") or request.url_rule is None:
+        return None
+    try:
+        seconds = request_deadline.requested_seconds(request.headers, request.args, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if seconds is None:
+        seconds = REQUEST_DEADLINES.get(request.url_rule.rule, DEFAULT_REQUEST_DEADLINE)
+    g.request_deadline_token = request_deadline.begin(seconds)
+    return None
+
+@app.teardown_request
+def end_request_deadline(exc):
+    # Streamed bodies are generated after this; their layer queries keep their own layerTimeout
+    token = g.pop("request_deadline_token", None)
+    if token is not None:
+        request_deadline.end(token)
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.pop("request_timer", None)
+    if timer is not None:
+        token = g.pop("request_timer_token", None)
+        error = response.status_code >= 400
+        if response.is_streamed:
+            # The body is generated after this hook; record once it has been sent
+            response.call_on_close(lambda: request_stats.finish(timer, error, token))
+        else:
+            request_stats.finish(timer, error, token)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli per Accept-Encoding (after_request hooks run in reverse, so this precedes finish_request_timer)"""
+    with request_metrics.stage("serialize"):
+        return compression.compress_response(response, request)
+
 @app.route("/api/layers", methods=["GET"])
 def get_layers():
     """Get available layers - using static list to avoid WMS calls"""
@@ -47,6 +221,157 @@ def get_layers():
         print(f"Error getting layers: {e}")
         return jsonify({"layers": AVAILABLE_LAYERS})
 
+def wfs_get_feature(params, timeout=None):
+    """
+    WFS GetFeature through the response cache. Returns the cached response
+    when the same normalized request was answered recently. Otherwise asks
+    GeoServer, sharing the call with identical requests already in flight,
+    and caches successful responses.
+    """
+    key = make_key(params)
+    cached = feature_cache.get(key)
+    if cached is not None:
+        print(f"DEBUG: Feature cache hit for {params.get('typeName')}")
+        if page_prefetcher.claim(key):
+            # A prefetched page, cached for PREFETCH_TTL only; a client needed it, so keep it as long as any page
+            _cache_features(key, params, cached)
+        return cached
+    
+    response, shared = feature_flights.do(key, lambda: _fetch_features(key, params, timeout))
+    if shared:
+        print(f"DEBUG: Shared an in-flight GetFeature call for {params.get('typeName')}")
+        if page_prefetcher.claim(key) and isinstance(response, CachedResponse):
+            # The call was a prefetch, cached for PREFETCH_TTL only; a client needed it, so keep it as long as any page
+            _cache_features(key, params, response)
+    return response
+
+def _is_feature_collection(response):
+    """True for a JSON FeatureCollection; GeoServer reports errors as XML exceptions, possibly with HTTP 200"""
+    if response.status_code != 200 or "json" not in response.headers.get("content-type", ""):
+        return False
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get("type") == "FeatureCollection"
+
+def _fetch_features(key, params, timeout, ttl=None):
+    """GetFeature from GeoServer; FeatureCollections are cached and returned as CachedResponse"""
+    response = geoserver_client.get(WFS_URL, params=params, operation="wfs_getfeature", timeout=timeout)
+    if _is_feature_collection(response):
+        cached = CachedResponse.from_response(response)
+        _cache_features(key, params, cached, ttl)
+        return cached
+    return response
+
+def _cache_features(key, params, cached, ttl=None):
+    """Store a GetFeature response for ttl seconds, by default the layer's feature cache TTL"""
+    layer_id = params.get("typeName")
+    feature_cache.put(key, cached, len(cached.content),
+                      layer_id=layer_id, ttl=FEATURE_CACHE_LAYER_TTLS.get(layer_id) if ttl is None else ttl)
+
+def prefetch_features(params):
+    """
+    Load a GetFeature page into feature_cache in the background, so that
+    wfs_get_feature() answers it from the cache (or joins the prefetch if
+    it is still running). Skipped when the page is already cached.
+    """
+    if not PREFETCH_ENABLED:
+        return
+    key = make_key(params)
+    if feature_cache.contains(key):
+        return
+    
+    def load():
+        if feature_cache.contains(key):
+            return None  # A client asked for it before the prefetch started
+        response, _ = feature_flights.do(key, lambda: _fetch_features(key, params, PREFETCH_TIMEOUT, ttl=PREFETCH_TTL))
+        return isinstance(response, CachedResponse)
+    
+    if page_prefetcher.schedule(key, load):
+        print(f"DEBUG: Prefetching {params.get('typeName')} from index {params.get('startIndex', 0)}")
+
+def prefetch_adjacent_pages(wfs_params, page, page_size, total_pages):
+    """Prefetch the page after page (and the one before it with PREFETCH_PREVIOUS) of an offset-paged request"""
+    pages = [page + 1] if page < total_pages else []
+    if PREFETCH_PREVIOUS and page > 1:
+        pages.append(page - 1)
+    for adjacent in pages:
+        prefetch_features(dict(wfs_params, startIndex=str((adjacent - 1) * page_size)))
+
+def layer_name(layer_id):
+    """Display name for a layer id, falling back to the id itself"""
+    return next((layer["name"] for layer in AVAILABLE_LAYERS if layer["id"] == layer_id), layer_id)
+
+def run_layer_queries(layers, query_layer, layer_timeout):
+    """
+    Run query_layer(layer_id, deadline) for every layer concurrently.
+
+    Each layer gets its own deadline of layer_timeout seconds, cut to the
+    request's deadline. Layers that have not finished by then are reported
+    as timed out so the results of the other layers can still be returned.
+    """
+    futures = {}
+    for layer_id in dict.fromkeys(layers):  # drop duplicates, keep order
+        submitted = time.time()
+        deadline = request_deadline.clamp(submitted + layer_timeout)
+        task = request_stats.bind_layer(layer_id, request_deadline.bind(query_layer, deadline))
+        future = _layer_executor.submit(task, layer_id, deadline)
+        futures[future] = (layer_id, submitted, deadline)
+
+    results = {}
+    pending = set(futures)
+    while pending:
+        next_deadline = min(futures[future][2] for future in pending)
+        done, pending = wait(pending, timeout=max(0, next_deadline - time.time()), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            layer_id, submitted, _ = futures[future]
+            try:
+                results[layer_id] = future.result()
+            except Exception as e:
+                print(f"DEBUG: Layer query for '{layer_id}' raised: {e}")
+                results[layer_id] = {
+                    "success": False,
+                    "features": [],
+                    "count": 0,
+                    "loadTime": (time.time() - submitted) * 1000,
+                    "error": str(e),
+                    "layerName": layer_name(layer_id)
+                }
+
+        now = time.time()
+        for future in [future for future in pending if futures[future][2] <= now]:
+            layer_id, submitted, deadline = futures[future]
+            pending.discard(future)
+            future.cancel()  # only stops it if it never started
+            allowed = f"{layer_timeout}s" if deadline == submitted + layer_timeout else f"{deadline - submitted:.1f}s request"
+            print(f"DEBUG: Layer query for '{layer_id}' exceeded its {allowed} deadline")
+            results[layer_id] = {
+                "success": False,
+                "features": [],
+                "count": 0,
+                "loadTime": (now - submitted) * 1000,
+                "error": f"Layer query exceeded its {allowed} deadline",
+                "timedOut": True,
+                "layerName": layer_name(layer_id)
+            }
+
+    return {layer_id: results[layer_id] for layer_id in dict.fromkeys(layers)}
+
+def budget_allows(*operations):
+    """Whether the request's deadline leaves time for one call of each operation, judged by their recent p95"""
+    remaining = request_deadline.remaining()
+    if remaining is None:
+        return True
+    return remaining > sum(geoserver_client.latency_p95(operation) or MIN_CALL_SECONDS for operation in operations)
+
+def upstream_timeout(deadline, operation="wfs_getfeature"):
+    """Configured timeout for operation, shortened to what is left before deadline"""
+    connect_timeout, read_timeout = geoserver_client.TIMEOUTS.get(operation, geoserver_client.TIMEOUTS["default"])
+    remaining = max(0.1, deadline - time.time())
+    return (min(connect_timeout, remaining), min(read_timeout, remaining))
+
 @app.route("/api/spatial-query", methods=["POST"])
 def spatial_query():
     """Perform spatial query with multiple layers"""
@@ -54,6 +379,8 @@ def spatial_query():
         data = request.get_json()
         geometry = data.get("geometry")  # WKT format
         layers = data.get("layers", [])  # List of layer IDs to query
+        layer_timeout = float(data.get("layerTimeout", LAYER_QUERY_TIMEOUT))  # Seconds allowed per layer
+        stream = bool(data.get("stream")) or request.args.get("stream", "false").lower() == "true"
         
         if not geometry:
             return jsonify({"error": "Geometry (WKT) is required"}), 400
@@ -61,90 +388,434 @@ def spatial_query():
         if not layers:
             return jsonify({"error": "At least one layer is required"}), 400
         
+        # Reject malformed or invalid geometries before any GeoServer request
+        try:
+            spatial_filter.parse_wkt(geometry)
+        except spatial_filter.InvalidGeometry as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Optional geometry simplification ("tolerance" or "zoom") and coordinate rounding ("precision")
+        try:
+            simplification = parse_simplification(data, layers)
+            output_format = response_format(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Streamed bodies are generated after this handler has returned, outside the request's
+        # deadline context, so the layers' deadline is cut to the request's here
+        stream_deadline = request_deadline.clamp(time.time() + layer_timeout)
+        if output_format == "flatgeobuf":
+            # Binary output is always streamed: features are converted as GeoServer sends them
+            return flatgeobuf_response(stream_spatial_query_flatgeobuf(geometry, layers, stream_deadline, simplification))
+        
+        if stream:
+            # Copy GeoServer's feature arrays straight through instead of decoding them
+            return Response(stream_spatial_query(geometry, layers, stream_deadline, simplification), mimetype="application/json")
+        
         start_time = time.time()
-        results = {}
         
-        # Query each layer
-        for layer_id in layers:
-            layer_start_time = time.time()
-            layer_end_time = time.time()  # Initialize at the beginning
-            
-            # Try different geometry field names
-            field_names = ["geom", "the_geom", "geometry"]  # Prioritize 'geom' as it worked before
-            success = False
-            
-            for field_name in field_names:
-                try:
-                    # Prepare WFS request
-                    wfs_params = {
-                        "service": "WFS",
-                        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
-                        "request": "GetFeature",
-                        "typeName": layer_id,
-                        "outputFormat": "application/json",
-                        "maxFeatures": "1000",  # Get all features for spatial query
-                        "CQL_FILTER": f"INTERSECTS({field_name}, {geometry})"
-                    }
-                    
-                    # Make WFS request
-                    print(f"DEBUG: Trying field '{field_name}' with params: {wfs_params}")
-                    response = requests.get(WFS_URL, params=wfs_params, timeout=30)
-                    print(f"DEBUG: Response status: {response.status_code}")
-                    layer_end_time = time.time()  # Update after request
-                    
-                    if response.status_code == 200:
-                        try:
-                            geo_json = response.json()
-                            features = geo_json.get("features", [])
-                            print(f"DEBUG: Success with field '{field_name}' - found {len(features)} features")
-                            
-                            results[layer_id] = {
-                                "success": True,
-                                "features": features,
-                                "count": len(features),
-                                "loadTime": (layer_end_time - layer_start_time) * 1000,  # Convert to ms
-                                "layerName": next((layer["name"] for layer in AVAILABLE_LAYERS if layer["id"] == layer_id), layer_id),
-                                "field_used": field_name
-                            }
-                            success = True
-                            break  # Found working field name
-                        except json.JSONDecodeError as e:
-                            print(f"DEBUG: JSON decode error with field '{field_name}': {e}")
-                            continue  # Try next field name
-                    else:
-                        print(f"DEBUG: Failed with field '{field_name}' - HTTP {response.status_code}")
-                        continue  # Try next field name
-                        
-                except requests.RequestException as e:
-                    print(f"DEBUG: Request exception with field '{field_name}': {e}")
-                    layer_end_time = time.time()  # Update on exception
-                    continue  # Try next field name
-            
-            # If no field name worked, return error
-            if not success:
-                layer_end_time = time.time()  # Ensure it's updated
-                results[layer_id] = {
-                    "success": False,
-                    "features": [],
-                    "count": 0,
-                    "loadTime": (layer_end_time - layer_start_time) * 1000,
-                    "error": "No working geometry field found",
-                    "layerName": next((layer["name"] for layer in AVAILABLE_LAYERS if layer["id"] == layer_id), layer_id)
-                }
+        # Query all layers concurrently
+        results = run_layer_queries(layers, lambda layer_id, deadline: query_layer_features(layer_id, geometry, deadline), layer_timeout)
+        simplify_results(results, simplification)
         
         total_time = (time.time() - start_time) * 1000
         
-        return jsonify({
+        response = {
             "success": True,
             "results": results,
-            "totalTime": total_time,
+            "totalTime": total_time,  # Wall-clock time for the whole request
+            "layerTimeSum": sum(result["loadTime"] for result in results.values()),  # Sum of per-layer times
             "queryTime": datetime.now().isoformat(),
             "geometry": geometry
-        })
+        }
+        if simplification:
+            response["simplification"] = simplification_info(simplification)
+        return jsonify(response)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def layer_is_geographic(layer_id):
+    """Whether a layer's coordinates are lon/lat; only a web mercator native CRS says otherwise"""
+    schema = layer_schemas.get(layer_id)
+    return flatgeobuf.crs_code((schema or {}).get("nativeCrs")) not in (3857, 900913)
+
+def parse_simplification(params, layers):
+    """
+    {layer_id: (tolerance, precision)} from a request's "tolerance", "zoom"
+    and "precision", or None when none were given. A zoom gives each layer
+    the tolerance in its own CRS's units. Raises ValueError for invalid values.
+    """
+    if geometry_simplify.parse_options(params) is None:
+        return None
+    return {layer_id: geometry_simplify.parse_options(params, geographic=layer_is_geographic(layer_id))
+            for layer_id in dict.fromkeys(layers)}
+
+def simplify_results(results, simplification):
+    """Simplify and round the features of every layer result in place"""
+    if not simplification:
+        return
+    for layer_id, result in results.items():
+        if result.get("features"):
+            result["features"] = geometry_simplify.simplify_features(result["features"], *simplification[layer_id])
+
+def simplification_info(simplification):
+    """
+    Response member describing the applied simplification; per layer when
+    a zoom gave layers in different CRSs different tolerances.
+    """
+    info = {layer_id: {"tolerance": tolerance, "precision": precision}
+            for layer_id, (tolerance, precision) in simplification.items()}
+    values = list(info.values())
+    if all(value == values[0] for value in values):
+        return values[0]
+    return {"layers": info}
+
+def query_layer_features(layer_id, geometry, deadline):
+    """Spatial query against a single layer, used by spatial_query"""
+    layer_start_time = time.time()
+    layer_end_time = time.time()  # Initialize at the beginning
+    
+    # Mirrored layers are answered in-process
+    mirrored = feature_mirror.query(layer_id, geometry, limit=1000)
+    if mirrored is not None:
+        return {
+            "success": True,
+            "features": mirrored,
+            "count": len(mirrored),
+            "loadTime": (time.time() - layer_start_time) * 1000,
+            "layerName": layer_name(layer_id),
+            "source": "mirror"
+        }
+    
+    # Geometry field from the schema registry (falls back to probing if the schema is unavailable)
+    field_names = layer_schemas.geometry_field_candidates(layer_id)
+    
+    for field_name in field_names:
+        if time.time() >= deadline:
+            break
+        try:
+            # Prepare WFS request
+            wfs_params = {
+                "service": "WFS",
+                "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+                "request": "GetFeature",
+                "typeName": layer_id,
+                "outputFormat": "application/json",
+                "maxFeatures": "1000",  # Get all features for spatial query
+                "CQL_FILTER": spatial_filter.intersects_filter(field_name, geometry)
+            }
+            
+            # Make WFS request
+            print(f"DEBUG: Trying field '{field_name}' with params: {wfs_params}")
+            response = wfs_get_feature(wfs_params, timeout=upstream_timeout(deadline))
+            print(f"DEBUG: Response status: {response.status_code}")
+            layer_end_time = time.time()  # Update after request
+            
+            if response.status_code == 200:
+                try:
+                    with request_metrics.stage("decode"):
+                        geo_json = response.json()
+                    features = geo_json.get("features", [])
+                    print(f"DEBUG: Success with field '{field_name}' - found {len(features)} features")
+                    layer_schemas.remember_geometry_field(layer_id, field_name)
+                    
+                    return {
+                        "success": True,
+                        "features": features,
+                        "count": len(features),
+                        "loadTime": (layer_end_time - layer_start_time) * 1000,  # Convert to ms
+                        "layerName": layer_name(layer_id),
+                        "field_used": field_name
+                    }
+                except json.JSONDecodeError as e:
+                    print(f"DEBUG: JSON decode error with field '{field_name}': {e}")
+                    continue  # Try next field name
+            else:
+                print(f"DEBUG: Failed with field '{field_name}' - HTTP {response.status_code}")
+                continue  # Try next field name
+                
+        except requests.RequestException as e:
+            print(f"DEBUG: Request exception with field '{field_name}': {e}")
+            layer_end_time = time.time()  # Update on exception
+            continue  # Try next field name
+    
+    # If no field name worked, return error
+    layer_end_time = time.time()  # Ensure it's updated
+    return {
+        "success": False,
+        "features": [],
+        "count": 0,
+        "loadTime": (layer_end_time - layer_start_time) * 1000,
+        "error": "No working geometry field found",
+        "layerName": layer_name(layer_id)
+    }
+
+def open_layer_stream(layer_id, geometry, deadline):
+    """
+    Open the WFS response for one layer of a streamed spatial query without
+    reading its body. Returns {"chunks", "response", "field_used"} or None.
+    """
+    mirrored = feature_mirror.query(layer_id, geometry, limit=1000)
+    if mirrored is not None:
+        return {"chunks": _feature_collection_chunks(mirrored), "response": None, "field_used": None}
+    
+    for field_name in layer_schemas.geometry_field_candidates(layer_id):
+        if time.time() >= deadline:
+            break
+        wfs_params = {
+            "service": "WFS",
+            "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+            "request": "GetFeature",
+            "typeName": layer_id,
+            "outputFormat": "application/json",
+            "maxFeatures": "1000",
+            "CQL_FILTER": spatial_filter.intersects_filter(field_name, geometry)
+        }
+        
+        cached = feature_cache.get(make_key(wfs_params))
+        if cached is not None:
+            print(f"DEBUG: Streaming {layer_id} from the feature cache")
+            return {"chunks": iter_chunks(cached.content), "response": None, "field_used": field_name}
+        
+        try:
+            print(f"DEBUG: Opening streamed WFS response with params: {wfs_params}")
+            response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature",
+                                            timeout=upstream_timeout(deadline), stream=True)
+        except requests.RequestException as e:
+            print(f"DEBUG: Request exception with field '{field_name}': {e}")
+            continue
+        
+        # GeoServer reports a bad filter as an XML exception, possibly with HTTP 200
+        if response.status_code == 200 and "json" in response.headers.get("content-type", ""):
+            layer_schemas.remember_geometry_field(layer_id, field_name)
+            return {"chunks": geoserver_client.iter_content(response), "response": response, "field_used": field_name}
+        
+        print(f"DEBUG: Failed with field '{field_name}' - HTTP {response.status_code}, {response.headers.get('content-type')}")
+        response.close()
+    return None
+
+def _feature_collection_chunks(features):
+    """Encode in-memory features as FeatureCollection chunks, one feature at a time"""
+    yield b'{"type": "FeatureCollection", "features": ['
+    for index, feature in enumerate(features):
+        yield (b"," if index else b"") + json.dumps(feature).encode()
+    yield b"]}"
+
+def _close_layer_stream(future):
+    """Done-callback closing a layer stream that will never be read"""
+    try:
+        opened = future.result()
+    except Exception:
+        return
+    if opened and opened["response"] is not None:
+        opened["response"].close()
+
+def stream_spatial_query(geometry, layers, deadline, simplification=None):
+    """
+    Generate the spatial_query JSON envelope while copying each layer's
+    features through from GeoServer chunk by chunk. Only one feature is
+    held in memory at a time. "count", "loadTime" and "success" are written
+    after a layer's features, once they are known. deadline is the
+    layers' deadline, already cut to the request's.
+    """
+    start_time = time.time()
+    allowed = deadline - start_time
+    layer_ids = list(dict.fromkeys(layers))
+    task = request_deadline.bind(open_layer_stream, deadline)
+    futures = {layer_id: _layer_executor.submit(request_stats.bind_layer(layer_id, task), layer_id, geometry, deadline)
+               for layer_id in layer_ids}
+    layer_times = []
+    
+    try:
+        yield b'{"success": true, "results": {'
+        for index, layer_id in enumerate(layer_ids):
+            layer_start_time = time.time()
+            if index:
+                yield b", "
+            yield json.dumps(layer_id).encode() + b": "
+            
+            failure = None
+            opened = None
+            try:
+                opened = futures.pop(layer_id).result(timeout=max(0, deadline - time.time()))
+                if opened is None:
+                    failure = {"error": "No working geometry field found"}
+            except FutureTimeoutError:
+                failure = {"error": f"Layer query exceeded its {allowed:.1f}s deadline", "timedOut": True}
+            except Exception as e:
+                failure = {"error": str(e)}
+            
+            if failure:
+                load_time = (time.time() - start_time) * 1000
+                layer_times.append(load_time)
+                failure.update({"success": False, "features": [], "count": 0, "loadTime": load_time, "layerName": layer_name(layer_id)})
+                yield json.dumps(failure).encode()
+                continue
+            
+            yield (f'{{"layerName": {json.dumps(layer_name(layer_id))}, '
+                   f'"field_used": {json.dumps(opened["field_used"])}, "features": [').encode()
+            features = FeatureStream(opened["chunks"])
+            tail = {}
+            try:
+                for count, raw_feature in enumerate(features):
+                    if simplification:
+                        raw_feature = geometry_simplify.simplify_raw_feature(raw_feature, *simplification[layer_id])
+                    yield b"," + raw_feature if count else raw_feature
+                tail["success"] = True
+            except (requests.RequestException, GeoJSONStreamError) as e:
+                print(f"DEBUG: Streaming {layer_id} failed after {features.count} features: {e}")
+                tail.update({"success": False, "error": f"Stream interrupted: {e}"})
+            
+            load_time = (time.time() - start_time) * 1000
+            layer_times.append(load_time)
+            tail.update({"count": features.count, "loadTime": load_time})
+            print(f"DEBUG: Streamed {features.count} features ({features.bytes_read} bytes) for {layer_id}")
+            yield b"], " + json.dumps(tail).encode()[1:]
+        
+        yield b"}, " + json.dumps({
+            "totalTime": (time.time() - start_time) * 1000,
+            "layerTimeSum": sum(layer_times),
+            "queryTime": datetime.now().isoformat(),
+            "geometry": geometry,
+            "streamed": True,
+            **({"simplification": simplification_info(simplification)} if simplification else {})
+        }).encode()[1:]
+    finally:
+        # Client went away or a layer failed: release responses nobody will read
+        for future in futures.values():
+            future.add_done_callback(_close_layer_stream)
+
+def response_format(params):
+    """
+    "json" or "flatgeobuf", from a "format" parameter (request body or query
+    string) or else the Accept header. Raises ValueError for other formats.
+    """
+    requested = (params.get("format") or request.args.get("format") or "").lower()
+    if not requested:
+        best = request.accept_mimetypes.best_match(["application/json", *flatgeobuf.MEDIA_TYPES])
+        return "flatgeobuf" if best in flatgeobuf.MEDIA_TYPES else "json"
+    if requested in ("fgb", "flatgeobuf", *flatgeobuf.MEDIA_TYPES):
+        return "flatgeobuf"
+    if requested in ("json", "geojson", "application/json"):
+        return "json"
+    raise ValueError(f"Unsupported format '{requested}' (use json or flatgeobuf)")
+
+def flatgeobuf_response(body):
+    response = Response(body, mimetype=flatgeobuf.MEDIA_TYPE)
+    response.headers["Vary"] = "Accept"
+    return response
+
+def decode_features(raw_features, simplification=None):
+    """Decode streamed raw features one at a time, simplifying them if asked to"""
+    for raw_feature in raw_features:
+        feature = json.loads(raw_feature)
+        if simplification:
+            feature = geometry_simplify.simplify_features([feature], *simplification)[0]
+        yield feature
+
+def layer_columns(layer_id, features):
+    """
+    Attribute columns [(name, flatgeobuf column type)] of a layer, from its
+    schema or else from its first feature, and the features iterator (with
+    that first feature put back).
+    """
+    features = iter(features)
+    schema = layer_schemas.get(layer_id)
+    if schema and schema.get("attributes"):
+        return flatgeobuf.columns_from_schema(schema["attributes"]), features
+    first = next(features, None)
+    if first is None:
+        return [], features
+    return flatgeobuf.columns_from_properties(first.get("properties") or {}), itertools.chain([first], features)
+
+def generate_flatgeobuf(layer_features, metadata, features_count=0):
+    """
+    FlatGeobuf body for [(layer_id, iterable of feature dicts)], encoded as
+    the features are read. Columns come from layer_columns(); with more than
+    one layer a "layer" column tells the features apart.
+    """
+    multiple = len(layer_features) > 1
+    columns = [("layer", flatgeobuf.STRING)] if multiple else []
+    known = {name for name, _ in columns}
+    crs = set()
+    layers = []
+    for layer_id, features in layer_features:
+        schema = layer_schemas.get(layer_id)
+        crs.add(schema.get("nativeCrs") if schema else None)
+        columns_of_layer, features = layer_columns(layer_id, features)
+        for name, column_type in columns_of_layer:
+            if name not in known:
+                known.add(name)
+                columns.append((name, column_type))
+        layers.append((layer_id, features))
+    
+    yield flatgeobuf.encode_header(columns, name=None if multiple or not layers else layer_name(layers[0][0]),
+                                   crs=crs.pop() if len(crs) == 1 else None,
+                                   features_count=features_count, metadata=metadata)
+    encoder = flatgeobuf.FeatureEncoder(columns)
+    buffer = bytearray()
+    for layer_id, features in layers:
+        extra_properties = {"layer": layer_id} if multiple else None
+        for feature in features:
+            buffer += encoder.encode(feature, extra_properties)
+            if len(buffer) >= CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+def stream_spatial_query_flatgeobuf(geometry, layers, deadline, simplification=None):
+    """
+    spatial_query as FlatGeobuf. Every layer's WFS response is opened first
+    so the header can list the layers that failed (in its metadata); the
+    features are then converted one at a time as GeoServer sends them.
+    """
+    start_time = time.time()
+    allowed = deadline - start_time
+    layer_ids = list(dict.fromkeys(layers))
+    task = request_deadline.bind(open_layer_stream, deadline)
+    futures = {layer_id: _layer_executor.submit(request_stats.bind_layer(layer_id, task), layer_id, geometry, deadline)
+               for layer_id in layer_ids}
+    
+    opened_streams = []
+    try:
+        layer_info = {}
+        layer_features = []
+        for layer_id in layer_ids:
+            info = layer_info[layer_id] = {"layerName": layer_name(layer_id), "success": False}
+            try:
+                opened = futures.pop(layer_id).result(timeout=max(0, deadline - time.time()))
+                if opened is None:
+                    info["error"] = "No working geometry field found"
+                    continue
+            except FutureTimeoutError:
+                info.update({"error": f"Layer query exceeded its {allowed:.1f}s deadline", "timedOut": True})
+                continue
+            except Exception as e:
+                info["error"] = str(e)
+                continue
+            info.update({"success": True, "field_used": opened["field_used"]})
+            opened_streams.append(opened)
+            layer_features.append((layer_id, decode_features(FeatureStream(opened["chunks"]),
+                                                              simplification and simplification[layer_id])))
+        
+        metadata = {
+            "results": layer_info,
+            "queryTime": datetime.now().isoformat(),
+            "geometry": geometry,
+            "streamed": True,
+            **({"simplification": simplification_info(simplification)} if simplification else {})
+        }
+        yield from generate_flatgeobuf(layer_features, metadata)
+        print(f"DEBUG: Streamed FlatGeobuf for {len(layer_features)} layer(s) in {(time.time() - start_time) * 1000:.1f}ms")
+    finally:
+        for opened in opened_streams:
+            if opened["response"] is not None:
+                opened["response"].close()
+        for future in futures.values():
+            future.add_done_callback(_close_layer_stream)
+
 @app.route("/api/spatial-query-paginated", methods=["POST"])
 def spatial_query_paginated():
     """Perform spatial query with pagination support"""
@@ -154,284 +825,685 @@ def spatial_query_paginated():
         layers = data.get("layers", [])  # List of layer IDs to query
         page = int(data.get("page", 1))
         page_size = int(data.get("pageSize", 100))
-        start_index = (page - 1) * page_size
-        
-        if not geometry:
+        layer_timeout = float(data.get("layerTimeout", LAYER_QUERY_TIMEOUT))  # Seconds allowed per layer
+        if not 1 <= page_size <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"pageSize must be between 1 and {MAX_PAGE_SIZE}"}), 400
+        
+        # Cursor pagination: {"useCursor": true} on the first page, then
+        # {"cursors": {layer: nextCursor}} (or {"cursor": nextCursor}) for the following ones
+        cursors = dict(data.get("cursors") or {})
+        if data.get("cursor"):
+            cursors[None] = data["cursor"]
+        cursor_states = {}
+        for cursor in cursors.values():
+            try:
+                state = decode_cursor(cursor, MAX_PAGE_SIZE)
+            except InvalidCursor as e:
+                return jsonify({"error": str(e)}), 400
+            cursor_states[state["layer"]] = state
+        use_cursor = bool(data.get("useCursor")) or bool(cursor_states)
+        if cursor_states:
+            layers = list(cursor_states)
+        
+        if not geometry and not cursor_states:
             return jsonify({"error": "Geometry (WKT) is required"}), 400
         
         if not layers:
             return jsonify({"error": "At least one layer is required"}), 400
         
+        try:
+            if geometry:
+                spatial_filter.parse_wkt(geometry)
+            simplification = parse_simplification(data, layers)
+            output_format = response_format(data)
+        except ValueError as e:  # includes spatial_filter.InvalidGeometry
+            return jsonify({"error": str(e)}), 400
+        
         start_time = time.time()
-        results = {}
         
-        # Query each layer
-        for layer_id in layers:
-            layer_start_time = time.time()
-            layer_end_time = time.time()  # Initialize at the beginning
-            
-            # Try different geometry field names
-            field_names = ["geom", "the_geom", "geometry"]  # Prioritize 'geom' as it works
-            success = False
-            
-            for field_name in field_names:
-                try:
-                    # First, get total count
-                    count_params = {
-                        "service": "WFS",
-                        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
-                        "request": "GetFeature",
-                        "typeName": layer_id,
-                        "resultType": "hits",
-                        "CQL_FILTER": f"INTERSECTS({field_name}, {geometry})"
-                    }
-                    
-                    print(f"DEBUG: Getting count for spatial query with params: {count_params}")
-                    count_response = requests.get(WFS_URL, params=count_params, timeout=30)
-                    
-                    if count_response.status_code == 200:
-                        try:
-                            count_text = count_response.text
-                            print(f"DEBUG: Full count response text: {count_text}")
-                            import re
-                            
-                            # Parse XML response to extract total count
-                            # Look for numberOfFeatures attribute in FeatureCollection
-                            number_match = re.search(r'numberOfFeatures="(\d+)"', count_text)
-                            if number_match:
-                                total_features = int(number_match.group(1))
-                                print(f"DEBUG: Found numberOfFeatures: {total_features}")
-                            else:
-                                # Try to find numberOfFeatures without quotes
-                                alt_match = re.search(r'numberOfFeatures=(\d+)', count_text)
-                                if alt_match:
-                                    total_features = int(alt_match.group(1))
-                                    print(f"DEBUG: Found numberOfFeatures (no quotes): {total_features}")
-                                else:
-                                    # Try to find numberMatched attribute (WFS 2.0.0)
-                                    matched_match = re.search(r'numberMatched="(\d+)"', count_text)
-                                    if matched_match:
-                                        total_features = int(matched_match.group(1))
-                                        print(f"DEBUG: Found numberMatched: {total_features}")
-                                    else:
-                                        # Try to find numberMatched without quotes
-                                        matched_alt_match = re.search(r'numberMatched=(\d+)', count_text)
-                                        if matched_alt_match:
-                                            total_features = int(matched_alt_match.group(1))
-                                            print(f"DEBUG: Found numberMatched (no quotes): {total_features}")
-                                        else:
-                                            # Try to find numberReturned attribute
-                                            returned_match = re.search(r'numberReturned="(\d+)"', count_text)
-                                            if returned_match:
-                                                total_features = int(returned_match.group(1))
-                                                print(f"DEBUG: Found numberReturned: {total_features}")
-                                            else:
-                                                # Try to find numberReturned without quotes
-                                                returned_alt_match = re.search(r'numberReturned=(\d+)', count_text)
-                                                if returned_alt_match:
-                                                    total_features = int(returned_alt_match.group(1))
-                                                    print(f"DEBUG: Found numberReturned (no quotes): {total_features}")
-                                                else:
-                                                    print(f"DEBUG: No count found in XML response")
-                                                    print(f"DEBUG: Full response: {count_text}")
-                                                    total_features = 0
-                            
-                            if total_features > 0:
-                                print(f"DEBUG: Spatial query found {total_features} total features")
-                                
-                                # Now get paginated features
-                                wfs_params = {
-                                    "service": "WFS",
-                                    "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
-                                    "request": "GetFeature",
-                                    "typeName": layer_id,
-                                    "outputFormat": "application/json",
-                                    "maxFeatures": str(page_size),
-                                    "startIndex": str(start_index),
-                                    "CQL_FILTER": f"INTERSECTS({field_name}, {geometry})"
-                                }
-                                
-                                print(f"DEBUG: Getting paginated features with params: {wfs_params}")
-                                response = requests.get(WFS_URL, params=wfs_params, timeout=30)
-                                layer_end_time = time.time()
-                                
-                                if response.status_code == 200:
-                                    try:
-                                        geo_json = response.json()
-                                        features = geo_json.get("features", [])
-                                        print(f"DEBUG: Success with field '{field_name}' - found {len(features)} features for page {page}")
-                                        
-                                        results[layer_id] = {
-                                            "success": True,
-                                            "features": features,
-                                            "count": len(features),
-                                            "totalFeatures": total_features,
-                                            "totalPages": max(1, (total_features + page_size - 1) // page_size),
-                                            "currentPage": page,
-                                            "pageSize": page_size,
-                                            "loadTime": (layer_end_time - layer_start_time) * 1000,
-                                            "layerName": next((layer["name"] for layer in AVAILABLE_LAYERS if layer["id"] == layer_id), layer_id),
-                                            "field_used": field_name
-                                        }
-                                        success = True
-                                        break
-                                    except json.JSONDecodeError as e:
-                                        print(f"DEBUG: JSON decode error with field '{field_name}': {e}")
-                                        continue
-                                else:
-                                    print(f"DEBUG: Failed with field '{field_name}' - HTTP {response.status_code}")
-                                    continue
-                            else:
-                                print(f"DEBUG: Could not parse total count from response or total features is 0")
-                                continue
-                        except Exception as e:
-                            print(f"DEBUG: Error parsing count response: {e}")
-                            continue
-                    else:
-                        print(f"DEBUG: Count request failed with status: {count_response.status_code}")
-                        continue
-                        
-                except requests.RequestException as e:
-                    print(f"DEBUG: Request exception with field '{field_name}': {e}")
-                    layer_end_time = time.time()
-                    continue
-            
-            # If no field name worked, return error
-            if not success:
-                layer_end_time = time.time()
-                results[layer_id] = {
-                    "success": False,
-                    "features": [],
-                    "count": 0,
-                    "loadTime": (layer_end_time - layer_start_time) * 1000,
-                    "error": "No working geometry field found",
-                    "layerName": next((layer["name"] for layer in AVAILABLE_LAYERS if layer["id"] == layer_id), layer_id)
-                }
+        # Query all layers concurrently
+        if use_cursor:
+            results = run_layer_queries(layers, lambda layer_id, deadline: query_layer_cursor_page(
+                layer_id, geometry, page_size, cursor_states.get(layer_id), deadline), layer_timeout)
+        else:
+            results = run_layer_queries(layers, lambda layer_id, deadline: query_layer_page(layer_id, geometry, page, page_size, deadline), layer_timeout)
+        simplify_results(results, simplification)
         
         total_time = (time.time() - start_time) * 1000
         
-        return jsonify({
+        response = {
             "success": True,
             "results": results,
-            "totalTime": total_time,
+            "totalTime": total_time,  # Wall-clock time for the whole request
+            "layerTimeSum": sum(result["loadTime"] for result in results.values()),  # Sum of per-layer times
             "queryTime": datetime.now().isoformat(),
             "geometry": geometry
-        })
+        }
+        if use_cursor:
+            response["nextCursors"] = {layer_id: result.get("nextCursor") for layer_id, result in results.items()}
+        if simplification:
+            response["simplification"] = simplification_info(simplification)
+        
+        if output_format == "flatgeobuf":
+            # Everything but the features goes into the FlatGeobuf header's metadata
+            layer_features = [(layer_id, result.get("features") or []) for layer_id, result in results.items()]
+            response["results"] = {layer_id: {key: value for key, value in result.items() if key != "features"}
+                                   for layer_id, result in results.items()}
+            features_count = sum(len(features) for _, features in layer_features)
+            return flatgeobuf_response(generate_flatgeobuf(layer_features, response, features_count))
+        return jsonify(response)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/api/features", methods=["GET"])
-def get_features():
-    """Get features for a specific layer with pagination support"""
-    try:
-        layer_id = request.args.get("layer")
-        geometry = request.args.get("geometry")  # WKT format
-        page = int(request.args.get("page", "1"))
-        page_size = int(request.args.get("pageSize", "100"))
-        start_index = (page - 1) * page_size
-        get_total_count = request.args.get("getTotalCount", "false").lower() == "true"
-        
-        if not layer_id:
-            return jsonify({"error": "Layer ID is required"}), 400
-        
-        # Always get total count if we don't have it
-        total_features = 0
-        if get_total_count:
-            # Use a more reliable approach: get all features and count them
-            count_params = {
+def query_layer_page(layer_id, geometry, page, page_size, deadline):
+    """Paginated spatial query against a single layer, used by spatial_query_paginated"""
+    start_index = (page - 1) * page_size
+    layer_start_time = time.time()
+    layer_end_time = time.time()  # Initialize at the beginning
+    
+    # Mirrored layers are answered in-process
+    mirrored = feature_mirror.query(layer_id, geometry)
+    if mirrored is not None:
+        total_features = len(mirrored)
+        features = mirrored[start_index:start_index + page_size]
+        return {
+            "success": True,
+            "features": features,
+            "count": len(features),
+            "totalFeatures": total_features,
+            "totalPages": max(1, (total_features + page_size - 1) // page_size),
+            "currentPage": page,
+            "pageSize": page_size,
+            "loadTime": (time.time() - layer_start_time) * 1000,
+            "layerName": layer_name(layer_id),
+            "source": "mirror"
+        }
+    
+    # Geometry field from the schema registry (falls back to probing if the schema is unavailable)
+    field_names = layer_schemas.geometry_field_candidates(layer_id)
+    error = None
+    
+    for field_name in field_names:
+        if time.time() >= deadline:
+            break
+        try:
+            cql_filter = spatial_filter.intersects_filter(field_name, geometry)
+            
+            # First, get total count (cached per layer and filter), unless the deadline is too close for it.
+            # None means skipped or failed; the page is still requested, and its response tells
+            # whether the field works and, if not, what GeoServer's error was.
+            total_features = feature_counts.cached(layer_id, cql_filter)
+            count_failed = False
+            if total_features is None and budget_allows("wfs_hits", "wfs_getfeature"):
+                total_features = feature_counts.count(layer_id, cql_filter, timeout=upstream_timeout(deadline, "wfs_hits"))
+                count_failed = total_features is None
+            
+            if total_features == 0:
+                layer_schemas.remember_geometry_field(layer_id, field_name)
+                return {
+                    "success": True,
+                    "features": [],
+                    "count": 0,
+                    "totalFeatures": 0,
+                    "totalPages": 1,
+                    "currentPage": page,
+                    "pageSize": page_size,
+                    "loadTime": (time.time() - layer_start_time) * 1000,
+                    "layerName": layer_name(layer_id),
+                    "field_used": field_name
+                }
+            
+            print(f"DEBUG: Spatial query found {total_features if total_features is not None else 'uncounted'} total features")
+            
+            # Now get paginated features
+            wfs_params = {
                 "service": "WFS",
                 "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
                 "request": "GetFeature",
                 "typeName": layer_id,
                 "outputFormat": "application/json",
-                "maxFeatures": "10000"  # Get up to 10000 features to count
+                "maxFeatures": str(page_size),
+                "startIndex": str(start_index),
+                "CQL_FILTER": cql_filter
             }
             
-            # Add spatial filter if geometry provided
-            if geometry and geometry != "1=1":
-                count_params["CQL_FILTER"] = f"INTERSECTS(the_geom, {geometry})"  # Use 'the_geom' as it's the correct field name
+            print(f"DEBUG: Getting paginated features with params: {wfs_params}")
+            response = wfs_get_feature(wfs_params, timeout=upstream_timeout(deadline))
+            layer_end_time = time.time()
             
-            print(f"DEBUG: Making count request to GeoServer with params: {count_params}")
-            count_response = requests.get(WFS_URL, params=count_params, timeout=30)
-            print(f"DEBUG: Count response status: {count_response.status_code}")
-            
-            if count_response.status_code == 200:
+            if response.status_code == 200:
                 try:
-                    count_data = count_response.json()
-                    features = count_data.get("features", [])
-                    total_features = len(features)
-                    print(f"DEBUG: Found {total_features} features by counting actual features")
-                except Exception as e:
-                    print(f"DEBUG: Error parsing count response: {e}")
-                    total_features = 0
+                    with request_metrics.stage("decode"):
+                        geo_json = response.json()
+                    features = geo_json.get("features", [])
+                    print(f"DEBUG: Success with field '{field_name}' - found {len(features)} features for page {page}")
+                    layer_schemas.remember_geometry_field(layer_id, field_name)
+                    total_pages = max(1, (total_features + page_size - 1) // page_size) if total_features is not None else None
+                    prefetch_adjacent_pages(wfs_params, page, page_size, total_pages or page + 1)
+                    
+                    result = {
+                        "success": True,
+                        "features": features,
+                        "count": len(features),
+                        "totalFeatures": total_features,
+                        "totalPages": total_pages,
+                        "currentPage": page,
+                        "pageSize": page_size,
+                        "loadTime": (layer_end_time - layer_start_time) * 1000,
+                        "layerName": layer_name(layer_id),
+                        "field_used": field_name
+                    }
+                    if total_features is None:
+                        result["countFailed" if count_failed else "countSkipped"] = True
+                    return result
+                except json.JSONDecodeError as e:
+                    print(f"DEBUG: JSON decode error with field '{field_name}': {e}")
+                    error = f"GeoServer did not return JSON: {response.text[:200]}"
+                    continue
             else:
-                print(f"DEBUG: Count request failed with status: {count_response.status_code}")
-                print(f"DEBUG: Count response text: {count_response.text}")
+                print(f"DEBUG: Failed with field '{field_name}' - HTTP {response.status_code}")
+                error = f"GeoServer returned HTTP {response.status_code}: {response.text[:200]}"
+                continue
+            
+        except requests.RequestException as e:
+            print(f"DEBUG: Request exception with field '{field_name}': {e}")
+            layer_end_time = time.time()
+            error = f"GeoServer request failed: {e}"
+            continue
+    
+    # If no field name worked, return the last upstream error
+    layer_end_time = time.time()
+    return {
+        "success": False,
+        "features": [],
+        "count": 0,
+        "loadTime": (layer_end_time - layer_start_time) * 1000,
+        "error": error or "No working geometry field found",
+        "layerName": layer_name(layer_id)
+    }
+
+def cursor_page_params(layer_id, state):
+    """GetFeature parameters for the page a cursor state points at"""
+    wfs_params = {
+        "service": "WFS",
+        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+        "request": "GetFeature",
+        "typeName": layer_id,
+        "outputFormat": "application/json",
+        "maxFeatures": str(state["pageSize"]),
+        "CQL_FILTER": state["filter"]
+    }
+    if state["sortKey"]:
+        wfs_params["sortBy"] = state["sortKey"]
+    if state["sortKey"] and state["last"] is not None:
+        # Keyset: continue after the last row of the previous page
+        wfs_params["CQL_FILTER"] = keyset_filter(state["filter"], state["sortKey"], state["last"])
+    elif state["offset"]:
+        # No usable sort key value: fall back to an offset
+        wfs_params["startIndex"] = str(state["offset"])
+    return wfs_params
+
+def query_layer_cursor_page(layer_id, geometry, page_size, state, deadline):
+    """
+    Keyset-paginated spatial query against a single layer. Without a cursor
+    state this is the first page: the filter, sort key and total count are
+    resolved once and carried in the returned nextCursor, so later pages
+    make a single GetFeature request.
+    """
+    layer_start_time = time.time()
+    
+    if state is None:
+        total_features = None
+        for field_name in layer_schemas.geometry_field_candidates(layer_id):
+            cql_filter = spatial_filter.intersects_filter(field_name, geometry)
+            total_features = feature_counts.count(layer_id, cql_filter, timeout=upstream_timeout(deadline, "wfs_hits"))
+            if total_features is not None:
+                break
+        if total_features is None:
+            return {
+                "success": False,
+                "features": [],
+                "count": 0,
+                "loadTime": (time.time() - layer_start_time) * 1000,
+                "error": "No working geometry field found",
+                "layerName": layer_name(layer_id)
+            }
+        state = {
+            "layer": layer_id,
+            "filter": cql_filter,
+            "field": field_name,
+            "sortKey": pick_sort_key(layer_schemas.get(layer_id), CURSOR_SORT_KEYS.get(layer_id)),
+            "last": None,
+            "offset": 0,
+            "page": 0,
+            "pageSize": page_size,
+            "total": total_features
+        }
+    
+    page_size = state["pageSize"]
+    wfs_params = cursor_page_params(layer_id, state)
+    
+    print(f"DEBUG: Getting cursor page {state['page'] + 1} with params: {wfs_params}")
+    try:
+        response = wfs_get_feature(wfs_params, timeout=upstream_timeout(deadline))
+        with request_metrics.stage("decode"):
+            features = response.json().get("features", []) if response.status_code == 200 else None
+    except (requests.RequestException, json.JSONDecodeError) as e:
+        print(f"DEBUG: Cursor page request failed: {e}")
+        features = None
+    if features is None:
+        return {
+            "success": False,
+            "features": [],
+            "count": 0,
+            "loadTime": (time.time() - layer_start_time) * 1000,
+            "error": "WFS request failed",
+            "layerName": layer_name(layer_id)
+        }
+    
+    page = state["page"] + 1
+    total_features = state["total"]
+    next_state = dict(state, page=page, offset=state["offset"] + len(features))
+    if state["sortKey"] and features:
+        next_state["last"] = features[-1].get("properties", {}).get(state["sortKey"])
+    has_more = len(features) == page_size and next_state["offset"] < total_features
+    if has_more:
+        prefetch_features(cursor_page_params(layer_id, next_state))
+    
+    return {
+        "success": True,
+        "features": features,
+        "count": len(features),
+        "totalFeatures": total_features,
+        "totalPages": max(1, (total_features + page_size - 1) // page_size),
+        "currentPage": page,
+        "pageSize": page_size,
+        "loadTime": (time.time() - layer_start_time) * 1000,
+        "layerName": layer_name(layer_id),
+        "field_used": state["field"],
+        "sortKey": state["sortKey"],
+        "nextCursor": encode_cursor(next_state) if has_more else None
+    }
+
+@app.route("/api/spatial-query-batch", methods=["POST"])
+def spatial_query_batch():
+    """
+    Spatial query for many geometries at once. "geometries" is a list of
+    WKT strings or {"id", "geometry"} objects. GeoServer is asked once per
+    group of geometries (OR-ed INTERSECTS filters) and layer, and the
+    features are matched to each geometry locally. Results are returned per
+    geometry, in input order.
+    """
+    try:
+        data = request.get_json() or {}
+        items = data.get("geometries") or []
+        layers = data.get("layers", [])
+        layer_timeout = float(data.get("layerTimeout", LAYER_QUERY_TIMEOUT))  # Seconds allowed per layer
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "At least one geometry (WKT) is required"}), 400
+        if len(items) > BATCH_MAX_GEOMETRIES:
+            return jsonify({"error": f"At most {BATCH_MAX_GEOMETRIES} geometries per batch"}), 400
+        if not layers:
+            return jsonify({"error": "At least one layer is required"}), 400
+        
+        ids = [item.get("id", index) if isinstance(item, dict) else index for index, item in enumerate(items)]
+        wkts = [item.get("geometry") if isinstance(item, dict) else item for item in items]
+        geometries = []
+        for geometry_id, wkt in zip(ids, wkts):
+            try:
+                geometries.append(spatial_filter.parse_wkt(wkt))
+            except spatial_filter.InvalidGeometry as e:
+                return jsonify({"error": f"Geometry {geometry_id}: {e}"}), 400
+        try:
+            simplification = parse_simplification(data, layers)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        # If we don't have total_features, we need to get it for pagination info
-        if total_features == 0:
-            # Make a count request to get total features for pagination
-            count_params = {
+        start_time = time.time()
+        groups = batch_query.group_geometries(wkts, geometries, BATCH_GROUP_MAX_GEOMETRIES, BATCH_GROUP_MAX_CHARS)
+        print(f"DEBUG: Batch query of {len(wkts)} geometries in {len(groups)} groups")
+        results = run_layer_queries(layers, lambda layer_id, deadline: query_layer_batch(
+            layer_id, wkts, geometries, groups, deadline), layer_timeout)
+        
+        with request_metrics.stage("assemble"):
+            per_geometry = [{"id": geometry_id, "layers": {}} for geometry_id in ids]
+            for layer_id, result in results.items():
+                features = result.pop("features", None) or []
+                matches = result.pop("matches", None) or [[] for _ in wkts]
+                if simplification:
+                    features = geometry_simplify.simplify_features(features, *simplification[layer_id])
+                for entry, positions in zip(per_geometry, matches):
+                    layer_result = {"features": [features[position] for position in positions], "count": len(positions)}
+                    if not result["success"]:
+                        layer_result["error"] = result.get("error")
+                    entry["layers"][layer_id] = layer_result
+        
+        response = {
+            "success": True,
+            "results": per_geometry,
+            "layers": results,  # Per layer: status, features fetched, GeoServer requests
+            "geometryCount": len(wkts),
+            "groups": len(groups),
+            "upstreamRequests": sum(result.get("requests", 0) for result in results.values()),
+            "totalTime": (time.time() - start_time) * 1000,
+            "queryTime": datetime.now().isoformat()
+        }
+        if simplification:
+            response["simplification"] = simplification_info(simplification)
+        return jsonify(response)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def query_layer_batch(layer_id, wkts, geometries, groups, deadline):
+    """Batch spatial query against a single layer, used by spatial_query_batch"""
+    layer_start_time = time.time()
+    
+    # Mirrored layers are answered in-process
+    if feature_mirror.has(layer_id):
+        features = batch_query.merge_features(feature_mirror.query(layer_id, wkt) or [] for wkt in wkts)
+        return {
+            "success": True,
+            "features": features,
+            "matches": batch_query.assign(features, geometries),
+            "count": len(features),
+            "requests": 0,
+            "loadTime": (time.time() - layer_start_time) * 1000,
+            "layerName": layer_name(layer_id),
+            "source": "mirror"
+        }
+    
+    error = "No working geometry field found"
+    for field_name in layer_schemas.geometry_field_candidates(layer_id):
+        feature_lists = []
+        truncated = False
+        for group in groups:
+            if time.time() >= deadline:
+                error = "Layer query exceeded its deadline"
+                break
+            wfs_params = {
                 "service": "WFS",
                 "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
                 "request": "GetFeature",
                 "typeName": layer_id,
                 "outputFormat": "application/json",
-                "maxFeatures": "10000"  # Get up to 10000 features to count
+                "maxFeatures": str(BATCH_MAX_FEATURES),
+                "CQL_FILTER": spatial_filter.intersects_any_filter(field_name, [wkts[index] for index in group])
             }
-            
-            # Add spatial filter if geometry provided
-            if geometry and geometry != "1=1":
-                count_params["CQL_FILTER"] = f"INTERSECTS(the_geom, {geometry})"  # Use 'the_geom' as it's the correct field name
-            
             try:
-                count_response = requests.get(WFS_URL, params=count_params, timeout=10)
-                if count_response.status_code == 200:
-                    count_data = count_response.json()
-                    features = count_data.get("features", [])
-                    total_features = len(features)
-                    print(f"DEBUG: Got total_features for pagination: {total_features}")
-                else:
-                    print(f"DEBUG: Count request failed with status: {count_response.status_code}")
-                    total_features = 0
-            except Exception as e:
-                print(f"DEBUG: Error getting total count for pagination: {e}")
-                total_features = 0
+                response = wfs_get_feature(wfs_params, timeout=upstream_timeout(deadline))
+                if response.status_code != 200:
+                    error = f"WFS request failed: HTTP {response.status_code}"
+                    print(f"DEBUG: Batch group failed with field '{field_name}' - HTTP {response.status_code}")
+                    break
+                with request_metrics.stage("decode"):
+                    features = response.json().get("features", [])
+            except (requests.RequestException, json.JSONDecodeError) as e:
+                error = str(e)
+                print(f"DEBUG: Batch group request failed with field '{field_name}': {e}")
+                break
+            feature_lists.append(features)
+            truncated = truncated or len(features) >= BATCH_MAX_FEATURES
+        else:
+            layer_schemas.remember_geometry_field(layer_id, field_name)
+            features = batch_query.merge_features(feature_lists)
+            print(f"DEBUG: Batch query of {layer_id} found {len(features)} features in {len(groups)} requests")
+            result = {
+                "success": True,
+                "features": features,
+                "matches": batch_query.assign(features, geometries),
+                "count": len(features),
+                "requests": len(groups),
+                "loadTime": (time.time() - layer_start_time) * 1000,
+                "layerName": layer_name(layer_id),
+                "field_used": field_name
+            }
+            if truncated:
+                # A group hit maxFeatures: some geometries may be missing features
+                result["truncated"] = True
+            return result
+        if feature_lists:
+            break  # The field worked for earlier groups, so another field will not help
+    
+    return {
+        "success": False,
+        "features": [],
+        "count": 0,
+        "loadTime": (time.time() - layer_start_time) * 1000,
+        "error": error,
+        "layerName": layer_name(layer_id)
+    }
+
+@app.route("/api/spatial-query-export", methods=["POST"])
+def spatial_query_export():
+    """
+    Export every feature intersecting a geometry, without the 1000 feature
+    limit of spatial_query, as NDJSON, CSV or GeoPackage ("format").
+    Pages are fetched EXPORT_PARALLEL_PAGES at a time and written out as
+    they arrive, so memory does not grow with the number of features.
+    """
+    try:
+        data = request.get_json()
+        geometry = data.get("geometry")  # WKT format
+        layers = list(dict.fromkeys(data.get("layers", [])))
+        export_format = (data.get("format") or request.args.get("format") or "ndjson").lower()
         
-        # Prepare WFS request
-        wfs_params = {
-            "service": "WFS",
-            "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
-            "request": "GetFeature",
-            "typeName": layer_id,
-            "outputFormat": "application/json",
-            "maxFeatures": str(page_size), # Use page_size for maxFeatures
-            "startIndex": str(start_index),
-            "CQL_FILTER": "1=1"  # Default filter to show all features
-        }
+        if not geometry:
+            return jsonify({"error": "Geometry (WKT) is required"}), 400
+        if not layers:
+            return jsonify({"error": "At least one layer is required"}), 400
+        if export_format not in feature_export.WRITERS:
+            return jsonify({"error": f"Unsupported export format '{export_format}' (use {', '.join(feature_export.WRITERS)})"}), 400
+        try:
+            spatial_filter.parse_wkt(geometry)
+            simplification = parse_simplification(data, layers)
+        except ValueError as e:  # includes spatial_filter.InvalidGeometry
+            return jsonify({"error": str(e)}), 400
+        
+        # Resolve each layer's filter and total first, so failures are still reported as JSON
+        plans = []
+        for layer_id in layers:
+            plan = plan_layer_export(layer_id, geometry)
+            if plan is None:
+                return jsonify({"error": f"No working geometry field found for {layer_id}"}), 502
+            plans.append(plan)
+        
+        writer_class = feature_export.WRITERS[export_format]
+        if writer_class is feature_export.GeoPackageWriter:
+            unsupported = [f"{plan['layer']} ({plan['crs']})" for plan in plans if feature_export.gpkg_srs_id(plan["crs"]) is None]
+            if unsupported:
+                return jsonify({"error": f"GeoPackage export supports {', '.join(feature_export.SUPPORTED_SRS)} only, "
+                                         f"not the CRS of {', '.join(unsupported)}"}), 400
+        
+        total_features = sum(plan["total"] for plan in plans)
+        print(f"DEBUG: Exporting {total_features} features from {len(plans)} layer(s) as {export_format}")
+        response = Response(generate_export(writer_class, plans, simplification), mimetype=writer_class.media_type)
+        response.headers["Content-Disposition"] = f'attachment; filename="export.{writer_class.extension}"'
+        response.headers["X-Total-Features"] = str(total_features)
+        return response
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def plan_layer_export(layer_id, geometry):
+    """CQL filter, sort key, CRS and (possibly cached) feature count for exporting one layer, or None"""
+    for field_name in layer_schemas.geometry_field_candidates(layer_id):
+        cql_filter = spatial_filter.intersects_filter(field_name, geometry)
+        total_features = feature_counts.count(layer_id, cql_filter)
+        if total_features is not None:
+            schema = layer_schemas.get(layer_id)
+            return {
+                "layer": layer_id,
+                "filter": cql_filter,
+                # A stable order keeps offset pages from overlapping or skipping features
+                "sortKey": pick_sort_key(schema, CURSOR_SORT_KEYS.get(layer_id)),
+                "crs": (schema or {}).get("nativeCrs"),
+                "total": total_features
+            }
+    return None
+
+def fetch_export_page(plan, start_index):
+    """Body of one GetFeature page of an export (not cached: exports would flush the feature cache)"""
+    wfs_params = {
+        "service": "WFS",
+        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+        "request": "GetFeature",
+        "typeName": plan["layer"],
+        "outputFormat": "application/json",
+        "maxFeatures": str(EXPORT_PAGE_SIZE),
+        "startIndex": str(start_index),
+        "CQL_FILTER": plan["filter"]
+    }
+    if plan["sortKey"]:
+        wfs_params["sortBy"] = plan["sortKey"]
+    response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature", timeout=EXPORT_PAGE_TIMEOUT)
+    if response.status_code != 200 or "json" not in response.headers.get("content-type", ""):
+        raise requests.RequestException(f"Export page at {start_index} of {plan['layer']} failed - HTTP {response.status_code}")
+    return response.content
+
+def export_layer_features(plan, simplification=None):
+    """
+    All features of an export plan, in page order. Pages are read until
+    one comes back short, since the plan's count may be cached and stale.
+    Up to EXPORT_PARALLEL_PAGES pages within that count are requested
+    ahead of the one being read; past it, one page at a time.
+    """
+    next_start = 0
+    pending = deque()
+    try:
+        while True:
+            while not pending or (len(pending) < EXPORT_PARALLEL_PAGES and next_start < plan["total"]):
+                pending.append(_export_executor.submit(fetch_export_page, plan, next_start))
+                next_start += EXPORT_PAGE_SIZE
+            content = pending.popleft().result()
+            received = 0
+            for feature in decode_features(FeatureStream(iter_chunks(content)), simplification and simplification[plan["layer"]]):
+                received += 1
+                yield feature
+            if received < EXPORT_PAGE_SIZE:
+                return
+    finally:
+        for future in pending:
+            future.cancel()
+
+def generate_export(writer_class, plans, simplification=None):
+    """Export body: every plan's features through one writer, in CHUNK_SIZE pieces"""
+    start_time = time.time()
+    layers = []
+    for plan in plans:
+        columns, features = layer_columns(plan["layer"], export_layer_features(plan, simplification))
+        layers.append((plan["layer"], columns, features))
+    crs_by_layer = {plan["layer"]: plan["crs"] for plan in plans}
+    writer = writer_class([(layer_id, columns) for layer_id, columns, _ in layers], crs_by_layer)
+    
+    count = 0
+    try:
+        buffer = bytearray(writer.begin())
+        for layer_id, _, features in layers:
+            for feature in features:
+                buffer += writer.write(layer_id, feature)
+                count += 1
+                if len(buffer) >= CHUNK_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+        buffer += writer.end()
+        if buffer:
+            yield bytes(buffer)
+        yield from writer.chunks()  # formats written to disk first (GeoPackage)
+        print(f"DEBUG: Exported {count} features in {(time.time() - start_time) * 1000:.1f}ms")
+    except Exception as e:
+        # Headers are already sent; all we can do is end the response early
+        print(f"DEBUG: Export failed after {count} features: {e}")
+        raise
+    finally:
+        writer.close()
+
+@app.route("/api/features", methods=["GET"])
+def get_features():
+    """Get features for a specific layer with pagination support"""
+    try:
+        layer_id = request.args.get("layer")
+        geometry = request.args.get("geometry")  # WKT format
+        page = int(request.args.get("page", "1"))
+        page_size = int(request.args.get("pageSize", "100"))
+        start_index = (page - 1) * page_size
+        
+        if not layer_id:
+            return jsonify({"error": "Layer ID is required"}), 400
+        
+        try:
+            if geometry and geometry != "1=1":
+                spatial_filter.parse_wkt(geometry)
+            simplification = parse_simplification(request.args, [layer_id])
+            output_format = response_format(request.args)
+        except ValueError as e:  # includes spatial_filter.InvalidGeometry
+            return jsonify({"error": str(e)}), 400
+        
+        # Geometry field comes from the layer's cached schema
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
-        # Add spatial filter if geometry provided
+        # Spatial filter if geometry provided
+        cql_filter = "1=1"  # Default filter to show all features
         if geometry and geometry != "1=1":
-            wfs_params["CQL_FILTER"] = f"INTERSECTS(the_geom, {geometry})"  # Use 'the_geom' as it's the correct field name
+            cql_filter = spatial_filter.intersects_filter(geom_field, geometry)
+        
+        # Total count for pagination from a resultType=hits request, cached per (layer, filter).
+        # getTotalCount is still accepted but no longer needed: counts are cheap once cached.
+        # The count is optional: without a cached one it is skipped when the deadline is too close.
+        total_features = feature_counts.cached(layer_id, cql_filter)
+        count_failed = False
+        if total_features is None and budget_allows("wfs_hits", "wfs_getfeature"):
+            total_features = feature_counts.count(layer_id, cql_filter)
+            count_failed = total_features is None  # Not the same as 0: the total is unknown
+        count_skipped = total_features is None and not count_failed
+        if count_skipped:
+            print(f"DEBUG: Skipping the feature count, {request_deadline.remaining():.2f}s left of the request's deadline")
+        total_pages = None if total_features is None else max(1, (total_features + page_size - 1) // page_size)
+        
+        # Prepare WFS request
+        wfs_params = features_page_params(layer_id, cql_filter, page_size, start_index)
         
         # Make WFS request
         print(f"DEBUG: Making WFS request with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = wfs_get_feature(wfs_params)
         print(f"DEBUG: WFS response status: {response.status_code}")
         
+        if response.status_code == 200:
+            prefetch_adjacent_pages(wfs_params, page, page_size, total_pages or page + 1)
+        
+        if response.status_code == 200 and output_format == "flatgeobuf":
+            # Convert feature by feature instead of decoding the whole collection
+            metadata = {
+                "pagination": {
+                    "page": page,
+                    "pageSize": page_size,
+                    "totalFeatures": total_features,
+                    "totalPages": total_pages,
+                    "hasMore": page < total_pages if total_pages else None,
+                    "startIndex": start_index
+                }
+            }
+            if total_features is None:
+                metadata["pagination"]["countFailed" if count_failed else "countSkipped"] = True
+            if simplification:
+                metadata["simplification"] = simplification_info(simplification)
+            features = decode_features(FeatureStream(iter_chunks(response.content)), simplification and simplification[layer_id])
+            return flatgeobuf_response(generate_flatgeobuf([(layer_id, features)], metadata))
+        
         if response.status_code == 200:
             try:
-                geo_json = response.json()
+                with request_metrics.stage("decode"):
+                    geo_json = response.json()
                 features = geo_json.get("features", [])
                 print(f"DEBUG: Retrieved {len(features)} features")
                 
-                # Calculate pagination info
-                total_pages = max(1, (total_features + page_size - 1) // page_size) if total_features > 0 else 1
-                has_more = page < total_pages
+                # Calculate pagination info (without a count, a full page means there may be more)
+                has_more = page < total_pages if total_pages else len(features) == page_size
                 print(f"DEBUG: Pagination - total_features: {total_features}, total_pages: {total_pages}, current_page: {page}, has_more: {has_more}")
                 
-                return jsonify({
+                result = {
                     "features": features,
                     "pagination": {
                         "page": page,
@@ -442,7 +1514,13 @@ def get_features():
                         "startIndex": start_index,
                         "endIndex": start_index + len(features) - 1
                     }
-                })
+                }
+                if total_features is None:
+                    result["pagination"]["countFailed" if count_failed else "countSkipped"] = True
+                if simplification:
+                    result["features"] = geometry_simplify.simplify_features(features, *simplification[layer_id])
+                    result["simplification"] = simplification_info(simplification)
+                return jsonify(result)
             except json.JSONDecodeError as e:
                 print(f"DEBUG: JSON decode error: {e}")
                 print(f"DEBUG: Response text: {response.text[:500]}...")
@@ -452,20 +1530,192 @@ def get_features():
             print(f"DEBUG: Response text: {response.text[:500]}...")
             return jsonify({"error": f"WFS request failed: HTTP {response.status_code} - {response.text[:200]}"}), 500
             
+    except requests.Timeout as e:  # includes running out of the request's deadline
+        return jsonify({"error": f"GeoServer did not answer in time: {e}"}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def features_page_params(layer_id, cql_filter, page_size, start_index):
+    """GetFeature parameters for a page of /api/features (also used by the cache warm-up)"""
+    return {
+        "service": "WFS",
+        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+        "request": "GetFeature",
+        "typeName": layer_id,
+        "outputFormat": "application/json",
+        "maxFeatures": str(page_size), # Use page_size for maxFeatures
+        "startIndex": str(start_index),
+        "CQL_FILTER": cql_filter
+    }
+
+@app.route("/api/features/count", methods=["GET"])
+def get_feature_count():
+    """Get the number of features in a layer, optionally inside a WKT geometry"""
+    try:
+        layer_id = request.args.get("layer")
+        geometry = request.args.get("geometry")  # WKT format
+        
+        if not layer_id:
+            return jsonify({"error": "Layer ID is required"}), 400
+        
+        cql_filter = "1=1"
+        if geometry and geometry != "1=1":
+            try:
+                spatial_filter.parse_wkt(geometry)
+            except spatial_filter.InvalidGeometry as e:
+                return jsonify({"error": str(e)}), 400
+            geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
+            cql_filter = spatial_filter.intersects_filter(geom_field, geometry)
+        
+        cached = feature_counts.cached(layer_id, cql_filter) is not None
+        total_features = feature_counts.count(layer_id, cql_filter)
+        if total_features is None:
+            return jsonify({"error": "GeoServer did not return a feature count"}), 502
+        
+        return jsonify({
+            "layer": layer_id,
+            "totalFeatures": total_features,
+            "cached": cached
+        })
+        
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/tiles/<layer_id>/<int:z>/<int:x>/<int:y>.mvt", methods=["GET"])
+def get_vector_tile(layer_id, z, x, y):
+    """Mapbox Vector Tile of a layer's features in XYZ tile z/x/y, cached once built"""
+    if not vector_tile.valid_tile(z, x, y):
+        return jsonify({"error": f"No tile {z}/{x}/{y}"}), 404
+    
+    key = (layer_id, z, x, y)
+    content = vector_tile_cache.get(key)
+    if content is None:
+        content, shared = vector_tile_flights.do(key, lambda: build_vector_tile(layer_id, z, x, y))
+        if content is None:
+            return jsonify({"error": f"Could not load features for tile {z}/{x}/{y} of {layer_id}"}), 502
+    
+    etag = hashlib.sha1(content).hexdigest()
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={VECTOR_TILE_BROWSER_MAX_AGE}"
+    }
+    # Weak comparison: the client may hold the compressed representation's weak ETag
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    return Response(content, mimetype=vector_tile.MEDIA_TYPE, headers=headers)
 
+def build_vector_tile(layer_id, z, x, y):
+    """
+    Fetch the features in a tile's bbox (plus its buffer) through the
+    GetFeature cache, encode them as a vector tile and cache it.
+    Returns the tile bytes, or None if GeoServer did not answer.
+    """
+    schema = layer_schemas.get(layer_id)
+    geom_field = (schema or {}).get("geometryField") or "the_geom"
+    # Tiles are web mercator; layers are assumed to be in lon/lat unless their native CRS is web mercator
+    geographic = layer_is_geographic(layer_id)
+    minx, miny, maxx, maxy = vector_tile.tile_bounds(z, x, y, geographic=geographic)
+    
+    wfs_params = {
+        "service": "WFS",
+        "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+        "request": "GetFeature",
+        "typeName": layer_id,
+        "outputFormat": "application/json",
+        "maxFeatures": str(VECTOR_TILE_MAX_FEATURES),
+        "CQL_FILTER": f"BBOX({geom_field}, {minx}, {miny}, {maxx}, {maxy})"
+    }
+    try:
+        response = wfs_get_feature(wfs_params)
+    except requests.RequestException as e:
+        print(f"DEBUG: GetFeature for tile {z}/{x}/{y} of {layer_id} failed: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"DEBUG: GetFeature for tile {z}/{x}/{y} of {layer_id} failed - HTTP {response.status_code}")
+        return None
+    
+    try:
+        with request_metrics.stage("decode"):
+            features = response.json().get("features", [])
+    except ValueError as e:
+        print(f"DEBUG: Invalid GetFeature response for tile {z}/{x}/{y} of {layer_id}: {e}")
+        return None
+    if len(features) >= VECTOR_TILE_MAX_FEATURES:
+        print(f"DEBUG: Tile {z}/{x}/{y} of {layer_id} hit the {VECTOR_TILE_MAX_FEATURES} feature limit")
+    
+    with request_metrics.stage("serialize"):
+        content = vector_tile.encode_tile([(layer_id, vector_tile.tile_geometries(features, z, x, y, geographic))])
+    vector_tile_cache.put((layer_id, z, x, y), content, len(content),
+                          layer_id=layer_id, ttl=FEATURE_CACHE_LAYER_TTLS.get(layer_id))
+    print(f"DEBUG: Built tile {z}/{x}/{y} of {layer_id}: {len(features)} features, {len(content)} bytes")
+    return content
+
+@app.route("/api/cache/purge", methods=["POST"])
+def purge_cache():
+    """Drop cached responses, counts and schema for one layer (?layer=...), or everything"""
+    layer_id = request.args.get("layer")
+    if layer_id:
+        removed = feature_cache.purge_layer(layer_id)
+        vector_tile_cache.purge_layer(layer_id)
+    else:
+        removed = feature_cache.stats()["entries"]
+        feature_cache.clear()
+        vector_tile_cache.clear()
+    feature_counts.invalidate(layer_id)
+    layer_schemas.invalidate(layer_id)
+    if not layer_id or layer_id in MIRROR_LAYERS:
+        feature_mirror.refresh_soon()
+    return jsonify({
+        "success": True,
+        "layer": layer_id,
+        "purgedResponses": removed
+    })
+
+@app.route("/api/ready", methods=["GET"])
+def readiness():
+    """Readiness probe: 200 once the startup cache warm-up has finished, 503 while it is running"""
+    status = cache_warmup.status()
+    status["pid"] = os.getpid()
+    return jsonify(status), 200 if status["ready"] else 503
 
 @app.route("/api/performance", methods=["GET"])
 def get_performance():
-    """Get performance metrics for recent queries"""
-    # This could be extended to store and retrieve performance metrics
+    """
+    Get performance metrics for recent requests: p50/p95/p99 per endpoint,
+    per stage and per layer over the last requests, error rates and
+    upstream bytes. ?format=prometheus returns the same as /api/metrics.
+    """
+    if request.args.get("format") == "prometheus":
+        return get_metrics()
     return jsonify({
-        "message": "Performance metrics endpoint",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "uptime": time.time() - request_stats.started,
+        "bufferSize": request_stats.buffer_size,
+        "endpoints": request_stats.snapshot(),
+        "geoserver": geoserver_client.get_stats(),
+        "circuitBreakers": geoserver_client.breaker_status(),
+        "featureCounts": feature_counts.stats,
+        "featureCache": feature_cache.stats(),
+        "vectorTileCache": vector_tile_cache.stats(),
+        "coalescing": {
+            "wfs_getfeature": feature_flights.status(),
+            "wfs_hits": feature_counts.flights.status(),
+            "vector_tile": vector_tile_flights.status()
+        },
+        "featureMirror": feature_mirror.status(),
+        "compression": compression.stats.status(),
+        "prefetch": page_prefetcher.status()
     })
 
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Request and GeoServer metrics in the Prometheus text format"""
+    coalescing = {"wfs_getfeature": feature_flights.status(), "wfs_hits": feature_counts.flights.status(),
+                  "vector_tile": vector_tile_flights.status()}
+    return Response(request_stats.prometheus(geoserver_client.get_stats(), coalescing, compression.stats.status(),
+                                             page_prefetcher.status(), geoserver_client.breaker_status()),
+                    mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/test-layer", methods=["GET"])
 def test_layer():
     """Test endpoint to check layer structure and available fields"""
@@ -483,7 +1733,7 @@ def test_layer():
         }
         
         print(f"DEBUG: Testing layer structure with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         print(f"DEBUG: Test response status: {response.status_code}")
         
         if response.status_code == 200:
@@ -547,7 +1797,7 @@ def test_spatial():
             }
             
             print(f"DEBUG: Testing with field '{field_name}' and params: {wfs_params}")
-            response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+            response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
             
             if response.status_code == 200:
                 try:
@@ -584,6 +1834,7 @@ def test_large_area():
     """Test spatial query with a larger area to see if we can find any features"""
     try:
         layer_id = request.args.get("layer", "Picarro:Boundary")
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
         # Use a much larger bounding box for testing
         test_geometry = "POLYGON((-122.5 37.0, -121.5 37.0, -121.5 38.0, -122.5 38.0, -122.5 37.0))"
@@ -595,11 +1846,11 @@ def test_large_area():
             "typeName": layer_id,
             "outputFormat": "application/json",
             "maxFeatures": "10",
-            "CQL_FILTER": f"INTERSECTS(the_geom, {test_geometry})"
+            "CQL_FILTER": f"INTERSECTS({geom_field}, {test_geometry})"
         }
         
         print(f"DEBUG: Testing large area with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         
         if response.status_code == 200:
             try:
@@ -631,6 +1882,7 @@ def test_coordinates():
     """Test coordinate transformation and spatial query with different coordinate systems"""
     try:
         layer_id = request.args.get("layer", "Picarro:Boundary")
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
         # Test coordinates in both EPSG:4326 and EPSG:3857
         test_cases = {
@@ -648,11 +1900,11 @@ def test_coordinates():
                 "typeName": layer_id,
                 "outputFormat": "application/json",
                 "maxFeatures": "5",
-                "CQL_FILTER": f"INTERSECTS(the_geom, {geometry})"
+                "CQL_FILTER": f"INTERSECTS({geom_field}, {geometry})"
             }
             
             print(f"DEBUG: Testing {coord_system} with params: {wfs_params}")
-            response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+            response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
             
             if response.status_code == 200:
                 try:
@@ -689,6 +1941,7 @@ def test_extent():
     """Test with a very large area to see if we can find any features"""
     try:
         layer_id = request.args.get("layer", "Picarro:Boundary")
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
         # Use a very large bounding box that should cover most of California
         test_geometry = "POLYGON((-125.0 32.0, -114.0 32.0, -114.0 42.0, -125.0 42.0, -125.0 32.0))"
@@ -700,11 +1953,11 @@ def test_extent():
             "typeName": layer_id,
             "outputFormat": "application/json",
             "maxFeatures": "10",
-            "CQL_FILTER": f"INTERSECTS(the_geom, {test_geometry})"
+            "CQL_FILTER": f"INTERSECTS({geom_field}, {test_geometry})"
         }
         
         print(f"DEBUG: Testing large extent with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         
         if response.status_code == 200:
             try:
@@ -750,6 +2003,7 @@ def test_correct_area():
     """Test with a polygon that should intersect with the actual features"""
     try:
         layer_id = request.args.get("layer", "Picarro:Boundary")
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
         # Use coordinates that should intersect with the actual features
         # Based on the coordinates we found: -122.01028502, 37.4351867 to -121.92562039, 37.39958956
@@ -762,11 +2016,11 @@ def test_correct_area():
             "typeName": layer_id,
             "outputFormat": "application/json",
             "maxFeatures": "10",
-            "CQL_FILTER": f"INTERSECTS(the_geom, {test_geometry})"
+            "CQL_FILTER": f"INTERSECTS({geom_field}, {test_geometry})"
         }
         
         print(f"DEBUG: Testing correct area with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         
         if response.status_code == 200:
             try:
@@ -811,7 +2065,7 @@ def test_geometry_field():
         }
         
         print(f"DEBUG: Testing geometry field with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         
         if response.status_code == 200:
             try:
@@ -831,6 +2085,7 @@ def test_geometry_field():
                         "success": True,
                         "all_properties": list(properties.keys()),
                         "geometry_fields": geometry_fields,
+                        "schema": layer_schemas.get(layer_id),
                         "sample_feature": feature
                     })
                 else:
@@ -883,7 +2138,7 @@ def test_spatial_approaches():
                 wfs_params["CQL_FILTER"] = filter_expr
             
             print(f"DEBUG: Testing {approach_name} with params: {wfs_params}")
-            response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+            response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
             
             if response.status_code == 200:
                 try:
@@ -920,6 +2175,7 @@ def test_huge_area():
     """Test with a huge area that should definitely contain the features"""
     try:
         layer_id = request.args.get("layer", "Picarro:Boundary")
+        geom_field = layer_schemas.geometry_field(layer_id) or "the_geom"
         
         # Use a huge area that should definitely contain the features
         # Based on the coordinates we found: around -122.0, 37.4
@@ -932,11 +2188,11 @@ def test_huge_area():
             "typeName": layer_id,
             "outputFormat": "application/json",
             "maxFeatures": "10",
-            "CQL_FILTER": f"INTERSECTS(the_geom, {test_geometry})"
+            "CQL_FILTER": f"INTERSECTS({geom_field}, {test_geometry})"
         }
         
         print(f"DEBUG: Testing huge area with params: {wfs_params}")
-        response = requests.get(WFS_URL, params=wfs_params, timeout=30)
+        response = geoserver_client.get(WFS_URL, params=wfs_params, operation="wfs_getfeature")
         
         if response.status_code == 200:
             try:
@@ -965,6 +2221,36 @@ def test_huge_area():
         return jsonify({"error": str(e)}), 500
 
 
+def warmup_steps():
+    """Named cache warm-up steps for every configured layer"""
+    layer_ids = list(dict.fromkeys([layer["id"] for layer in AVAILABLE_LAYERS] + MIRROR_LAYERS))
+    steps = []
+    for layer_id in layer_ids:
+        steps.append((f"schema:{layer_id}", lambda layer_id=layer_id: layer_schemas.get(layer_id) is not None))
+        steps.append((f"count:{layer_id}", lambda layer_id=layer_id: feature_counts.count(layer_id, "1=1") is not None))
+        steps.append((f"firstPage:{layer_id}", lambda layer_id=layer_id: wfs_get_feature(
+            features_page_params(layer_id, "1=1", WARMUP_PAGE_SIZE, 0)).status_code == 200))
+    return steps
+
+def start_background_tasks():
+    """Start the app's background threads (the layer mirror's load/refresh loop and the cache warm-up)"""
+    feature_mirror.start()
+    if WARMUP_ENABLED:
+        cache_warmup.start(warmup_steps())
+    else:
+        cache_warmup.skip()
+
+# A preloading WSGI server imports this module in its master process before
+# forking workers, and threads started there would not survive the fork (locks
+# they hold would stay locked in the workers). start_servers.py sets
+# API_START_BACKGROUND=false in that case and starts them in each worker instead.
+# Started at the end of the module so the warm-up can use every function above.
+# Run as a script, the debug reloader's parent process only watches files and
+# restarts the server in a child (WERKZEUG_RUN_MAIN=true), which does the work.
+_reloader_parent = __name__ == "__main__" and os.environ.get("WERKZEUG_RUN_MAIN") != "true"
+if os.environ.get("API_START_BACKGROUND", "true").lower() == "true" and not _reloader_parent:
+    start_background_tasks()
+
 if __name__ == "__main__":
     print("Starting GIS API Server...")
     print(f"GeoServer URL: {GEOSERVER_BASE_URL}")
@@ -975,7 +2261,10 @@ if __name__ == "__main__":
     print("  - GET  /api/layers")
     print("  - POST /api/spatial-query")
     print("  - GET  /api/features")
+    print("  - GET  /api/features/count")
+    print("  - GET  /api/ready")
     print("  - GET  /api/performance")
+    print("  - GET  /api/metrics")
 
     
     try:
@@ -0,0 +1,84 @@
+"""
+Grouping and local matching for batch spatial queries.
+
+A batch query asks which features of a layer intersect each of many
+polygons. Instead of one GeoServer request per polygon, the polygons are
+split into groups whose INTERSECTS terms are OR-ed into one CQL filter
+(see spatial_filter.intersects_any_filter). Each group is fetched once,
+features found by several groups are kept once, and every feature is
+matched to the input polygons it intersects locally, through an STR-tree
+over the polygons.
+"""
+
+import json
+
+import numpy as np
+import shapely
+from shapely.errors import ShapelyError
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+
+def group_geometries(wkts, geometries, max_count, max_chars):
+    """
+    Split geometry indices into groups of at most max_count whose WKT adds
+    up to at most max_chars (a longer single WKT gets a group of its own).
+    Geometries are ordered west to east first, so each group's combined
+    envelope, which prefilters the query, stays small.
+    """
+    order = sorted(range(len(wkts)), key=lambda index: shapely.bounds(geometries[index])[0])
+    groups = []
+    current, chars = [], 0
+    for index in order:
+        length = len(wkts[index])
+        if current and (len(current) >= max_count or chars + length > max_chars):
+            groups.append(current)
+            current, chars = [], 0
+        current.append(index)
+        chars += length
+    if current:
+        groups.append(current)
+    return groups
+
+
+def feature_key(feature):
+    """Identity of a feature across grouped responses: its id, else its content"""
+    if feature.get("id") is not None:
+        return feature["id"]
+    return json.dumps(feature, sort_keys=True)
+
+
+def merge_features(feature_lists):
+    """Features of several responses, each feature once, in first-seen order"""
+    seen = set()
+    merged = []
+    for features in feature_lists:
+        for feature in features:
+            key = feature_key(feature)
+            if key not in seen:
+                seen.add(key)
+                merged.append(feature)
+    return merged
+
+
+def assign(features, geometries):
+    """For each geometry, the indices (in order) of the features that intersect it"""
+    matches = [[] for _ in geometries]
+    shapes = []
+    positions = []
+    for position, feature in enumerate(features):
+        try:
+            geometry = shape(feature["geometry"]) if feature.get("geometry") else None
+        except (ShapelyError, ValueError, TypeError, KeyError, AttributeError):
+            geometry = None
+        if geometry is not None and not geometry.is_empty:
+            shapes.append(geometry)
+            positions.append(position)
+    if not shapes or not geometries:
+        return matches
+
+    tree = STRtree(geometries)
+    feature_indices, geometry_indices = tree.query(np.array(shapes, dtype=object), predicate="intersects")
+    for feature_index, geometry_index in sorted(zip(feature_indices.tolist(), geometry_indices.tolist())):
+        matches[geometry_index].append(positions[feature_index])
+    return matches
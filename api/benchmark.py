@@ -0,0 +1,375 @@
+"""
+Benchmark suite for the /api/* endpoints and the WMS tile proxy.
+
+Runs app.py (and queries.py for /wms-proxy) in-process against
+fake_geoserver.FakeGeoServer (synthetic layers, configurable upstream
+latency). Every endpoint scenario is warmed
+up and then requested a fixed number of times from a number of concurrent
+clients. Reported per scenario: p50/p95/p99 latency, throughput and peak
+RSS. Results are compared with a saved baseline, and the run exits
+non-zero when a scenario regressed beyond the tolerance.
+
+    python benchmark.py                      # run and compare with benchmark_baseline.json
+    python benchmark.py --save-baseline      # run and store the results as the new baseline
+    python benchmark.py --only spatial-query,features --requests 200 --concurrency 8
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from fake_geoserver import DEFAULT_EXTENT, DEFAULT_FEATURES, FakeGeoServer
+from request_metrics import percentile
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# A scenario regresses when a latency percentile or peak RSS grows, or throughput
+# drops, by more than the tolerance AND by more than these absolute amounts
+# (so sub-millisecond noise on fast endpoints does not fail the run)
+LATENCY_SLACK_MS = 5.0
+RSS_SLACK_MB = 16.0
+
+BATCH_GEOMETRIES = 20  # Geometries per spatial-query-batch request
+VECTOR_TILE_ZOOM = 12
+WMS_TILE_ZOOM = 12
+
+
+def random_polygon(rng, extent=DEFAULT_EXTENT, min_size=0.05, max_size=0.3):
+    """WKT rectangle of random size and position inside extent"""
+    width = rng.uniform(min_size, max_size)
+    height = rng.uniform(min_size, max_size)
+    minx = rng.uniform(extent[0], extent[2] - width)
+    miny = rng.uniform(extent[1], extent[3] - height)
+    maxx, maxy = minx + width, miny + height
+    return (f"POLYGON(({minx:.6f} {miny:.6f}, {maxx:.6f} {miny:.6f}, {maxx:.6f} {maxy:.6f}, "
+            f"{minx:.6f} {maxy:.6f}, {minx:.6f} {miny:.6f}))")
+
+
+def vector_tiles(zoom, extent=DEFAULT_EXTENT):
+    """(x, y) of the web mercator XYZ tiles at zoom that cover extent"""
+    n = 2 ** zoom
+
+    def column(lon):
+        return int((lon + 180) / 360 * n)
+
+    def row(lat):
+        return int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+
+    return [(x, y) for x in range(column(extent[0]), column(extent[2]) + 1)
+            for y in range(row(extent[3]), row(extent[1]) + 1)]
+
+
+def wms_tiles(zoom, extent=DEFAULT_EXTENT):
+    """BBOX strings of the EPSG:4326 tile cache grid tiles at zoom that cover extent"""
+    span = 180.0 / 2 ** zoom
+    first_x, last_x = int((extent[0] + 180) // span), int((extent[2] + 180) // span)
+    first_y, last_y = int((extent[1] + 90) // span), int((extent[3] + 90) // span)
+    return [f"{x * span - 180:.10f},{y * span - 90:.10f},{(x + 1) * span - 180:.10f},{(y + 1) * span - 90:.10f}"
+            for x in range(first_x, last_x + 1) for y in range(first_y, last_y + 1)]
+
+
+def build_scenarios(layers, count, seed):
+    """
+    Scenario name -> function(i) returning (method, path, json body) for
+    request i (0 <= i < count). Requests of a scenario use distinct
+    geometries (or tiles, in a random order) unless the scenario is about
+    repeated requests.
+    """
+    def geometries(name):
+        rng = random.Random(f"{seed}:{name}")
+        return [random_polygon(rng) for _ in range(count)]
+
+    def shuffled(name, items):
+        random.Random(f"{seed}:{name}").shuffle(items)
+        return items
+
+    pools = {name: geometries(name) for name in (
+        "spatial-query", "spatial-query-stream", "spatial-query-paginated", "spatial-query-cursor",
+        "features-geometry", "features-count")}
+    batch_rng = random.Random(f"{seed}:spatial-query-batch")
+    batches = [[random_polygon(batch_rng) for _ in range(BATCH_GEOMETRIES)] for _ in range(count)]
+    exports = geometries("spatial-query-export")
+    repeated = geometries("repeated")[0]
+    layer = layers[0]
+    tiles = shuffled("vector-tile", vector_tiles(VECTOR_TILE_ZOOM))
+    bboxes = shuffled("wms-tile", wms_tiles(WMS_TILE_ZOOM))
+
+    return {
+        "layers": lambda i: ("GET", "/api/layers", None),
+        "spatial-query": lambda i: ("POST", "/api/spatial-query",
+                                    {"geometry": pools["spatial-query"][i], "layers": layers}),
+        "spatial-query-repeated": lambda i: ("POST", "/api/spatial-query",
+                                             {"geometry": repeated, "layers": layers}),
+        "spatial-query-stream": lambda i: ("POST", "/api/spatial-query",
+                                           {"geometry": pools["spatial-query-stream"][i], "layers": layers, "stream": True}),
+        "spatial-query-paginated": lambda i: ("POST", "/api/spatial-query-paginated",
+                                              {"geometry": pools["spatial-query-paginated"][i], "layers": layers,
+                                               "page": 1 + i % 3, "pageSize": 20}),
+        "spatial-query-cursor": lambda i: ("POST", "/api/spatial-query-paginated",
+                                           {"geometry": pools["spatial-query-cursor"][i], "layers": layers,
+                                            "useCursor": True, "pageSize": 20}),
+        "features": lambda i: ("GET", "/api/features?" + urlencode({"layer": layer, "page": 1 + i % 10, "pageSize": 100}), None),
+        "features-geometry": lambda i: ("GET", "/api/features?" + urlencode(
+            {"layer": layer, "geometry": pools["features-geometry"][i], "pageSize": 100}), None),
+        "features-count": lambda i: ("GET", "/api/features/count?" + urlencode(
+            {"layer": layer, "geometry": pools["features-count"][i]}), None),
+        "spatial-query-batch": lambda i: ("POST", "/api/spatial-query-batch",
+                                          {"geometries": batches[i], "layers": layers}),
+        "spatial-query-export": lambda i: ("POST", "/api/spatial-query-export",
+                                           {"geometry": exports[i], "layers": layers, "format": "ndjson"}),
+        "vector-tile": lambda i: ("GET", "/api/tiles/{}/{}/{}/{}.mvt".format(
+            layer, VECTOR_TILE_ZOOM, *tiles[i % len(tiles)]), None),
+        "wms-tile": lambda i: ("GET", "/wms-proxy?" + urlencode(
+            {"layers": layer, "bbox": bboxes[i % len(bboxes)], "width": 256, "height": 256}), None),
+        "performance": lambda i: ("GET", "/api/performance", None),
+    }
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if it cannot be read"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current RSS, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSS:
+    """Samples RSS in a background thread and keeps the maximum seen"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._update()
+
+    def _update(self):
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update()
+
+
+def reset_caches(api, wms):
+    """Drop the API's response, count and tile caches so every round starts cold"""
+    api.feature_cache.clear()
+    api.feature_counts.invalidate()
+    api.vector_tile_cache.clear()
+    wms.tile_cache.clear()
+
+
+def run_scenario(app, make_request, warmup, count, concurrency):
+    """Warm up, then issue count requests from concurrency clients and measure them"""
+    clients = threading.local()
+
+    def issue(i):
+        client = getattr(clients, "client", None)
+        if client is None:
+            client = clients.client = app.test_client()
+        method, path, body = make_request(i)
+        started = time.perf_counter()
+        if method == "POST":
+            response = client.post(path, json=body)
+        else:
+            response = client.get(path)
+        size = len(response.get_data())  # reads streamed bodies to the end
+        return (time.perf_counter() - started) * 1000, response.status_code, size
+
+    # Requests 0..warmup-1 warm up; the measured ones use geometries not seen before
+    for i in range(warmup):
+        issue(i)
+
+    with PeakRSS() as rss, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        samples = list(executor.map(issue, range(warmup, warmup + count)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _, _ in samples]
+    errors = sum(1 for _, status, _ in samples if status >= 400)
+    return {
+        "requests": count,
+        "concurrency": concurrency,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies),
+        "throughput": count / elapsed,
+        "peakRssMb": rss.peak / (1024 * 1024) if rss.peak is not None else None,
+        "errors": errors,
+        "errorRate": errors / count,
+        "avgBytes": sum(size for _, _, size in samples) / count
+    }
+
+
+def median_of_rounds(rounds):
+    """Per-metric median over several runs of one scenario, to damp scheduling noise"""
+    combined = {}
+    for metric in rounds[0]:
+        values = [result[metric] for result in rounds if result[metric] is not None]
+        combined[metric] = percentile(values, 50) if values else None
+    combined["errors"] = sum(result["errors"] for result in rounds)
+    combined["rounds"] = len(rounds)
+    return combined
+
+
+def compare(results, baseline, tolerance):
+    """List of human-readable regressions of results against baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        for metric in ("p50", "p95", "p99"):
+            if result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > LATENCY_SLACK_MS:
+                regressions.append(f"{name}: {metric} {result[metric]:.1f}ms vs baseline {base[metric]:.1f}ms")
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']:.1f}/s vs baseline {base['throughput']:.1f}/s")
+        if result["peakRssMb"] is not None and base.get("peakRssMb") is not None:
+            if result["peakRssMb"] > base["peakRssMb"] * (1 + tolerance) and result["peakRssMb"] - base["peakRssMb"] > RSS_SLACK_MB:
+                regressions.append(f"{name}: peak RSS {result['peakRssMb']:.0f}MB vs baseline {base['peakRssMb']:.0f}MB")
+        if result["errorRate"] > base.get("errorRate", 0):
+            regressions.append(f"{name}: error rate {result['errorRate']:.1%} vs baseline {base.get('errorRate', 0):.1%}")
+    return regressions
+
+
+def print_report(results, baseline):
+    base_scenarios = baseline.get("scenarios", {}) if baseline else {}
+    print(f"{'scenario':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'RSS MB':>9}{'errors':>8}{'p95 vs base':>13}")
+    for name, result in results.items():
+        base = base_scenarios.get(name)
+        change = f"{(result['p95'] / base['p95'] - 1):+.0%}" if base and base["p95"] else "-"
+        rss = f"{result['peakRssMb']:.0f}" if result["peakRssMb"] is not None else "-"
+        print(f"{name:<26}{result['p50']:>9.1f}{result['p95']:>9.1f}{result['p99']:>9.1f}"
+              f"{result['throughput']:>9.1f}{rss:>9}{result['errors']:>8}{change:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /api/* endpoints against a local GeoServer stand-in")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per scenario; the median of each metric is reported")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="latency of every fake GeoServer response")
+    parser.add_argument("--features", type=int, default=DEFAULT_FEATURES, help="features per synthetic layer")
+    parser.add_argument("--layers", default="Picarro:Boundary", help="comma-separated synthetic layer ids")
+    parser.add_argument("--only", help="comma-separated scenario names to run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="keep the API's debug output")
+    args = parser.parse_args()
+
+    layers = [layer_id.strip() for layer_id in args.layers.split(",") if layer_id.strip()]
+    fake = FakeGeoServer(layers, args.features, args.latency_ms / 1000)
+    base_url = fake.start()
+
+    # The API reads its configuration at import time
+    os.environ["GEOSERVER_URL"] = base_url
+    os.environ.pop("MIRROR_LAYERS", None)
+    os.environ.setdefault("TILE_CACHE_DIR", tempfile.mkdtemp(prefix="benchmark-tiles-"))
+    import app as api
+    import queries as wms
+
+    api.AVAILABLE_LAYERS[:] = [{"id": layer_id, "name": layer_id.split(":")[-1], "visible": True} for layer_id in layers]
+    scenarios = build_scenarios(layers, args.warmup + args.requests, args.seed)
+    if args.only:
+        selected = [name.strip() for name in args.only.split(",")]
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(unknown)} (available: {', '.join(scenarios)})")
+        scenarios = {name: scenarios[name] for name in selected}
+
+    results = {}
+    quiet = open(os.devnull, "w")
+    for name, make_request in scenarios.items():
+        print(f"Running {name} ...", file=sys.stderr)
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+            # /api/* is served by app.py, the WMS proxy by queries.py
+            target = api.app if make_request(0)[1].startswith("/api/") else wms.app
+            rounds = []
+            for _ in range(args.rounds):
+                reset_caches(api, wms)
+                rounds.append(run_scenario(target, make_request, args.warmup, args.requests, args.concurrency))
+            results[name] = median_of_rounds(rounds)
+    quiet.close()
+    fake.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "rounds": args.rounds,
+            "latencyMs": args.latency_ms,
+            "features": args.features,
+            "layers": layers,
+            "python": sys.version.split()[0]
+        },
+        "scenarios": results,
+        "upstreamRequests": fake.requests
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config", {}).get("latencyMs") != args.latency_ms or baseline.get("config", {}).get("features") != args.features:
+            print("Warning: baseline was recorded with a different --latency-ms/--features", file=sys.stderr)
+
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        return 1
+    print(f"\nNo regressions beyond {args.tolerance:.0%} against the baseline from {baseline.get('timestamp')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Cache warm-up after the API starts.
+
+Every cache starts empty after a restart, so the first users pay for
+DescribeFeatureType lookups, geometry field probing, full-layer hit
+counts and uncached first pages. CacheWarmup runs a list of named steps
+(one per layer and cache) in parallel in the background. It records how
+long each step took and whether it failed, and reports ready once all
+steps have finished or the warm-up timeout has passed. /api/ready
+answers 503 until then. Given a ready_dir (API_READY_DIR), each process
+also writes <pid>.json there once it is ready, so start_servers.py can
+wait for every worker without asking them one by one through a shared
+socket.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 60  # Seconds before the API reports ready even if steps are still running
+
+
+class CacheWarmup:
+    """Runs warm-up steps once and tracks whether they are done"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, ready_dir=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.ready_dir = ready_dir
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._thread = None
+        self._steps = {}  # name -> {"status": ..., "ms": ..., "error": ...}
+        self.started_at = None
+        self.finished_at = None
+        self.timed_out = False
+
+    def start(self, steps):
+        """Run steps, a list of (name, callable), in a background thread. A step fails by raising or returning False."""
+        if self._thread is not None:
+            return
+        self.started_at = time.time()
+        self._steps = {name: {"status": "pending", "ms": None, "error": None} for name, _ in steps}
+        self._thread = threading.Thread(target=self._run, args=(steps,), name="cache-warmup", daemon=True)
+        self._thread.start()
+
+    def skip(self):
+        """Report ready without warming anything"""
+        self._mark_ready()
+
+    def ready(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _run(self, steps):
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cache-warmup")
+        try:
+            futures = [executor.submit(self._run_step, name, step) for name, step in steps]
+            _, not_done = wait(futures, timeout=self.timeout)
+            self.timed_out = bool(not_done)
+        finally:
+            # Steps still running keep going; they just no longer hold up readiness
+            executor.shutdown(wait=False)
+            self.finished_at = time.time()
+            self._mark_ready()
+        failed = sum(1 for step in self._steps.values() if step["status"] == "failed")
+        print(f"DEBUG: Cache warm-up finished in {self.finished_at - self.started_at:.1f}s "
+              f"({len(steps)} steps, {failed} failed{', timed out' if self.timed_out else ''})")
+
+    def _mark_ready(self):
+        self._done.set()
+        if not self.ready_dir:
+            return
+        status = self.status()
+        path = os.path.join(self.ready_dir, f"{os.getpid()}.json")
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({"seconds": status["seconds"], "failed": status["failed"], "timedOut": status["timedOut"]}, f)
+            os.replace(path + ".tmp", path)  # Whole files only: the reader counts *.json
+        except OSError as e:
+            print(f"DEBUG: Could not report readiness in {self.ready_dir}: {e}")
+
+    def _run_step(self, name, step):
+        started = time.perf_counter()
+        with self._lock:
+            self._steps[name]["status"] = "running"
+        try:
+            ok = step() is not False
+            error = None if ok else "no result"
+        except Exception as e:
+            ok = False
+            error = str(e)
+            print(f"DEBUG: Cache warm-up step {name} failed: {e}")
+        with self._lock:
+            self._steps[name].update(status="done" if ok else "failed", ms=(time.perf_counter() - started) * 1000,
+                                     error=error)
+
+    def status(self):
+        with self._lock:
+            steps = {name: dict(step) for name, step in self._steps.items()}
+        return {
+            "ready": self.ready(),
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+            "seconds": (self.finished_at or time.time()) - self.started_at if self.started_at else None,
+            "timedOut": self.timed_out,
+            "failed": sum(1 for step in steps.values() if step["status"] == "failed"),
+            "steps": steps
+        }
@@ -0,0 +1,96 @@
+"""
+Circuit breakers for GeoServer operations.
+
+While GeoServer is failing or timing out, every call would otherwise wait
+for its full timeout, and request threads pile up behind it. A breaker
+counts consecutive failures of one operation. After FAILURE_THRESHOLD of
+them it opens, and calls are rejected at once with CircuitOpenError for
+OPEN_SECONDS. Then a single trial call is let through (half-open). If it
+succeeds the breaker closes, and if it fails the breaker opens again.
+"""
+
+import threading
+import time
+
+import requests
+
+FAILURE_THRESHOLD = 5  # Consecutive failures that open the breaker
+OPEN_SECONDS = 15  # Seconds calls are rejected before a trial call is allowed
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Numeric states for metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """The operation's breaker is open; GeoServer was not called"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for one upstream operation"""
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0, "failures": 0, "successes": 0}
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go to GeoServer now"""
+        with self._lock:
+            if self.state == OPEN and time.time() - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.stats["rejected"] += 1
+            retry_in = max(0.0, self.open_seconds - (time.time() - self._opened_at))
+        raise CircuitOpenError(f"GeoServer {self.name} circuit is open after {self.failure_threshold} "
+                               f"consecutive failures; retrying in {retry_in:.0f}s")
+
+    def record_success(self):
+        with self._lock:
+            self.stats["successes"] += 1
+            self._failures = 0
+            if self.state != CLOSED:
+                print(f"DEBUG: GeoServer {self.name} circuit closed")
+            self.state = CLOSED
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.stats["failures"] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.time()
+                self._trial_in_flight = False
+                self.stats["opened"] += 1
+                print(f"DEBUG: GeoServer {self.name} circuit opened after {self._failures} consecutive failures")
+
+    def record_no_signal(self):
+        """The call ended without telling anything about GeoServer (e.g. the client's deadline ran out)"""
+        with self._lock:
+            self._trial_in_flight = False  # A half-open breaker lets the next call try instead
+
+    def status(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutiveFailures": self._failures,
+                "openedAt": self._opened_at if self.state != CLOSED else None,
+                "failureThreshold": self.failure_threshold,
+                "openSeconds": self.open_seconds,
+                **self.stats
+            }
@@ -0,0 +1,166 @@
+"""
+Response compression negotiated from Accept-Encoding.
+
+GeoJSON responses are large and compress well (coordinates and property
+names repeat). compress_response() encodes a response with brotli (when
+the Brotli package is installed) or gzip, whichever the client prefers.
+Buffered bodies below COMPRESSION_MIN_BYTES are sent as they are.
+Streamed bodies are compressed chunk by chunk as they are generated, so
+they are never held in memory, and are always compressed because their
+size is not known in advance.
+"""
+
+import os
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", "6"))  # gzip, 1-9
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))  # brotli, 0-11; higher is much slower
+
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/geo+json",
+    "application/xml",
+    "application/javascript",
+    "application/flatgeobuf",
+    "application/x-ndjson",
+    "application/vnd.mapbox-vector-tile"
+}
+
+
+class CompressionStats:
+    """Bytes before and after compression per encoding"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encodings = {}
+        self.skipped = 0
+
+    def record(self, encoding, bytes_in, bytes_out):
+        with self._lock:
+            stats = self._encodings.setdefault(encoding, {"responses": 0, "bytesIn": 0, "bytesOut": 0})
+            stats["responses"] += 1
+            stats["bytesIn"] += bytes_in
+            stats["bytesOut"] += bytes_out
+
+    def record_skipped(self):
+        with self._lock:
+            self.skipped += 1
+
+    def status(self):
+        with self._lock:
+            encodings = {encoding: dict(stats) for encoding, stats in self._encodings.items()}
+            skipped = self.skipped
+        for stats in encodings.values():
+            stats["ratio"] = stats["bytesIn"] / stats["bytesOut"] if stats["bytesOut"] else None
+        bytes_in = sum(stats["bytesIn"] for stats in encodings.values())
+        bytes_out = sum(stats["bytesOut"] for stats in encodings.values())
+        return {
+            "encodings": encodings,
+            "ratio": bytes_in / bytes_out if bytes_out else None,
+            "skippedBelowMinimum": skipped,
+            "available": ENCODINGS,
+            "minBytes": COMPRESSION_MIN_BYTES,
+            "gzipLevel": COMPRESSION_LEVEL,
+            "brotliQuality": BROTLI_QUALITY
+        }
+
+    def reset(self):
+        with self._lock:
+            self._encodings.clear()
+            self.skipped = 0
+
+
+stats = CompressionStats()
+
+
+class _Compressor:
+    def __init__(self, encoding):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+
+    def compress(self, data):
+        return self._brotli.process(data) if self._brotli else self._zlib.compress(data)
+
+    def finish(self):
+        return self._brotli.finish() if self._brotli else self._zlib.flush()
+
+
+def compress(data, encoding):
+    """Compress a whole body"""
+    compressor = _Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress an iterable of chunks as it is consumed, recording the ratio at the end"""
+    compressor = _Compressor(encoding)
+    bytes_in = bytes_out = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            bytes_in += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                bytes_out += len(data)
+                yield data
+        data = compressor.finish()
+        bytes_out += len(data)
+        yield data
+        stats.record(encoding, bytes_in, bytes_out)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def negotiate(accept_encodings):
+    """Preferred supported encoding from a request's accept_encodings, or None"""
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def is_compressible(response):
+    mimetype = response.mimetype or ""
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES or mimetype.endswith(("+json", "+xml"))
+
+
+def compress_response(response, request):
+    """Compress a Flask response if the client accepts it and it is worth it"""
+    response.vary.add("Accept-Encoding")
+    if (request.method == "HEAD" or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough or "Content-Encoding" in response.headers
+            or "no-transform" in response.headers.get("Cache-Control", "") or not is_compressible(response)):
+        return response
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            stats.record_skipped()
+            return response
+        compressed = compress(data, encoding)
+        stats.record(encoding, len(data), len(compressed))
+        response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)  # the compressed bytes differ from the ones the strong ETag names
+    return response
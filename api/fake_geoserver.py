@@ -0,0 +1,296 @@
+"""
+Local stand-in for GeoServer, used by benchmark.py.
+
+Serves synthetic layers over the same WFS/WMS requests the API makes:
+DescribeFeatureType, GetFeature (JSON or resultType=hits, with
+INTERSECTS/BBOX CQL filters or both, parenthesized OR-ed INTERSECTS, keyset "AND key > value" filters, sortBy,
+startIndex and maxFeatures), GetCapabilities and GetMap. Every response
+can be delayed by a fixed latency to model the network and GeoServer's
+own processing time.
+
+Run it on its own to point a development server at it:
+    python fake_geoserver.py --port 8999 --latency-ms 20
+    GEOSERVER_URL=http://127.0.0.1:8999/geoserver python app.py
+"""
+
+import argparse
+import io
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+from shapely import wkt as shapely_wkt
+from shapely.errors import ShapelyError
+from shapely.geometry import box, mapping
+from shapely.strtree import STRtree
+
+GEOMETRY_FIELD = "the_geom"
+DEFAULT_LAYERS = ("Picarro:Boundary",)
+DEFAULT_FEATURES = 2000
+# Synthetic features are laid out on a grid over this extent (around the area the app is used for)
+DEFAULT_EXTENT = (-122.6, 37.0, -121.6, 37.8)
+
+_KEYSET = re.compile(r"^\((.*)\) AND (\w+) > (.+)$", re.DOTALL)
+_INTERSECTS = re.compile(r"^INTERSECTS\(\s*(\w+)\s*,\s*(.*)\)$", re.DOTALL)
+_BBOX_AND = re.compile(r"^(BBOX\([^)]*\)) AND (.+)$", re.DOTALL)
+_BBOX = re.compile(r"^BBOX\(\s*(\w+)\s*,\s*([-\d.eE]+)\s*,\s*([-\d.eE]+)\s*,\s*([-\d.eE]+)\s*,\s*([-\d.eE]+)\s*(?:,.*)?\)$")
+
+
+class FilterError(ValueError):
+    """CQL filter the stand-in cannot evaluate (GeoServer would answer 400)"""
+
+
+class SyntheticLayer:
+    """A grid of square polygons with gid/name/category/value attributes"""
+
+    def __init__(self, layer_id, feature_count, extent=DEFAULT_EXTENT):
+        self.layer_id = layer_id
+        columns = max(1, int(math.ceil(math.sqrt(feature_count))))
+        rows = max(1, int(math.ceil(feature_count / columns)))
+        cell_width = (extent[2] - extent[0]) / columns
+        cell_height = (extent[3] - extent[1]) / rows
+
+        self.geometries = []
+        self.gids = []
+        self.encoded = []  # each feature's GeoJSON, serialized once
+        short_name = layer_id.split(":")[-1]
+        for index in range(feature_count):
+            x = extent[0] + (index % columns) * cell_width
+            y = extent[1] + (index // columns) * cell_height
+            geometry = box(x, y, x + cell_width * 0.9, y + cell_height * 0.9)
+            gid = index + 1
+            feature = {
+                "type": "Feature",
+                "id": f"{short_name}.{gid}",
+                "geometry": {"type": "MultiPolygon", "coordinates": [mapping(geometry)["coordinates"]]},
+                "geometry_name": GEOMETRY_FIELD,
+                "properties": {"gid": gid, "name": f"{short_name} {gid}", "category": gid % 7, "value": gid * 1.5}
+            }
+            self.geometries.append(geometry)
+            self.gids.append(gid)
+            self.encoded.append(json.dumps(feature, separators=(",", ":")).encode("utf-8"))
+        self.tree = STRtree(self.geometries)
+
+    def select(self, cql_filter):
+        """Indices of the features matching a CQL filter, in gid order. Raises FilterError."""
+        cql_filter = (cql_filter or "").strip()
+        if not cql_filter or cql_filter == "1=1":
+            return list(range(len(self.geometries)))
+
+        keyset = _KEYSET.match(cql_filter)
+        if keyset:
+            if keyset.group(2) != "gid":
+                raise FilterError(f"Unknown attribute {keyset.group(2)}")
+            last_value = float(keyset.group(3).strip("'"))
+            return [index for index in self.select(keyset.group(1)) if self.gids[index] > last_value]
+
+        if cql_filter.startswith("(") and cql_filter.endswith(")") and " OR " in cql_filter:
+            matched = set()
+            for term in cql_filter[1:-1].split(" OR "):
+                matched.update(self.select(term))
+            return sorted(matched)
+
+        bbox_and = _BBOX_AND.match(cql_filter)
+        if bbox_and:
+            candidates = set(self.select(bbox_and.group(1)))
+            return [index for index in self.select(bbox_and.group(2)) if index in candidates]
+
+        intersects = _INTERSECTS.match(cql_filter)
+        bbox = _BBOX.match(cql_filter)
+        if intersects:
+            field = intersects.group(1)
+            try:
+                geometry = shapely_wkt.loads(intersects.group(2))
+            except (ShapelyError, ValueError) as e:
+                raise FilterError(f"Invalid WKT: {e}")
+        elif bbox:
+            field = bbox.group(1)
+            geometry = box(*(float(bbox.group(group)) for group in range(2, 6)))
+        else:
+            raise FilterError(f"Unsupported filter: {cql_filter[:80]}")
+        if field != GEOMETRY_FIELD:
+            raise FilterError(f"Illegal property name: {field}")
+        return sorted(int(index) for index in self.tree.query(geometry, predicate="intersects"))
+
+
+class FakeGeoServer:
+    """Threaded HTTP server answering the WFS/WMS requests the API makes"""
+
+    def __init__(self, layers=DEFAULT_LAYERS, features_per_layer=DEFAULT_FEATURES, latency=0.0, workspace="Picarro"):
+        self.layers = {layer_id: SyntheticLayer(layer_id, features_per_layer) for layer_id in layers}
+        self.latency = latency  # seconds added to every response
+        self.workspace = workspace
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        """GeoServer base URL (the equivalent of http://host:8181/geoserver)"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/geoserver"
+
+    def start(self, port=0):
+        """Serve in a background thread; port 0 picks a free port"""
+        server = ThreadingHTTPServer(("127.0.0.1", port), _handler_for(self))
+        server.daemon_threads = True
+        self._server = server
+        threading.Thread(target=server.serve_forever, name="fake-geoserver", daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def handle(self, params):
+        """(status, body, content type) for a request's lower-cased query parameters"""
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        request_type = params.get("request", "").lower()
+        if request_type == "getfeature":
+            return self._get_feature(params)
+        if request_type == "describefeaturetype":
+            return self._describe_feature_type(params)
+        if request_type == "getmap":
+            return self._get_map(params)
+        if request_type == "getcapabilities":
+            return self._get_capabilities(params)
+        return 400, _service_exception(f"Unsupported request: {request_type}"), "application/xml"
+
+    def _layer(self, params):
+        layer_id = params.get("typename") or params.get("typenames") or params.get("layers") or ""
+        return self.layers.get(layer_id)
+
+    def _get_feature(self, params):
+        layer = self._layer(params)
+        if layer is None:
+            return 400, _service_exception("Unknown feature type"), "application/xml"
+        try:
+            matches = layer.select(params.get("cql_filter"))
+        except FilterError as e:
+            return 400, _service_exception(str(e)), "application/xml"
+
+        if params.get("resulttype", "").lower() == "hits":
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+                    f'numberOfFeatures="{len(matches)}" timeStamp="{time.strftime("%Y-%m-%dT%H:%M:%S")}"/>')
+            return 200, body.encode("utf-8"), "text/xml; subtype=gml/3.1.1"
+
+        start_index = int(params.get("startindex", 0))
+        max_features = int(params.get("maxfeatures") or params.get("count") or len(matches))
+        page = matches[start_index:start_index + max_features]
+        body = b"".join([
+            b'{"type":"FeatureCollection","features":[',
+            b",".join(layer.encoded[index] for index in page),
+            f'],"totalFeatures":{len(matches)},"numberMatched":{len(matches)},"numberReturned":{len(page)},'
+            f'"timeStamp":"{time.strftime("%Y-%m-%dT%H:%M:%S")}Z",'
+            '"crs":{"type":"name","properties":{"name":"urn:ogc:def:crs:EPSG::4326"}}}'.encode("utf-8")
+        ])
+        return 200, body, "application/json;charset=UTF-8"
+
+    def _describe_feature_type(self, params):
+        layer = self._layer(params)
+        if layer is None:
+            return 400, _service_exception("Unknown feature type"), "application/xml"
+        type_name = layer.layer_id.split(":")[-1]
+        body = f'''<?xml version="1.0" encoding="UTF-8"?>
+<xsd:schema xmlns:gml="http://www.opengis.net/gml" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:{self.workspace}="{self.workspace}" targetNamespace="{self.workspace}">
+  <xsd:complexType name="{type_name}Type">
+    <xsd:complexContent>
+      <xsd:extension base="gml:AbstractFeatureType">
+        <xsd:sequence>
+          <xsd:element maxOccurs="1" minOccurs="0" name="{GEOMETRY_FIELD}" nillable="true" type="gml:MultiPolygonPropertyType"/>
+          <xsd:element maxOccurs="1" minOccurs="0" name="gid" nillable="true" type="xsd:int"/>
+          <xsd:element maxOccurs="1" minOccurs="0" name="name" nillable="true" type="xsd:string"/>
+          <xsd:element maxOccurs="1" minOccurs="0" name="category" nillable="true" type="xsd:int"/>
+          <xsd:element maxOccurs="1" minOccurs="0" name="value" nillable="true" type="xsd:double"/>
+        </xsd:sequence>
+      </xsd:extension>
+    </xsd:complexContent>
+  </xsd:complexType>
+  <xsd:element name="{type_name}" substitutionGroup="gml:_Feature" type="{self.workspace}:{type_name}Type"/>
+</xsd:schema>'''
+        return 200, body.encode("utf-8"), "text/xml"
+
+    def _get_map(self, params):
+        try:
+            width = int(params.get("width", 256))
+            height = int(params.get("height", 256))
+        except ValueError:
+            return 400, _service_exception("Invalid width/height"), "application/vnd.ogc.se_xml"
+        image_format = params.get("format", "image/png").lower()
+        image = Image.new("RGBA", (width, height), (51, 136, 255, 96))
+        output = io.BytesIO()
+        if image_format == "image/jpeg":
+            image.convert("RGB").save(output, "JPEG")
+        else:
+            image_format = "image/png"
+            image.save(output, "PNG")
+        return 200, output.getvalue(), image_format
+
+    def _get_capabilities(self, params):
+        if params.get("service", "").upper() == "WFS":
+            feature_types = "".join(
+                f"<FeatureType><Name>{layer_id}</Name><Title>{layer_id.split(':')[-1]}</Title>"
+                f"<DefaultSRS>urn:x-ogc:def:crs:EPSG:4326</DefaultSRS></FeatureType>"
+                for layer_id in self.layers)
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><wfs:WFS_Capabilities xmlns:wfs="http://www.opengis.net/wfs" '
+                    f'xmlns="http://www.opengis.net/wfs" version="1.1.0"><FeatureTypeList>{feature_types}</FeatureTypeList></wfs:WFS_Capabilities>')
+        else:
+            layers = "".join(f"<Layer queryable=\"1\"><Name>{layer_id}</Name><Title>{layer_id.split(':')[-1]}</Title></Layer>"
+                             for layer_id in self.layers)
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><WMS_Capabilities xmlns="http://www.opengis.net/wms" version="1.3.0">'
+                    f'<Capability><Layer><Title>{self.workspace}</Title>{layers}</Layer></Capability></WMS_Capabilities>')
+        return 200, body.encode("utf-8"), "application/xml"
+
+
+def _service_exception(message):
+    return (f'<?xml version="1.0" encoding="UTF-8"?><ServiceExceptionReport version="1.2.0">'
+            f'<ServiceException>{message}</ServiceException></ServiceExceptionReport>').encode("utf-8")
+
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like GeoServer behind Jetty
+
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+            params = {name.lower(): values[0] for name, values in query.items()}
+            status, body, content_type = fake.handle(params)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local GeoServer stand-in with synthetic layers")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every response")
+    parser.add_argument("--features", type=int, default=DEFAULT_FEATURES, help="features per layer")
+    parser.add_argument("--layers", default=",".join(DEFAULT_LAYERS), help="comma-separated layer ids")
+    args = parser.parse_args()
+
+    fake = FakeGeoServer([layer_id.strip() for layer_id in args.layers.split(",") if layer_id.strip()],
+                         args.features, args.latency_ms / 1000)
+    print(f"Fake GeoServer at {fake.start(args.port)} with {args.features} features per layer")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
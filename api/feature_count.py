@@ -0,0 +1,138 @@
+"""
+Feature count service.
+
+Counts come from WFS GetFeature with resultType=hits, which returns only
+the number of matching features instead of the features themselves.
+Counts are cached per (layer, CQL filter) for COUNT_TTL seconds so paging
+through a table never asks GeoServer for the same number twice.
+"""
+
+import re
+import threading
+import time
+
+import requests
+
+import geoserver_client
+from single_flight import SingleFlight
+
+COUNT_TTL = 300  # Seconds a cached count stays valid
+COUNT_CACHE_MAX_ENTRIES = 5000
+
+# Attributes GeoServer may use for the total, in order of preference
+# (numberOfFeatures: WFS 1.0/1.1, numberMatched: WFS 2.0)
+_COUNT_PATTERNS = [
+    re.compile(r'numberOfFeatures="?(\d+)"?'),
+    re.compile(r'numberMatched="?(\d+)"?'),
+    re.compile(r'numberReturned="?(\d+)"?'),
+]
+
+
+def parse_hits(text):
+    """Total feature count from a resultType=hits response, or None if it has none"""
+    for pattern in _COUNT_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def normalize_filter(cql_filter):
+    """Cache key form of a CQL filter: whitespace collapsed, '1=1' treated as no filter"""
+    if not cql_filter:
+        return ""
+    normalized = " ".join(cql_filter.split())
+    return "" if normalized == "1=1" else normalized
+
+
+class FeatureCounter:
+    """Cached resultType=hits counts for one WFS endpoint"""
+
+    def __init__(self, wfs_url, ttl=COUNT_TTL):
+        self.wfs_url = wfs_url
+        self.ttl = ttl
+        self._counts = {}  # (layer_id, filter) -> (expires_at, count)
+        self._lock = threading.Lock()
+        self.flights = SingleFlight("wfs_hits")  # identical concurrent counts share one request
+        self.stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def cached(self, layer_id, cql_filter=None):
+        """Cached count for (layer_id, cql_filter) without going upstream, or None"""
+        key = (layer_id, normalize_filter(cql_filter))
+        entry = self._counts.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def count(self, layer_id, cql_filter=None, timeout=None):
+        """
+        Number of features in layer_id matching cql_filter. Served from the
+        cache when possible. Returns None if GeoServer did not return a count.
+        """
+        key = (layer_id, normalize_filter(cql_filter))
+        entry = self._counts.get(key)
+        if entry and entry[0] > time.time():
+            with self._lock:
+                self.stats["hits"] += 1
+            return entry[1]
+
+        with self._lock:
+            self.stats["misses"] += 1
+
+        total, _ = self.flights.do(key, lambda: self._fetch(key, timeout))
+        return total
+
+    def _fetch(self, key, timeout):
+        """Ask GeoServer for the count of a (layer, filter) key and cache it"""
+        layer_id = key[0]
+        params = {
+            "service": "WFS",
+            "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+            "request": "GetFeature",
+            "typeName": layer_id,
+            "resultType": "hits"
+        }
+        if key[1]:
+            params["CQL_FILTER"] = key[1]
+
+        try:
+            print(f"DEBUG: Counting features with params: {params}")
+            response = geoserver_client.get(self.wfs_url, params=params, operation="wfs_hits", timeout=timeout)
+        except requests.RequestException as e:
+            print(f"DEBUG: Count request failed: {e}")
+            with self._lock:
+                self.stats["errors"] += 1
+            return None
+
+        total = parse_hits(response.text) if response.status_code == 200 else None
+        if total is None:
+            print(f"DEBUG: No count in hits response (HTTP {response.status_code}): {response.text[:200]}")
+            with self._lock:
+                self.stats["errors"] += 1
+            return None
+
+        print(f"DEBUG: {layer_id} has {total} features matching '{key[1] or '1=1'}'")
+        with self._lock:
+            if len(self._counts) >= COUNT_CACHE_MAX_ENTRIES:
+                self._evict_expired()
+            self._counts[key] = (time.time() + self.ttl, total)
+        return total
+
+    def invalidate(self, layer_id=None):
+        """Drop cached counts for one layer, or all of them"""
+        with self._lock:
+            if layer_id is None:
+                self._counts.clear()
+            else:
+                for key in [key for key in self._counts if key[0] == layer_id]:
+                    del self._counts[key]
+
+    def _evict_expired(self):
+        now = time.time()
+        for key in [key for key, (expires_at, _) in self._counts.items() if expires_at <= now]:
+            del self._counts[key]
+        # Still full: drop the entries closest to expiry
+        overflow = len(self._counts) - COUNT_CACHE_MAX_ENTRIES + 1
+        if overflow > 0:
+            for key in sorted(self._counts, key=lambda key: self._counts[key][0])[:overflow]:
+                del self._counts[key]
@@ -0,0 +1,281 @@
+"""
+Writers for bulk feature exports: NDJSON, CSV and GeoPackage.
+
+A writer is given the exported layers and their attribute columns up
+front, then one feature at a time. begin(), write() and end() return the
+bytes to send next, so NDJSON and CSV exports can be streamed with only
+the current feature in memory. A GeoPackage is an SQLite database and
+cannot be sent before it is complete: GeoPackageWriter fills a temporary
+file on disk and chunks() streams it once end() has been called.
+"""
+
+import csv
+import io
+import json
+import os
+import re
+import sqlite3
+import struct
+import tempfile
+
+import shapely
+from shapely.errors import ShapelyError
+from shapely.geometry import shape
+
+import flatgeobuf
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def _geometry(feature):
+    """Shapely geometry of a GeoJSON feature, or None"""
+    try:
+        geometry = shape(feature["geometry"]) if feature.get("geometry") else None
+    except (ShapelyError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+    return None if geometry is None or geometry.is_empty else geometry
+
+
+def _plain(value):
+    """A property value as a scalar a CSV cell or SQLite column can hold"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+class NDJSONWriter:
+    """One GeoJSON feature per line (a "layer" member is added when exporting several layers)"""
+
+    media_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def __init__(self, layers, crs_by_layer=None):
+        self.multiple = len(layers) > 1
+
+    def begin(self):
+        return b""
+
+    def write(self, layer_id, feature):
+        if self.multiple:
+            feature = {**feature, "layer": layer_id}
+        return json.dumps(feature, separators=(",", ":")).encode("utf-8") + b"\n"
+
+    def end(self):
+        return b""
+
+    def chunks(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class CSVWriter:
+    """One row per feature: layer (several layers only), id, the attribute columns and the geometry as WKT"""
+
+    media_type = "text/csv"
+    extension = "csv"
+
+    def __init__(self, layers, crs_by_layer=None):
+        self.multiple = len(layers) > 1
+        names = []
+        for _, columns in layers:
+            names.extend(name for name, _ in columns if name not in names)
+        self.attributes = names
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def _row(self, values):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(values)
+        return self._buffer.getvalue().encode("utf-8")
+
+    def begin(self):
+        return self._row((["layer"] if self.multiple else []) + ["id"] + self.attributes + ["wkt"])
+
+    def write(self, layer_id, feature):
+        properties = feature.get("properties") or {}
+        geometry = _geometry(feature)
+        values = [layer_id] if self.multiple else []
+        values.append(feature.get("id", ""))
+        values.extend("" if properties.get(name) is None else _plain(properties[name]) for name in self.attributes)
+        values.append(geometry.wkt if geometry is not None else "")
+        return self._row(values)
+
+    def end(self):
+        return b""
+
+    def chunks(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+# GeoPackage 1.3: "GPKG" application id and version 1.3.0
+GPKG_APPLICATION_ID = 0x47504B47
+GPKG_USER_VERSION = 10300
+
+WGS84_DEFINITION = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+    'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+    'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+)
+PSEUDO_MERCATOR_DEFINITION = (
+    'PROJCS["WGS 84 / Pseudo-Mercator",' + WGS84_DEFINITION + ',PROJECTION["Mercator_1SP"],'
+    'PARAMETER["central_meridian",0],PARAMETER["scale_factor",1],PARAMETER["false_easting",0],'
+    'PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["Easting",EAST],'
+    'AXIS["Northing",NORTH],EXTENSION["PROJ4","+proj=merc +a=6378137 +b=6378137 +lat_ts=0 +lon_0=0 +x_0=0 '
+    '+y_0=0 +k=1 +units=m +nadgrids=@null +wktext +no_defs"],AUTHORITY["EPSG","3857"]]'
+)
+
+# gpkg_spatial_ref_sys rows (name, WKT definition) by EPSG code. Without a
+# projection library there is no definition for other codes, and a
+# GeoPackage with an undefined SRS cannot be placed by GIS clients, so
+# exports of layers in other CRSs are refused.
+SRS_DEFINITIONS = {
+    4326: ("WGS 84", WGS84_DEFINITION),
+    3857: ("WGS 84 / Pseudo-Mercator", PSEUDO_MERCATOR_DEFINITION),
+}
+_SRS_ALIASES = {900913: 3857}
+SUPPORTED_SRS = [f"EPSG:{code}" for code in SRS_DEFINITIONS]
+
+_SQL_TYPES = {flatgeobuf.BOOL: "BOOLEAN", flatgeobuf.LONG: "INTEGER", flatgeobuf.DOUBLE: "REAL"}
+
+_GPKG_SCHEMA = """
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY, organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+INSERT INTO gpkg_spatial_ref_sys VALUES
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system');
+"""
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def gpkg_srs_id(crs):
+    """GeoPackage srs_id for a layer's native CRS (EPSG:4326 if unknown), or None if it has no definition"""
+    code = flatgeobuf.crs_code(crs) or 4326
+    code = _SRS_ALIASES.get(code, code)
+    return code if code in SRS_DEFINITIONS else None
+
+
+def gpkg_geometry(geometry, srs_id):
+    """GeoPackage geometry blob: "GP" header (little-endian, XY envelope) followed by WKB"""
+    minx, miny, maxx, maxy = geometry.bounds
+    header = b"GP" + struct.pack("<BBi4d", 0, 0b011, srs_id, minx, maxx, miny, maxy)
+    return header + shapely.to_wkb(geometry, output_dimension=2, byte_order=1)
+
+
+class GeoPackageWriter:
+    """One feature table per layer, written to a temporary file"""
+
+    media_type = "application/geopackage+sqlite3"
+    extension = "gpkg"
+
+    def __init__(self, layers, crs_by_layer=None):
+        self.layers = layers
+        self.crs_by_layer = crs_by_layer or {}
+        handle, self.path = tempfile.mkstemp(suffix=".gpkg", prefix="export-")
+        os.close(handle)
+        self._db = None
+        self._tables = {}  # layer_id -> (table, insert statement, attribute names, srs_id, [bounds])
+
+    def begin(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(f"PRAGMA application_id = {GPKG_APPLICATION_ID}")
+        self._db.execute(f"PRAGMA user_version = {GPKG_USER_VERSION}")
+        self._db.executescript(_GPKG_SCHEMA)
+
+        used_names = set()
+        for layer_id, columns in self.layers:
+            table = re.sub(r"\W", "_", layer_id)
+            while table.lower() in used_names:
+                table += "_"
+            used_names.add(table.lower())
+
+            srs_id = gpkg_srs_id(self.crs_by_layer.get(layer_id))
+            if srs_id is None:
+                raise ValueError(f"No GeoPackage SRS definition for {layer_id} ({self.crs_by_layer.get(layer_id)})")
+            srs_name, definition = SRS_DEFINITIONS[srs_id]
+            self._db.execute("INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, 'EPSG', ?, ?, NULL)",
+                             (srs_name, srs_id, srs_id, definition))
+
+            # Attributes named like the table's own fid and geom columns are left out
+            names = [name for name, _ in columns if name.lower() not in ("fid", "geom")]
+            definitions = ", ".join(f"{_quote(name)} {_SQL_TYPES.get(column_type, 'TEXT')}"
+                                    for name, column_type in columns if name in names)
+            self._db.execute(f"CREATE TABLE {_quote(table)} (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom GEOMETRY"
+                             + (f", {definitions}" if definitions else "") + ")")
+            self._db.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+                             (table, layer_id, srs_id))
+            self._db.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'GEOMETRY', ?, 0, 0)", (table, srs_id))
+            placeholders = ", ".join("?" * (len(names) + 1))
+            insert = f"INSERT INTO {_quote(table)} (geom{''.join(', ' + _quote(name) for name in names)}) VALUES ({placeholders})"
+            self._tables[layer_id] = (table, insert, names, srs_id, [None])
+        return b""
+
+    def write(self, layer_id, feature):
+        table, insert, names, srs_id, bounds = self._tables[layer_id]
+        properties = feature.get("properties") or {}
+        geometry = _geometry(feature)
+        blob = None
+        if geometry is not None:
+            blob = gpkg_geometry(geometry, srs_id)
+            minx, miny, maxx, maxy = geometry.bounds
+            if bounds[0] is None:
+                bounds[0] = [minx, miny, maxx, maxy]
+            else:
+                current = bounds[0]
+                bounds[0] = [min(current[0], minx), min(current[1], miny), max(current[2], maxx), max(current[3], maxy)]
+        self._db.execute(insert, [blob] + [_plain(properties.get(name)) for name in names])
+        return b""
+
+    def end(self):
+        for table, _, _, _, bounds in self._tables.values():
+            if bounds[0] is not None:
+                self._db.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?",
+                                 (*bounds[0], table))
+        self._db.commit()
+        self._db.close()
+        self._db = None
+        return b""
+
+    def chunks(self):
+        with open(self.path, "rb") as gpkg:
+            while True:
+                chunk = gpkg.read(FILE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+WRITERS = {
+    "ndjson": NDJSONWriter,
+    "csv": CSVWriter,
+    "gpkg": GeoPackageWriter
+}
@@ -0,0 +1,164 @@
+"""
+Local feature mirror for rarely-changing layers.
+
+Selected layers are downloaded from WFS at startup and again every
+refresh interval. An STR-tree over the features' bounding boxes is built
+for each layer, so spatial queries against a mirrored layer are answered
+in-process: a bounding-box prefilter through the tree, then exact
+intersection tests. No GeoServer round-trip is needed.
+"""
+
+import threading
+import time
+
+import requests
+from shapely.errors import ShapelyError
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+import geoserver_client
+import spatial_filter
+
+DEFAULT_REFRESH_SECONDS = 3600
+DOWNLOAD_PAGE_SIZE = 1000
+
+
+class LayerSnapshot:
+    """Immutable mirror of one layer: features, their geometries and the tree over them"""
+
+    def __init__(self, layer_id, features, geometries, load_time):
+        self.layer_id = layer_id
+        self.features = features
+        self.geometries = geometries
+        self.tree = STRtree(geometries)
+        self.loaded_at = time.time()
+        self.load_time = load_time
+
+    def query(self, geometry):
+        """Indices of features intersecting geometry, in download order"""
+        return sorted(int(index) for index in self.tree.query(geometry, predicate="intersects"))
+
+
+class FeatureMirror:
+    """Keeps in-memory copies of layers fetched from one WFS endpoint"""
+
+    def __init__(self, wfs_url, layers, refresh_seconds=DEFAULT_REFRESH_SECONDS, sort_key_for=None):
+        self.wfs_url = wfs_url
+        self.layers = list(layers)
+        self.refresh_seconds = refresh_seconds
+        self.sort_key_for = sort_key_for  # optional callable: layer_id -> attribute to page by
+        self._snapshots = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._refresh_event = threading.Event()
+        self._thread = None
+        self.stats = {"queries": 0, "loads": 0, "loadErrors": 0}
+
+    def start(self):
+        """Load all layers in the background, then refresh them on a schedule"""
+        if self._thread is not None or not self.layers:
+            return
+        self._thread = threading.Thread(target=self._run, name="feature-mirror", daemon=True)
+        self._thread.start()
+
+    def has(self, layer_id):
+        """True once layer_id is mirrored and loaded"""
+        return layer_id in self._snapshots
+
+    def refresh_soon(self):
+        """Wake the background thread to reload every mirrored layer now"""
+        self._refresh_event.set()
+
+    def query(self, layer_id, geometry_wkt, limit=None):
+        """
+        Features of a mirrored layer intersecting the WKT geometry, or None if
+        the layer is not mirrored yet or the WKT cannot be parsed (callers
+        then go to GeoServer as usual).
+        """
+        snapshot = self._snapshots.get(layer_id)
+        if snapshot is None:
+            return None
+        try:
+            geometry = spatial_filter.parse_wkt(geometry_wkt)  # cached: the request handler parsed it already
+        except (ShapelyError, ValueError, TypeError) as e:
+            print(f"DEBUG: Mirror could not parse WKT, using GeoServer: {e}")
+            return None
+        matches = snapshot.query(geometry)
+        with self._lock:
+            self.stats["queries"] += 1
+        if limit is not None:
+            matches = matches[:limit]
+        return [snapshot.features[index] for index in matches]
+
+    def load(self, layer_id):
+        """Download layer_id page by page and swap in a new snapshot"""
+        started = time.time()
+        sort_key = self.sort_key_for(layer_id) if self.sort_key_for else None
+        features = []
+        while True:
+            params = {
+                "service": "WFS",
+                "version": "1.0.0",  # Use 1.0.0 as it works better with this GeoServer
+                "request": "GetFeature",
+                "typeName": layer_id,
+                "outputFormat": "application/json",
+                "maxFeatures": str(DOWNLOAD_PAGE_SIZE),
+                "startIndex": str(len(features))
+            }
+            if sort_key:
+                params["sortBy"] = sort_key  # stable order across pages
+            response = geoserver_client.get(self.wfs_url, params=params, operation="wfs_getfeature")
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code} while mirroring {layer_id}")
+            page = response.json().get("features", [])
+            features.extend(page)
+            if len(page) < DOWNLOAD_PAGE_SIZE:
+                break
+
+        # Features without a usable geometry cannot match a spatial query
+        kept = []
+        geometries = []
+        for feature in features:
+            try:
+                geometry = shape(feature["geometry"]) if feature.get("geometry") else None
+            except (ShapelyError, ValueError, TypeError, KeyError):
+                geometry = None
+            if geometry is not None and not geometry.is_empty:
+                kept.append(feature)
+                geometries.append(geometry)
+
+        snapshot = LayerSnapshot(layer_id, kept, geometries, time.time() - started)
+        with self._lock:
+            self._snapshots[layer_id] = snapshot
+            self._errors.pop(layer_id, None)
+            self.stats["loads"] += 1
+        print(f"DEBUG: Mirrored {len(kept)} features of {layer_id} in {snapshot.load_time:.1f}s")
+        return snapshot
+
+    def status(self):
+        """Per-layer mirror state for /api/performance"""
+        layers = {}
+        for layer_id in self.layers:
+            snapshot = self._snapshots.get(layer_id)
+            layers[layer_id] = {
+                "loaded": snapshot is not None,
+                "features": len(snapshot.features) if snapshot else 0,
+                "loadedAt": snapshot.loaded_at if snapshot else None,
+                "loadSeconds": snapshot.load_time if snapshot else None,
+                "error": self._errors.get(layer_id)
+            }
+        return {"layers": layers, "refreshSeconds": self.refresh_seconds, **self.stats}
+
+    def _run(self):
+        while True:
+            for layer_id in self.layers:
+                try:
+                    self.load(layer_id)
+                except (requests.RequestException, ValueError, RuntimeError) as e:
+                    # Keep serving the previous snapshot, if any
+                    print(f"DEBUG: Mirroring {layer_id} failed: {e}")
+                    with self._lock:
+                        self._errors[layer_id] = str(e)
+                        self.stats["loadErrors"] += 1
+            self._refresh_event.wait(self.refresh_seconds)
+            self._refresh_event.clear()
@@ -0,0 +1,334 @@
+"""
+FlatGeobuf encoding of GeoJSON features.
+
+FlatGeobuf is a binary feature format made for streaming: a magic number,
+a header declaring the attribute columns, then each feature as its own
+size-prefixed flatbuffer. A response can therefore be written one feature
+at a time while GeoServer's GeoJSON is still being read, and clients
+(OpenLayers, GDAL, the flatgeobuf libraries) can decode it incrementally
+without a JSON parse.
+
+The flatbuffers are written by hand, front to back, so no flatbuffers
+runtime is needed. Only what a feature stream uses is encoded: no spatial
+index (index_node_size 0), 2D coordinates (Z and M values are dropped) and
+a header geometry type of Unknown, with the type stored on each feature.
+"""
+
+import json
+import re
+import struct
+
+MEDIA_TYPE = "application/flatgeobuf"
+MEDIA_TYPES = (MEDIA_TYPE, "application/x-flatgeobuf")
+FILE_EXTENSION = "fgb"
+
+MAGIC = b"fgb\x03fgb\x00"
+
+# GeometryType
+UNKNOWN = 0
+GEOMETRY_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7
+}
+
+# ColumnType
+BOOL = 2
+LONG = 7
+DOUBLE = 10
+STRING = 11
+JSON = 12
+
+# XSD attribute types from DescribeFeatureType -> column type (anything else is a string)
+XSD_COLUMN_TYPES = {
+    "boolean": BOOL,
+    "byte": LONG, "short": LONG, "int": LONG, "integer": LONG, "long": LONG,
+    "unsignedByte": LONG, "unsignedShort": LONG, "unsignedInt": LONG,
+    "float": DOUBLE, "double": DOUBLE, "decimal": DOUBLE
+}
+
+_EPSG_CODE = re.compile(r"EPSG[:/]+(?:[\d.]*[:/]+)?(\d+)$", re.IGNORECASE)
+
+
+class _Builder:
+    """
+    Front-to-back flatbuffer writer. A table is written as its vtable
+    followed by the table itself; strings, vectors and sub-tables come after
+    it, so every uoffset points forward as the format requires. Alignment
+    is relative to the start of the buffer.
+    """
+
+    def __init__(self):
+        self.buf = bytearray(4)  # root uoffset, patched in finish()
+
+    def finish(self, root_fields):
+        root = self.table(root_fields)
+        struct.pack_into("<I", self.buf, 0, root)
+        return bytes(self.buf)
+
+    def _align(self, alignment, extra=0):
+        """Pad so that position + extra is a multiple of alignment"""
+        self.buf.extend(b"\0" * (-(len(self.buf) + extra) % alignment))
+
+    def table(self, fields):
+        """
+        Write a table. fields is a list indexed by field id of None,
+        (struct format, value) for scalars or (writer, value) for references,
+        where writer(builder, value) writes the referenced object and returns
+        its position. Returns the table's position.
+        """
+        layout = []  # (field id, offset in table, format or writer, value)
+        inline_size = 4  # soffset to the vtable
+        for size in (8, 4, 2, 1):
+            for field_id, field in enumerate(fields):
+                if field is None:
+                    continue
+                kind, value = field
+                field_size = struct.calcsize("<" + kind) if isinstance(kind, str) else 4
+                if field_size == size:
+                    layout.append((field_id, inline_size, kind, value))
+                    inline_size += size
+        table_alignment = 8 if any(isinstance(kind, str) and struct.calcsize("<" + kind) == 8 for _, _, kind, _ in layout) else 4
+
+        vtable = [0] * len(fields)
+        for field_id, offset, _, _ in layout:
+            vtable[field_id] = offset
+        self._align(2)
+        vtable_position = len(self.buf)
+        self.buf.extend(struct.pack(f"<HH{len(vtable)}H", 4 + 2 * len(vtable), inline_size, *vtable))
+
+        self._align(table_alignment)
+        table_position = len(self.buf)
+        self.buf.extend(struct.pack("<i", table_position - vtable_position))
+        references = []
+        for field_id, offset, kind, value in layout:
+            if isinstance(kind, str):
+                self.buf.extend(struct.pack("<" + kind, value))
+            else:
+                references.append((table_position + offset, kind, value))
+                self.buf.extend(b"\0\0\0\0")
+
+        for field_position, writer, value in references:
+            self._patch(field_position, writer(self, value))
+        return table_position
+
+    def _patch(self, field_position, target):
+        struct.pack_into("<I", self.buf, field_position, target - field_position)
+
+    def string(self, value):
+        data = value.encode("utf-8")
+        self._align(4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack("<I", len(data)) + data + b"\0")
+        return position
+
+    def bytes_vector(self, data):
+        self._align(4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack("<I", len(data)) + data)
+        return position
+
+    def vector(self, kind, values):
+        """Vector of scalars; the elements are aligned to their size"""
+        size = struct.calcsize("<" + kind)
+        self._align(max(4, size), 4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack(f"<I{len(values)}{kind}", len(values), *values))
+        return position
+
+    def table_vector(self, tables):
+        """Vector of tables, each given as a fields list for table()"""
+        self._align(4)
+        position = len(self.buf)
+        self.buf.extend(struct.pack("<I", len(tables)) + b"\0\0\0\0" * len(tables))
+        for index, fields in enumerate(tables):
+            self._patch(position + 4 + 4 * index, self.table(fields))
+        return position
+
+
+def _string(builder, value):
+    return builder.string(value)
+
+
+def _doubles(builder, values):
+    return builder.vector("d", values)
+
+
+def _uints(builder, values):
+    return builder.vector("I", values)
+
+
+def _bytes(builder, data):
+    return builder.bytes_vector(data)
+
+
+def _table(builder, fields):
+    return builder.table(fields)
+
+
+def _tables(builder, tables):
+    return builder.table_vector(tables)
+
+
+def crs_code(crs):
+    """EPSG code from "EPSG:4326", "urn:x-ogc:def:crs:EPSG:4326" or an EPSG URL, else None"""
+    match = _EPSG_CODE.search((crs or "").strip())
+    return int(match.group(1)) if match else None
+
+
+def columns_from_schema(attributes):
+    """[(name, column type)] from a layer schema's {attribute: XSD type}"""
+    return [(name, XSD_COLUMN_TYPES.get(xsd_type, STRING)) for name, xsd_type in attributes.items()]
+
+
+def columns_from_properties(properties):
+    """[(name, column type)] guessed from one feature's property values"""
+    columns = []
+    for name, value in properties.items():
+        if isinstance(value, bool):
+            column_type = BOOL
+        elif isinstance(value, int):
+            column_type = LONG
+        elif isinstance(value, float):
+            column_type = DOUBLE
+        elif isinstance(value, str) or value is None:
+            column_type = STRING
+        else:
+            column_type = JSON
+        columns.append((name, column_type))
+    return columns
+
+
+def encode_header(columns, name=None, crs=None, features_count=0, metadata=None):
+    """
+    Magic number and size-prefixed header. features_count 0 means unknown;
+    metadata is any JSON-serializable value, stored as a JSON string.
+    """
+    column_tables = [[(_string, column_name), ("B", column_type)] for column_name, column_type in columns]
+    code = crs_code(crs)
+    fields = [
+        (_string, name) if name else None,                                 # name
+        None,                                                              # envelope
+        ("B", UNKNOWN),                                                    # geometry_type
+        None, None, None, None,                                            # has_z, has_m, has_t, has_tm
+        (_tables, column_tables) if column_tables else None,               # columns
+        ("Q", features_count) if features_count else None,                 # features_count
+        ("H", 0),                                                          # index_node_size: no index
+        (_table, [(_string, "EPSG"), ("i", code)]) if code else None,      # crs
+        None, None,                                                        # title, description
+        (_string, json.dumps(metadata)) if metadata is not None else None  # metadata
+    ]
+    header = _Builder().finish(fields)
+    return MAGIC + struct.pack("<I", len(header)) + header
+
+
+def _xy(points):
+    flat = []
+    for point in points:
+        flat.extend((float(point[0]), float(point[1])))
+    return flat
+
+
+def _rings(rings):
+    """xy and ends (vertex counts, cumulative) for a list of rings or lines"""
+    xy = []
+    ends = []
+    for ring in rings:
+        xy.extend(_xy(ring))
+        ends.append(len(xy) // 2)
+    return xy, ends
+
+
+def _geometry_fields(geometry):
+    """Fields list of a FlatGeobuf Geometry table, or None for an empty or unknown geometry"""
+    geometry_type = GEOMETRY_TYPES.get(geometry.get("type"))
+    if geometry_type is None:
+        return None
+    fields = [None] * 8  # ends, xy, z, m, t, tm, type, parts
+    fields[6] = ("B", geometry_type)
+
+    if geometry_type == GEOMETRY_TYPES["GeometryCollection"]:
+        parts = [_geometry_fields(part) for part in geometry.get("geometries") or []]
+        parts = [part for part in parts if part is not None]
+        if not parts:
+            return None
+        fields[7] = (_tables, parts)
+        return fields
+
+    coordinates = geometry.get("coordinates")
+    if not coordinates:
+        return None
+    if geometry_type == GEOMETRY_TYPES["MultiPolygon"]:
+        parts = [_geometry_fields({"type": "Polygon", "coordinates": polygon}) for polygon in coordinates]
+        fields[7] = (_tables, [part for part in parts if part is not None])
+        return fields
+
+    if geometry_type == GEOMETRY_TYPES["Point"]:
+        xy, ends = _xy([coordinates]), None
+    elif geometry_type in (GEOMETRY_TYPES["LineString"], GEOMETRY_TYPES["MultiPoint"]):
+        xy, ends = _xy(coordinates), None
+    else:  # Polygon, MultiLineString
+        xy, ends = _rings(coordinates)
+        if len(ends) == 1:
+            ends = None  # a single part needs no ends
+    fields[1] = (_doubles, xy)
+    if ends:
+        fields[0] = (_uints, ends)
+    return fields
+
+
+def _encode_value(column_type, value):
+    """Property value bytes for a column type, or None when the value does not fit it"""
+    try:
+        if column_type == BOOL:
+            if isinstance(value, str):
+                if value.lower() not in ("true", "false"):
+                    return None
+                value = value.lower() == "true"
+            return struct.pack("<B", bool(value))
+        if column_type == LONG:
+            if isinstance(value, float) and not value.is_integer():
+                return None
+            return struct.pack("<q", int(value))
+        if column_type == DOUBLE:
+            return struct.pack("<d", float(value))
+        if column_type == JSON or not isinstance(value, str):
+            value = json.dumps(value)
+    except (TypeError, ValueError, OverflowError, struct.error):
+        return None
+    data = value.encode("utf-8")
+    return struct.pack("<I", len(data)) + data
+
+
+class FeatureEncoder:
+    """Encodes features for one header's columns"""
+
+    def __init__(self, columns):
+        self.columns = {name: (index, column_type) for index, (name, column_type) in enumerate(columns)}
+
+    def encode(self, feature, extra_properties=None):
+        """Size-prefixed Feature flatbuffer for a GeoJSON feature dict"""
+        properties = dict(feature.get("properties") or {})
+        if extra_properties:
+            properties.update(extra_properties)
+
+        encoded = bytearray()
+        for name, value in properties.items():
+            column = self.columns.get(name)
+            if column is None or value is None:
+                continue  # properties outside the header's columns cannot be written
+            data = _encode_value(column[1], value)
+            if data is not None:
+                encoded.extend(struct.pack("<H", column[0]) + data)
+
+        geometry = _geometry_fields(feature.get("geometry") or {})
+        fields = [
+            (_table, geometry) if geometry else None,
+            (_bytes, bytes(encoded)) if encoded else None
+        ]
+        buffer = _Builder().finish(fields)
+        return struct.pack("<I", len(buffer)) + buffer
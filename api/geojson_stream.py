@@ -0,0 +1,157 @@
+"""
+Incremental splitting of GeoServer GeoJSON FeatureCollections.
+
+FeatureStream reads a FeatureCollection body chunk by chunk and yields
+each feature's raw JSON bytes without decoding them. Features can then be
+copied through to the client, or decoded one at a time, while only one
+feature is held in memory. The small members around the "features" array
+(totalFeatures, numberMatched, crs, ...) are available from metadata()
+after iteration.
+"""
+
+import json
+import re
+
+# Start of the features array in GeoServer's output ({"type":"FeatureCollection","features":[...)
+_FEATURES_START = re.compile(rb'"features"\s*:\s*\[')
+# Inside a string only quotes and backslashes matter
+_STRING_SPECIAL = re.compile(rb'["\\]')
+# Inside a feature (outside strings) only braces and quotes matter; brackets in
+# coordinate arrays are skipped over by the regex, which is what keeps this fast
+_FEATURE_SPECIAL = re.compile(rb'["{}]')
+# Between features: the next feature, or the end of the array
+_BETWEEN_FEATURES = re.compile(rb'[{\]]')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class GeoJSONStreamError(ValueError):
+    """The streamed body is not a GeoJSON FeatureCollection"""
+
+
+def iter_chunks(content, chunk_size=CHUNK_SIZE):
+    """Split an in-memory body into chunks, e.g. for responses served from a cache"""
+    for offset in range(0, len(content), chunk_size):
+        yield content[offset:offset + chunk_size]
+
+
+class FeatureStream:
+    """Iterate over the raw features of a streamed FeatureCollection"""
+
+    def __init__(self, chunks, max_header_bytes=1024 * 1024):
+        self._chunks = iter(chunks)
+        self._max_header_bytes = max_header_bytes
+        self.header = b""
+        self.trailer = b""
+        self.count = 0
+        self.bytes_read = 0
+
+    def __iter__(self):
+        buffer = self._read_header()
+        position = 0
+        parts = []  # pieces of the current feature that spans several chunks
+        depth = 0
+        in_string = False
+        escaped = False
+        feature_start = None
+
+        while True:
+            if position >= len(buffer):
+                if feature_start is not None:
+                    parts.append(buffer[feature_start:])
+                    feature_start = 0
+                buffer = self._next_chunk()
+                position = 0
+                if buffer is None:
+                    raise GeoJSONStreamError("FeatureCollection ended inside the features array")
+                continue
+
+            if escaped:
+                # The byte after a backslash at the end of the previous chunk
+                escaped = False
+                position += 1
+                continue
+
+            if in_string:
+                match = _STRING_SPECIAL.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    continue
+                position = match.end()
+                if match.group() == b"\\":
+                    if position >= len(buffer):
+                        escaped = True
+                    else:
+                        position += 1
+                else:
+                    in_string = False
+                continue
+
+            if depth == 0:
+                match = _BETWEEN_FEATURES.search(buffer, position)
+                if match is None:
+                    position = len(buffer)
+                    continue
+                if match.group() == b"]":
+                    self.trailer = self._read_trailer(buffer[match.end():])
+                    return
+                feature_start = match.start()
+                parts = []
+                depth = 1
+                position = match.end()
+                continue
+
+            match = _FEATURE_SPECIAL.search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                continue
+            position = match.end()
+            token = match.group()
+            if token == b'"':
+                in_string = True
+            elif token == b"{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    parts.append(buffer[feature_start:position])
+                    feature_start = None
+                    self.count += 1
+                    yield b"".join(parts)
+                    parts = []
+
+    def metadata(self):
+        """The collection's members other than "features" (available after iteration)"""
+        try:
+            return json.loads(self.header + b"]" + self.trailer)
+        except ValueError:
+            return {}
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            if chunk:
+                self.bytes_read += len(chunk)
+                return chunk
+        return None
+
+    def _read_header(self):
+        head = b""
+        while True:
+            match = _FEATURES_START.search(head)
+            if match:
+                self.header = head[:match.end()]
+                return head[match.end():]
+            if len(head) > self._max_header_bytes:
+                raise GeoJSONStreamError("No features array found in response")
+            chunk = self._next_chunk()
+            if chunk is None:
+                raise GeoJSONStreamError("No features array found in response")
+            head += chunk
+
+    def _read_trailer(self, rest):
+        pieces = [rest]
+        chunk = self._next_chunk()
+        while chunk is not None:
+            pieces.append(chunk)
+            chunk = self._next_chunk()
+        return b"".join(pieces)
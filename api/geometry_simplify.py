@@ -0,0 +1,126 @@
+"""
+Geometry simplification and coordinate rounding for feature responses.
+
+Clients that show a layer zoomed out do not need every vertex of a
+boundary, nor coordinates at full float precision. A feature's geometry
+can be simplified with topology-preserving Douglas-Peucker (shapely's
+simplify with preserve_topology=True: rings never self-intersect or
+collapse) and its coordinates rounded to a number of decimals. Features are
+copied, never changed in place, because they may come from the layer
+mirror or a cache.
+
+Simplification is per feature: borders shared by neighbouring polygons
+are simplified independently and may no longer match exactly.
+"""
+
+import json
+import math
+
+import shapely
+from shapely.errors import ShapelyError
+from shapely.geometry import mapping, shape
+
+TILE_SIZE = 256
+MAX_ZOOM = 24
+MAX_PRECISION = 15
+PIXEL_FRACTION = 0.5  # tolerance for a zoom level, in screen pixels
+
+
+def tolerance_for_zoom(zoom, geographic=True):
+    """
+    Simplification tolerance (in layer units) that is invisible at a web-map
+    zoom level: half a pixel, in degrees for EPSG:4326 or metres for EPSG:3857.
+    """
+    world = 360.0 if geographic else 40075016.68557849
+    return world / (TILE_SIZE * 2 ** zoom) * PIXEL_FRACTION
+
+
+def precision_for_tolerance(tolerance):
+    """Decimals that keep rounding error well below the tolerance"""
+    if tolerance <= 0:
+        return MAX_PRECISION
+    return max(0, min(MAX_PRECISION, int(math.ceil(-math.log10(tolerance))) + 1))
+
+
+def parse_options(args, geographic=True):
+    """
+    (tolerance, precision) from request parameters "tolerance", "zoom" and
+    "precision" (a dict or request.args), or None when none were given.
+    A zoom sets the tolerance, in the units of a layer that is geographic or
+    not; a tolerance without a precision sets one too.
+    Raises ValueError for invalid values.
+    """
+    tolerance = args.get("tolerance")
+    zoom = args.get("zoom")
+    precision = args.get("precision")
+    if tolerance in (None, "") and zoom in (None, "") and precision in (None, ""):
+        return None
+
+    if tolerance not in (None, ""):
+        tolerance = float(tolerance)
+        if tolerance < 0 or not math.isfinite(tolerance):
+            raise ValueError("tolerance must be a non-negative number")
+    elif zoom not in (None, ""):
+        zoom = float(zoom)
+        if not 0 <= zoom <= MAX_ZOOM:
+            raise ValueError(f"zoom must be between 0 and {MAX_ZOOM}")
+        tolerance = tolerance_for_zoom(zoom, geographic)
+    else:
+        tolerance = 0.0
+
+    if precision not in (None, ""):
+        precision = int(precision)
+        if not 0 <= precision <= MAX_PRECISION:
+            raise ValueError(f"precision must be between 0 and {MAX_PRECISION}")
+    elif tolerance > 0:
+        precision = precision_for_tolerance(tolerance)
+    else:
+        precision = None
+    return tolerance, precision
+
+
+def _round_coordinates(coordinates, precision):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    return [_round_coordinates(part, precision) for part in coordinates]
+
+
+def _round_geometry(geometry, precision):
+    if geometry.get("type") == "GeometryCollection":
+        return {**geometry, "geometries": [_round_geometry(part, precision) for part in geometry.get("geometries", [])]}
+    coordinates = geometry.get("coordinates")
+    if not coordinates:
+        return geometry
+    return {**geometry, "coordinates": _round_coordinates(coordinates, precision)}
+
+
+def simplify_features(features, tolerance, precision=None):
+    """Copies of features with simplified geometries and rounded coordinates"""
+    if not features:
+        return features
+
+    geometries = [feature.get("geometry") for feature in features]
+    if tolerance > 0:
+        shapes = []
+        for geometry in geometries:
+            try:
+                shapes.append(shape(geometry) if geometry else None)
+            except (ShapelyError, ValueError, TypeError, KeyError, AttributeError):
+                shapes.append(None)  # leave geometries shapely cannot read as they are
+        simplified = shapely.simplify([item for item in shapes if item is not None], tolerance, preserve_topology=True)
+        simplified = iter(simplified)
+        geometries = [mapping(next(simplified)) if item is not None else geometry
+                      for item, geometry in zip(shapes, geometries)]
+
+    result = []
+    for feature, geometry in zip(features, geometries):
+        if geometry and precision is not None:
+            geometry = _round_geometry(geometry, precision)
+        result.append({**feature, "geometry": geometry})
+    return result
+
+
+def simplify_raw_feature(raw_feature, tolerance, precision=None):
+    """The same for one JSON-encoded feature of a streamed response (bytes in, bytes out)"""
+    feature = simplify_features([json.loads(raw_feature)], tolerance, precision)[0]
+    return json.dumps(feature, separators=(",", ":")).encode("utf-8")
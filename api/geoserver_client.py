@@ -0,0 +1,441 @@
+"""
+Shared HTTP client for all GeoServer calls made by app.py and queries.py.
+
+Every WFS/WMS request goes through one requests.Session so TCP connections
+to GeoServer are kept alive and reused instead of being opened per call.
+Each call is timed (connect, time to first byte, total) and its byte count
+recorded per operation so the numbers can be exposed by /api/performance,
+and added to the timings of the API request that made the call.
+
+Each operation has a circuit breaker (see circuit_breaker.py) that fails
+calls fast while GeoServer keeps failing. A call that is still waiting
+for GeoServer's answer after the operation's observed p95 time to first
+byte is hedged: a duplicate request is sent, and whichever answers first
+is used. Only reads are made here, so duplicates are safe.
+
+Timeouts are cut to what is left of the API request's deadline budget
+(see request_deadline.py).
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import request_deadline
+import request_metrics
+from circuit_breaker import STATE_VALUES, CircuitBreaker
+
+# Keep-alive pool size per GeoServer host ("host:port"), i.e. how many idle
+# connections we keep open to it. Hosts not listed use DEFAULT_POOL_SIZE.
+POOL_SIZES = {
+    "20.20.152.180:8181": 32,
+}
+DEFAULT_POOL_SIZE = 10
+# Overrides the sizes above for every host, e.g. for async workers with many concurrent calls
+POOL_SIZE_OVERRIDE = int(os.environ.get("GEOSERVER_POOL_SIZE", "0"))
+
+# (connect, read) timeouts in seconds per upstream operation
+TIMEOUTS = {
+    "wfs_getfeature": (5, 30),
+    "wfs_hits": (5, 30),
+    "wfs_describe": (5, 10),
+    "wms_getmap": (5, 30),
+    "wms_capabilities": (5, 10),
+    "default": (5, 30),
+}
+
+# Retries for transient failures (connection errors and the statuses below).
+# Read timeouts are not retried - GeoServer already spent the full timeout.
+RETRIES = {
+    "wfs_getfeature": 2,
+    "wfs_hits": 2,
+    "wfs_describe": 2,
+    "wms_getmap": 1,
+    "wms_capabilities": 1,
+    "default": 1,
+}
+RETRY_BACKOFF = 0.25  # seconds, doubled after each attempt
+RETRY_BACKOFF_MAX = 2.0
+RETRY_STATUSES = (502, 503, 504)
+
+# Hedged requests for these operations once HEDGE_MIN_SAMPLES calls were timed.
+# Hedges are limited to HEDGE_MAX_RATIO of an operation's calls, so a GeoServer
+# that is slow for everyone does not get twice the load.
+HEDGED_OPERATIONS = {"wfs_getfeature", "wfs_hits", "wfs_describe", "wms_getmap", "wms_capabilities"}
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05  # Seconds
+HEDGE_MAX_RATIO = 0.1
+HEDGE_WORKERS = int(os.environ.get("GEOSERVER_HEDGE_WORKERS", "64"))  # Threads running hedgeable calls
+LATENCY_WINDOW = 200  # Recent times to first byte per operation the p95 is taken over
+
+_session = requests.Session()
+_mounted_hosts = set()
+_mount_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_breakers = {}
+_latencies = {}  # operation -> recent times to first byte (ms) of answered calls
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="geoserver-hedge")
+# Idle hedge threads; a call is only handed to the executor when one is free,
+# so it never waits in the executor's queue
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+# Per-thread accumulator the connection classes below write into while a
+# request is in flight (urllib3 connects on the thread sending it).
+_call_state = threading.local()
+
+
+class _TimedConnectMixin:
+    """Records how long establishing a new connection (TCP + TLS) took"""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            state = getattr(_call_state, "current", None)
+            if state is not None:
+                state["new_connections"] += 1
+                state["connect_ms"] += (time.perf_counter() - started) * 1000
+
+
+class _TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools create timed connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+def _reset_after_fork():
+    """
+    Give a forked worker process its own session and counters. Sockets
+    opened before the fork (e.g. by a preloading server's master) must not
+    be shared between processes.
+    """
+    global _session, _mount_lock, _stats_lock, _hedge_executor, _hedge_slots
+    _session = requests.Session()
+    _mounted_hosts.clear()
+    _mount_lock = threading.Lock()
+    _stats.clear()
+    _stats_lock = threading.Lock()
+    _breakers.clear()
+    _latencies.clear()
+    _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="geoserver-hedge")
+    _hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _ensure_adapter(url):
+    """Mount a keep-alive adapter sized for the url's host on first use"""
+    parts = urlsplit(url)
+    if parts.netloc in _mounted_hosts:
+        return
+    with _mount_lock:
+        if parts.netloc in _mounted_hosts:
+            return
+        pool_size = POOL_SIZE_OVERRIDE or POOL_SIZES.get(parts.netloc, DEFAULT_POOL_SIZE)
+        adapter = _InstrumentedAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        _session.mount(f"{parts.scheme}://{parts.netloc}/", adapter)
+        _mounted_hosts.add(parts.netloc)
+
+
+def _breaker(operation):
+    breaker = _breakers.get(operation)
+    if breaker is None:
+        with _stats_lock:
+            breaker = _breakers.setdefault(operation, CircuitBreaker(operation))
+    return breaker
+
+
+def _record(operation, call):
+    with _stats_lock:
+        stats = _stats.setdefault(operation, {
+            "calls": 0,
+            "errors": 0,
+            "retries": 0,
+            "new_connections": 0,
+            "connect_ms": 0.0,
+            "ttfb_ms": 0.0,
+            "total_ms": 0.0,
+            "bytes": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+        })
+        stats["calls"] += 1
+        for key in ("errors", "retries", "new_connections", "connect_ms", "ttfb_ms", "total_ms", "bytes",
+                    "hedged", "hedge_wins"):
+            stats[key] += call[key]
+
+
+def _record_latency(operation, ttfb_ms):
+    with _stats_lock:
+        _latencies.setdefault(operation, deque(maxlen=LATENCY_WINDOW)).append(ttfb_ms)
+
+
+def _hedge_delay(operation):
+    """Seconds to wait before hedging a call of operation, or None if it is not hedged"""
+    if operation not in HEDGED_OPERATIONS:
+        return None
+    with _stats_lock:
+        samples = list(_latencies.get(operation, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY, request_metrics.percentile(samples, HEDGE_PERCENTILE) / 1000)
+
+
+def latency_p95(operation):
+    """Seconds to first byte that 95% of recent answered calls of operation stayed under, or None"""
+    with _stats_lock:
+        samples = list(_latencies.get(operation, ()))
+    return request_metrics.percentile(samples, 95) / 1000 if samples else None
+
+
+def _hedge_allowed(operation):
+    with _stats_lock:
+        stats = _stats.get(operation)
+        return stats is not None and stats["hedged"] < HEDGE_MAX_RATIO * stats["calls"]
+
+
+def _send(url, params, timeout, kwargs):
+    """
+    One GET through the session, returned as soon as the headers are in
+    (the body is read by the caller). Returns (response, attempt), where
+    attempt holds this request's own new connections and time to headers;
+    hedged requests run concurrently, so each one gets its own.
+    """
+    attempt = {"new_connections": 0, "connect_ms": 0.0}
+    _call_state.current = attempt
+    started = time.perf_counter()
+    try:
+        response = _session.get(url, params=params, timeout=timeout, stream=True, **kwargs)
+    finally:
+        _call_state.current = None
+    attempt["headers_at"] = time.perf_counter()
+    attempt["ttfb_ms"] = (attempt["headers_at"] - started) * 1000
+    return response, attempt
+
+
+def _submit(url, params, timeout, kwargs):
+    """_send() on an idle hedge thread, or None when all of them are busy"""
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    try:
+        future = _hedge_executor.submit(_send, url, params, timeout, kwargs)
+    except BaseException:
+        _hedge_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def _discard(future):
+    """Close the response of the request that lost a hedge"""
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+
+
+def _hedged_get(operation, url, params, timeout, kwargs, call):
+    """
+    GET url, sending a duplicate request if no answer has arrived after
+    the operation's hedge delay. Returns _send()'s (response, attempt) of
+    the first answer; raises the first request's exception if both fail.
+    While every hedge thread is busy, the call is sent on the caller's
+    thread without a hedge rather than waiting for one.
+    """
+    delay = _hedge_delay(operation)
+    primary = None if delay is None else _submit(url, params, timeout, kwargs)
+    if primary is None:
+        return _send(url, params, timeout, kwargs)
+    done, _ = wait([primary], timeout=delay)
+    if done or not _hedge_allowed(operation):
+        return primary.result()
+    hedge = _submit(url, params, timeout, kwargs)
+    if hedge is None:
+        return primary.result()
+
+    call["hedged"] = 1
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in (primary, hedge) if future in done and future.exception() is None), None)
+        if winner is not None:
+            for future in (primary, hedge):
+                if future is not winner:
+                    future.add_done_callback(_discard)
+            call["hedge_wins"] = int(winner is hedge)
+            return winner.result()
+    return primary.result()  # Both failed
+
+
+def get(url, params=None, operation="default", timeout=None, stream=False, **kwargs):
+    """
+    GET a GeoServer URL through the shared keep-alive session.
+
+    operation selects the timeout and retry settings ("wfs_getfeature",
+    "wfs_hits", "wms_getmap", ...) and the bucket the call is counted in.
+    timeout overrides the configured timeout for this call only; either is
+    shortened to the time left before the request's deadline. With
+    stream=True the body is not read here; read it with iter_content() so
+    its bytes are still counted. Raises the same requests exceptions as
+    requests.get once retries are exhausted, DeadlineExceeded when the
+    request's deadline has passed and CircuitOpenError while the
+    operation's breaker is open.
+    """
+    if timeout is None:
+        timeout = TIMEOUTS.get(operation, TIMEOUTS["default"])
+    request_deadline.shorten(timeout)  # Raises DeadlineExceeded before the breaker is involved
+    breaker = _breaker(operation)
+    breaker.before_call()  # Raises CircuitOpenError while GeoServer is failing
+    _ensure_adapter(url)
+    max_retries = RETRIES.get(operation, RETRIES["default"])
+
+    call = {
+        "errors": 0,
+        "retries": 0,
+        "new_connections": 0,
+        "connect_ms": 0.0,
+        "ttfb_ms": 0.0,
+        "total_ms": 0.0,
+        "bytes": 0,
+        "hedged": 0,
+        "hedge_wins": 0,
+    }
+    started = time.perf_counter()
+    attempt = 0
+    # What the call says about GeoServer's health: "failure", "success", or None when
+    # it ran out of the client's deadline budget (no signal either way)
+    outcome = "failure"
+    try:
+        while True:
+            try:
+                attempt_timeout = request_deadline.shorten(timeout)
+            except request_deadline.DeadlineExceeded:
+                outcome = None
+                raise
+            try:
+                response, sent = _hedged_get(operation, url, params, attempt_timeout, kwargs, call)
+                call["new_connections"] += sent["new_connections"]
+                call["connect_ms"] += sent["connect_ms"]
+                call["ttfb_ms"] = (sent["headers_at"] - started) * 1000
+                if response.status_code in RETRY_STATUSES and attempt < max_retries:
+                    response.close()
+                else:
+                    if stream:
+                        response.geoserver_operation = operation
+                    else:
+                        # Read the body here so byte counts and total time are exact
+                        call["bytes"] = len(response.content)
+                    if response.status_code >= 400:
+                        call["errors"] = 1
+                    outcome = "failure" if response.status_code >= 500 else "success"
+                    if outcome == "success":
+                        _record_latency(operation, sent["ttfb_ms"])
+                    return response
+            except requests.ReadTimeout:
+                call["errors"] = 1
+                # Running out of the client's budget says nothing about GeoServer's health
+                outcome = "failure" if attempt_timeout == timeout else None
+                raise
+            except (requests.ConnectionError, requests.ConnectTimeout):
+                if attempt >= max_retries:
+                    call["errors"] = 1
+                    raise
+            except requests.RequestException:
+                call["errors"] = 1
+                raise
+
+            attempt += 1
+            call["retries"] = attempt
+            backoff = min(RETRY_BACKOFF * (2 ** (attempt - 1)), RETRY_BACKOFF_MAX)
+            left = request_deadline.remaining()
+            time.sleep(backoff if left is None else max(0, min(backoff, left)))
+    finally:
+        if outcome == "failure":
+            breaker.record_failure()
+        elif outcome == "success":
+            breaker.record_success()
+        else:
+            breaker.record_no_signal()
+        call["total_ms"] = (time.perf_counter() - started) * 1000
+        _record(operation, call)
+        request_metrics.record_upstream(call["total_ms"], call["bytes"])
+        print(f"DEBUG: GeoServer {operation} - connect {call['connect_ms']:.1f}ms "
+              f"({call['new_connections']} new), ttfb {call['ttfb_ms']:.1f}ms, "
+              f"total {call['total_ms']:.1f}ms, {call['bytes']} bytes, {call['retries']} retries"
+              + (f", hedged ({'hedge' if call['hedge_wins'] else 'first request'} won)" if call["hedged"] else ""))
+
+
+def iter_content(response, chunk_size=64 * 1024):
+    """Yield the body of a stream=True response in chunks, counting its bytes"""
+    operation = getattr(response, "geoserver_operation", "default")
+    received = 0
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            received += len(chunk)
+            yield chunk
+    finally:
+        response.close()
+        with _stats_lock:
+            if operation in _stats:
+                _stats[operation]["bytes"] += received
+        request_metrics.record_upstream_bytes(received)
+
+
+def get_stats():
+    """Return per-operation call counters with averages"""
+    with _stats_lock:
+        snapshot = {operation: dict(stats) for operation, stats in _stats.items()}
+    for stats in snapshot.values():
+        calls = stats["calls"] or 1
+        stats["avg_ttfb_ms"] = stats["ttfb_ms"] / calls
+        stats["avg_total_ms"] = stats["total_ms"] / calls
+        stats["avg_bytes"] = stats["bytes"] / calls
+    return snapshot
+
+
+def breaker_status():
+    """Circuit breaker state per operation"""
+    status = {operation: breaker.status() for operation, breaker in list(_breakers.items())}
+    for breaker in status.values():
+        breaker["stateValue"] = STATE_VALUES[breaker["state"]]
+    return status
+
+
+def reset_stats():
+    """Clear all recorded counters"""
+    with _stats_lock:
+        _stats.clear()
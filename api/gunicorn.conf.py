@@ -0,0 +1,19 @@
+"""
+gunicorn hooks for start_servers.py --production. Worker counts, threads,
+worker class, timeouts and preloading are passed on the command line.
+"""
+
+import os
+
+if os.environ.get("API_WORKER_CLASS") == "gevent":
+    # Patch sockets, threads and locks before anything (including a preloaded
+    # app) imports them, so GeoServer calls yield to other requests
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_fork(server, worker):
+    """With --preload the app was imported in the master; start its background threads in each worker"""
+    if os.environ.get("API_START_BACKGROUND", "true").lower() == "false":
+        import app
+        app.start_background_tasks()
@@ -0,0 +1,186 @@
+"""
+Layer schema registry.
+
+Runs WFS DescribeFeatureType once per layer and caches what the query
+builders need: the geometry field name, attribute types and the layer's
+native CRS. Entries are refreshed after SCHEMA_TTL seconds, so requests
+never have to probe ["geom", "the_geom", "geometry"] one after another.
+"""
+
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+
+import geoserver_client
+import request_deadline
+
+SCHEMA_TTL = 3600  # Seconds before a layer schema is fetched again
+FAILED_SCHEMA_TTL = 60  # Seconds before retrying a layer whose schema could not be fetched
+
+# Field names probed when a layer's schema is not available
+FALLBACK_GEOMETRY_FIELDS = ["geom", "the_geom", "geometry"]
+
+XSD_NS = "{http://www.w3.org/2001/XMLSchema}"
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def parse_feature_type(xml_content):
+    """
+    Parse a DescribeFeatureType XSD into geometry field, geometry type and
+    attribute types. Geometry properties are the elements typed gml:*.
+    """
+    root = ET.fromstring(xml_content)
+    geometry_field = None
+    geometry_type = None
+    attributes = {}
+
+    for element in root.iter(f"{XSD_NS}element"):
+        name = element.get("name")
+        type_name = element.get("type", "")
+        if not name or element.get("substitutionGroup"):
+            continue  # top-level feature element, not a property
+        prefix, _, local_type = type_name.rpartition(":")
+        if prefix == "gml":
+            if geometry_field is None:
+                geometry_field = name
+                geometry_type = local_type.replace("PropertyType", "")
+        else:
+            attributes[name] = local_type or type_name
+
+    return {
+        "geometryField": geometry_field,
+        "geometryType": geometry_type,
+        "attributes": attributes
+    }
+
+
+def parse_native_crs(xml_content):
+    """Map of feature type name -> default SRS from a WFS GetCapabilities document"""
+    root = ET.fromstring(xml_content)
+    crs_by_layer = {}
+    for feature_type in root.iter():
+        if _local_name(feature_type.tag) != "FeatureType":
+            continue
+        name = srs = None
+        for child in feature_type:
+            child_name = _local_name(child.tag)
+            if child_name == "Name":
+                name = (child.text or "").strip()
+            elif child_name in ("DefaultSRS", "DefaultCRS", "SRS") and srs is None:
+                srs = (child.text or "").strip()
+        if name:
+            crs_by_layer[name] = srs
+    return crs_by_layer
+
+
+class LayerSchemaRegistry:
+    """Thread-safe, TTL-refreshed cache of layer schemas for one WFS endpoint"""
+
+    def __init__(self, wfs_url, ttl=SCHEMA_TTL):
+        self.wfs_url = wfs_url
+        self.ttl = ttl
+        self._schemas = {}  # layer_id -> (expires_at, schema or None)
+        self._crs = (0, {})  # (expires_at, {layer name: srs})
+        self._lock = threading.Lock()
+        self._layer_locks = {}
+
+    def get(self, layer_id):
+        """Cached schema for layer_id, fetching it if missing or expired. None if unavailable."""
+        entry = self._schemas.get(layer_id)
+        if entry and entry[0] > time.time():
+            return entry[1]
+
+        with self._lock:
+            layer_lock = self._layer_locks.setdefault(layer_id, threading.Lock())
+        with layer_lock:
+            # Another request may have refreshed it while we waited
+            entry = self._schemas.get(layer_id)
+            if entry and entry[0] > time.time():
+                return entry[1]
+            schema = self._fetch(layer_id)
+            if schema is None and request_deadline.expired():
+                return None  # The request ran out of time; that is no reason to stop asking for a minute
+            ttl = self.ttl if schema else FAILED_SCHEMA_TTL
+            self._schemas[layer_id] = (time.time() + ttl, schema)
+            return schema
+
+    def geometry_field(self, layer_id):
+        """Geometry field name for layer_id, or None if the schema is unavailable"""
+        schema = self.get(layer_id)
+        return schema["geometryField"] if schema else None
+
+    def geometry_field_candidates(self, layer_id):
+        """Field names a query should use: the known field, or the fallback list"""
+        field_name = self.geometry_field(layer_id)
+        return [field_name] if field_name else list(FALLBACK_GEOMETRY_FIELDS)
+
+    def remember_geometry_field(self, layer_id, field_name):
+        """Record a geometry field found by probing when DescribeFeatureType was unavailable"""
+        with self._lock:
+            entry = self._schemas.get(layer_id)
+            if entry and entry[1] and entry[1]["geometryField"] == field_name:
+                return
+            schema = dict(entry[1]) if entry and entry[1] else {"geometryType": None, "attributes": {}, "nativeCrs": None}
+            schema["geometryField"] = field_name
+            schema["fetchedAt"] = time.time()
+            self._schemas[layer_id] = (time.time() + self.ttl, schema)
+
+    def invalidate(self, layer_id=None):
+        """Drop one layer's schema, or all of them"""
+        with self._lock:
+            if layer_id is None:
+                self._schemas.clear()
+                self._crs = (0, {})
+            else:
+                self._schemas.pop(layer_id, None)
+
+    def snapshot(self):
+        """All cached schemas, for diagnostics"""
+        return {layer_id: schema for layer_id, (_, schema) in list(self._schemas.items())}
+
+    def _fetch(self, layer_id):
+        params = {
+            "service": "WFS",
+            "version": "1.1.0",
+            "request": "DescribeFeatureType",
+            "typeName": layer_id
+        }
+        try:
+            print(f"DEBUG: Describing feature type {layer_id}")
+            response = geoserver_client.get(self.wfs_url, params=params, operation="wfs_describe")
+            if response.status_code != 200:
+                print(f"DEBUG: DescribeFeatureType for {layer_id} failed - HTTP {response.status_code}")
+                return None
+            schema = parse_feature_type(response.content)
+        except (requests.RequestException, ET.ParseError) as e:
+            print(f"DEBUG: DescribeFeatureType for {layer_id} failed: {e}")
+            return None
+
+        if not schema["geometryField"]:
+            print(f"DEBUG: No geometry field found in schema for {layer_id}")
+            return None
+
+        schema["nativeCrs"] = self._native_crs(layer_id)
+        schema["fetchedAt"] = time.time()
+        print(f"DEBUG: Schema for {layer_id}: geometry field '{schema['geometryField']}', CRS {schema['nativeCrs']}")
+        return schema
+
+    def _native_crs(self, layer_id):
+        expires_at, crs_by_layer = self._crs
+        if expires_at <= time.time():
+            params = {"service": "WFS", "version": "1.1.0", "request": "GetCapabilities"}
+            try:
+                response = geoserver_client.get(self.wfs_url, params=params, operation="wfs_describe")
+                crs_by_layer = parse_native_crs(response.content) if response.status_code == 200 else {}
+            except (requests.RequestException, ET.ParseError) as e:
+                print(f"DEBUG: WFS GetCapabilities failed: {e}")
+                crs_by_layer = {}
+            self._crs = (time.time() + (self.ttl if crs_by_layer else FAILED_SCHEMA_TTL), crs_by_layer)
+
+        # Workspace-scoped capabilities may list names without the workspace prefix
+        return crs_by_layer.get(layer_id) or crs_by_layer.get(layer_id.split(":")[-1])
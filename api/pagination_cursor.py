@@ -0,0 +1,123 @@
+"""
+Opaque cursors for keyset pagination of spatial query results.
+
+A cursor carries everything needed to fetch the next page without redoing
+the first page's work: the layer, the CQL filter, the sort key and the
+last value seen for it, the page size, the page number and the total count.
+The next page is requested with "<filter> AND <sort key> > <last value>"
+sorted by the key, so page N costs the same as page 1 and does not shift
+when rows before it change. Layers without a usable sort key fall back to
+an offset carried in the cursor.
+
+The filter and sort key go into the GetFeature request as they are, so
+cursors are signed with an HMAC: a client can only hand back cursors the
+server issued. All processes serving the API must share CURSOR_SECRET
+(start_servers.py generates one for its workers); without it each process
+signs with a random key of its own.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+# Attribute names tried as the keyset sort key when a layer has none configured
+DEFAULT_SORT_KEY_CANDIDATES = ("fid", "gid", "id", "objectid", "ogc_fid")
+
+SECRET = os.environ.get("CURSOR_SECRET", "").encode("utf-8") or os.urandom(32)
+SIGNATURE_BYTES = 16
+
+# Cursor state members and the types their values must have
+_STATE_TYPES = {
+    "layer": (str,),
+    "filter": (str,),
+    "field": (str,),
+    "sortKey": (str, type(None)),
+    "last": (str, int, float, bool, type(None)),
+    "offset": (int,),
+    "page": (int,),
+    "pageSize": (int,),
+    "total": (int,),
+}
+
+
+class InvalidCursor(ValueError):
+    """The cursor could not be decoded"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode((text + "=" * (-len(text) % 4)).encode("ascii"))
+
+
+def _signature(payload):
+    return hmac.new(SECRET, payload.encode("ascii"), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def encode_cursor(state):
+    """Opaque, URL-safe, signed string for a cursor state dict"""
+    payload = _b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_b64encode(_signature(payload))}"
+
+
+def decode_cursor(cursor, max_page_size=None):
+    """
+    Cursor state dict from a cursor string issued by encode_cursor(), with
+    pageSize cut to max_page_size. Raises InvalidCursor.
+    """
+    try:
+        payload, signature = cursor.split(".")
+        if not hmac.compare_digest(_b64decode(signature), _signature(payload)):
+            raise InvalidCursor("Cursor signature does not match")
+        state = json.loads(_b64decode(payload))
+    except InvalidCursor:
+        raise
+    except (ValueError, TypeError, AttributeError) as e:
+        raise InvalidCursor(f"Malformed cursor: {e}")
+    if not isinstance(state, dict) or set(state) != set(_STATE_TYPES):
+        raise InvalidCursor("Cursor is missing required fields")
+    for key, types in _STATE_TYPES.items():
+        value = state[key]
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            raise InvalidCursor(f"Cursor field {key} is invalid")
+    if state["offset"] < 0 or state["page"] < 0 or state["total"] < 0 or state["pageSize"] < 1:
+        raise InvalidCursor("Cursor position is invalid")
+    if max_page_size:
+        state["pageSize"] = min(state["pageSize"], max_page_size)
+    return state
+
+
+def pick_sort_key(schema, configured=None):
+    """
+    Keyset sort key for a layer: the configured attribute, else the first
+    attribute in the schema that looks like an id. None if there is none.
+    """
+    if configured:
+        return configured
+    if not schema:
+        return None
+    attributes = {name.lower(): name for name in schema.get("attributes", {})}
+    for candidate in DEFAULT_SORT_KEY_CANDIDATES:
+        if candidate in attributes:
+            return attributes[candidate]
+    return None
+
+
+def cql_literal(value):
+    """CQL literal for a sort key value"""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def keyset_filter(cql_filter, sort_key, last_value):
+    """cql_filter restricted to rows after last_value in sort_key order"""
+    if last_value is None:
+        return cql_filter
+    return f"({cql_filter}) AND {sort_key} > {cql_literal(last_value)}"
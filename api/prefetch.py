@@ -0,0 +1,98 @@
+"""
+Speculative prefetching of result pages.
+
+After a client is served page N of a paged result, the page it most likely
+asks for next (N+1) is loaded into the response cache in the background,
+so the click that follows is answered from memory. A request that arrives
+while the prefetch is still in flight joins it through single-flight
+instead of asking GeoServer again.
+
+Prefetches are capped (at most max_in_flight at once; more are dropped,
+never queued) and tracked per cache key: a prefetched page that is asked
+for counts as a hit, one that expires unused counts as wasted.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """Runs capped background loads and records whether they were used"""
+
+    def __init__(self, name, max_in_flight=4, ttl=30):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.ttl = ttl  # seconds a prefetched page is expected to stay useful
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._unclaimed = {}  # key -> time after which the prefetched page counts as wasted
+        self.stats = {"scheduled": 0, "skippedBusy": 0, "completed": 0, "superseded": 0, "failed": 0, "hits": 0, "wasted": 0}
+
+    def schedule(self, key, load):
+        """
+        Run load() in the background for key unless it is already being
+        prefetched or the cap is reached. load() returns True once the page
+        is cached, False if loading failed and None if it was not needed
+        (a client request loaded it first).
+        """
+        with self._lock:
+            self._expire()
+            if key in self._in_flight or key in self._unclaimed:
+                return False
+            if len(self._in_flight) >= self.max_in_flight:
+                self.stats["skippedBusy"] += 1
+                return False
+            self._in_flight.add(key)
+            self._unclaimed[key] = time.time() + self.ttl
+            self.stats["scheduled"] += 1
+        self._executor.submit(self._run, key, load)
+        return True
+
+    def _run(self, key, load):
+        try:
+            loaded = load()
+        except Exception as e:
+            loaded = False
+            print(f"DEBUG: {self.name}: prefetch failed: {e}")
+        with self._lock:
+            self._in_flight.discard(key)
+            if loaded:
+                self.stats["completed"] += 1
+                return
+            # Nothing cached by the prefetch, so nothing to claim
+            self._unclaimed.pop(key, None)
+            self.stats["failed" if loaded is False else "superseded"] += 1
+
+    def claim(self, key):
+        """A request used the page for key; counts a hit if it was prefetched"""
+        with self._lock:
+            if self._unclaimed.pop(key, None) is None:
+                return False
+            self.stats["hits"] += 1
+            return True
+
+    def _expire(self):
+        now = time.time()
+        expired = [key for key, deadline in self._unclaimed.items() if deadline <= now and key not in self._in_flight]
+        for key in expired:
+            del self._unclaimed[key]
+        self.stats["wasted"] += len(expired)
+
+    def status(self):
+        with self._lock:
+            self._expire()
+            stats = dict(self.stats)
+            stats["inFlight"] = len(self._in_flight)
+            stats["unclaimed"] = len(self._unclaimed)
+        finished = stats["hits"] + stats["wasted"]
+        stats["hitRatio"] = stats["hits"] / finished if finished else 0.0
+        stats["maxInFlight"] = self.max_in_flight
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._unclaimed.clear()
+            for name in self.stats:
+                self.stats[name] = 0
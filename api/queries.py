@@ -1,13 +1,55 @@
 from flask import Flask, request, Response
+import hashlib
+import os
 import requests
 import urllib.parse
 
+import compression
+import geoserver_client
+from layer_schema import LayerSchemaRegistry
+import spatial_filter
+from tile_cache import TileCache
+
 app = Flask(__name__)
 
 # GeoServer WMS endpoint
-WMS_URL = "http://20.20.152.180:8181/geoserver/Picarro/wms"
+WMS_URL = os.environ.get("GEOSERVER_URL", "http://20.20.152.180:8181/geoserver") + "/Picarro/wms"
 LAYER_NAME = "Picarro:Boundary"  # Updated to match the Picarro workspace
 
+# Cached geometry field names per layer
+layer_schemas = LayerSchemaRegistry(WMS_URL.replace('/wms', '/wfs'))
+
+# Disk tile cache for GetMap requests (/wms-proxy and /wms-filter)
+TILE_CACHE_DIR = os.environ.get("TILE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".tile_cache"))
+TILE_CACHE_MAX_BYTES = int(os.environ.get("TILE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+TILE_CACHE_TTL = int(os.environ.get("TILE_CACHE_TTL", 24 * 3600))
+TILE_BROWSER_MAX_AGE = 300  # Cache-Control max-age for map images, in seconds
+tile_cache = TileCache(WMS_URL, TILE_CACHE_DIR, max_bytes=TILE_CACHE_MAX_BYTES, ttl=TILE_CACHE_TTL)
+
+
+def cached_map_response(params):
+    """
+    Serve a GetMap request from the tile cache, with ETag and Cache-Control
+    headers. Returns None when the request has to go to GeoServer directly.
+    """
+    result = tile_cache.get_map(params)
+    if result is None:
+        return None
+    content, content_type = result
+    etag = hashlib.sha1(content).hexdigest()
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={TILE_BROWSER_MAX_AGE}"
+    }
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(content, content_type=content_type, headers=headers)
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli per Accept-Encoding; streamed WFS features are compressed as they arrive"""
+    return compression.compress_response(response, request)
+
 @app.route("/", methods=["GET"])
 def health_check():
     """
@@ -22,10 +64,18 @@ def health_check():
             "/test-wms",
             "/wms-layers", 
             "/wms-filter",
-            "/wms-features"
+            "/wms-features",
+            "/tile-cache"
         ]
     }
 
+@app.route("/tile-cache", methods=["GET"])
+def tile_cache_status():
+    """
+    Tile cache hit/miss counters and disk usage
+    """
+    return tile_cache.status()
+
 @app.route("/wms-capabilities", methods=["GET"])
 def wms_capabilities():
     """
@@ -37,7 +87,7 @@ def wms_capabilities():
         "request": "GetCapabilities"
     }
     
-    response = requests.get(WMS_URL, params=params)
+    response = geoserver_client.get(WMS_URL, params=params, operation="wms_capabilities")
     
     if response.status_code != 200:
         return {"error": "Failed to get WMS capabilities", "details": response.text}, 500
@@ -57,7 +107,7 @@ def wms_layers():
         }
         
         print(f"Requesting WMS capabilities from: {WMS_URL}")
-        response = requests.get(WMS_URL, params=params, timeout=10)
+        response = geoserver_client.get(WMS_URL, params=params, operation="wms_capabilities")
         
         print(f"WMS response status: {response.status_code}")
         print(f"WMS response content type: {response.headers.get('content-type', 'unknown')}")
@@ -161,7 +211,7 @@ def test_wms():
         }
         
         print(f"Testing WMS connectivity to: {WMS_URL}")
-        response = requests.get(WMS_URL, params=params, timeout=10)
+        response = geoserver_client.get(WMS_URL, params=params, operation="wms_getmap", timeout=(5, 10))
         
         print(f"WMS test response status: {response.status_code}")
         print(f"WMS test response content type: {response.headers.get('content-type', 'unknown')}")
@@ -220,7 +270,8 @@ def wms_filter():
         return {"error": "Provide 'bbox' or 'wkt'"}, 400
 
     # Build CQL filter to get only intersecting features
-    cql_filter = f"INTERSECTS(geom, {wkt})"
+    geom_field = layer_schemas.geometry_field(layer) or "geom"
+    cql_filter = f"INTERSECTS({geom_field}, {wkt})"
     print(f"CQL Filter: {cql_filter}")
 
     # Prepare WMS GetMap parameters
@@ -242,9 +293,14 @@ def wms_filter():
     print(f"WMS request parameters: {params}")
 
     try:
+        cached = cached_map_response(params)
+        if cached is not None:
+            print("WMS request served from tile cache")
+            return cached
+
         # Make request to GeoServer
         print(f"Making WMS request to: {WMS_URL}")
-        response = requests.get(WMS_URL, params=params, timeout=30)
+        response = geoserver_client.get(WMS_URL, params=params, operation="wms_getmap")
         
         print(f"WMS response status: {response.status_code}")
         print(f"WMS response content type: {response.headers.get('content-type', 'unknown')}")
@@ -258,7 +314,7 @@ def wms_filter():
             params_without_filter = params.copy()
             del params_without_filter['CQL_FILTER']
             
-            response = requests.get(WMS_URL, params=params_without_filter, timeout=30)
+            response = geoserver_client.get(WMS_URL, params=params_without_filter, operation="wms_getmap")
             if response.status_code != 200:
                 return {"error": "WMS request failed", "details": response.text}, 500
             else:
@@ -297,8 +353,12 @@ def wms_proxy():
     if 'srs' not in params:
         params['srs'] = 'EPSG:4326'
     
+    cached = cached_map_response(params)
+    if cached is not None:
+        return cached
+
     # Make request to GeoServer
-    response = requests.get(WMS_URL, params=params)
+    response = geoserver_client.get(WMS_URL, params=params, operation="wms_getmap")
     
     if response.status_code != 200:
         return {"error": "WMS request failed", "details": response.text}, 500
@@ -328,12 +388,16 @@ def wms_features():
             return {"error": "Invalid bbox format"}, 400
     elif wkt:
         print(f"Using provided WKT: {wkt}")
-        pass  # Use provided WKT
+        try:
+            spatial_filter.parse_wkt(wkt)
+        except spatial_filter.InvalidGeometry as e:
+            return {"error": str(e)}, 400
     else:
         return {"error": "Provide 'bbox' or 'wkt'"}, 400
 
-    # Build CQL filter to get only intersecting features
-    cql_filter = f"INTERSECTS(geom, {wkt})"
+    # Build CQL filter to get only intersecting features (BBOX first, for GeoServer's spatial index)
+    geom_field = layer_schemas.geometry_field(layer) or "geom"
+    cql_filter = spatial_filter.intersects_filter(geom_field, wkt)
     print(f"CQL Filter: {cql_filter}")
 
     # Prepare WFS GetFeature parameters
@@ -355,7 +419,7 @@ def wms_features():
     try:
         # Make request to GeoServer WFS
         print(f"Making WFS request to: {wfs_url}")
-        response = requests.get(wfs_url, params=params, timeout=30)
+        response = geoserver_client.get(wfs_url, params=params, operation="wfs_getfeature", stream=True)
         
         print(f"WFS response status: {response.status_code}")
         print(f"WFS response content type: {response.headers.get('content-type', 'unknown')}")
@@ -365,15 +429,13 @@ def wms_features():
             print(f"WFS response content: {response.text[:500]}...")
             return {"error": "WFS request failed", "details": response.text}, 500
 
-        # Check if response is valid JSON
-        try:
-            json_data = response.json()
-            print(f"WFS returned valid JSON with {len(json_data.get('features', []))} features")
-            return Response(response.content, content_type="application/json")
-        except ValueError as e:
-            print(f"WFS response is not valid JSON: {e}")
-            print(f"WFS response content: {response.text[:500]}...")
+        # GeoServer reports errors as XML exceptions, possibly with HTTP 200
+        if "json" not in response.headers.get("content-type", ""):
+            print(f"WFS response is not JSON: {response.text[:500]}...")
             return {"error": "WFS response is not valid JSON", "details": response.text}, 500
+
+        # Pass the features through as GeoServer sends them (compressed on the way if the client accepts it)
+        return Response(geoserver_client.iter_content(response), content_type="application/json")
         
     except requests.RequestException as e:
         print(f"WFS Request Error: {e}")
@@ -386,7 +448,7 @@ def wms_features():
 if __name__ == "__main__":
     print("Starting Flask API server...")
     print("API will be available at: http://localhost:5000")
-    print("WMS URL: http://20.20.152.180:8181/geoserver/Picarro/wms")
+    print(f"WMS URL: {WMS_URL}")
     print("Test endpoints:")
     print("  - GET http://localhost:5000/test-wms")
     print("  - GET http://localhost:5000/wms-layers")
@@ -0,0 +1,108 @@
+"""
+End-to-end deadline budget of an API request.
+
+Each request gets a deadline when it starts. The client can set it in
+seconds with the X-Request-Timeout header or a "timeout" parameter;
+otherwise the endpoint's default applies. The deadline is held in a
+context variable, so geoserver_client can shorten the timeout of every
+upstream call to the time that is left. A call made with no time left
+fails with DeadlineExceeded and never reaches GeoServer. Handlers check
+remaining() to skip optional work, such as count queries, when the budget
+is nearly gone. Work handed to worker threads carries the deadline along
+through bind().
+"""
+
+import contextvars
+import time
+
+import requests
+
+HEADER = "X-Request-Timeout"
+PARAMETER = "timeout"
+MAX_SECONDS = 300
+MIN_UPSTREAM_SECONDS = 0.05  # Less than this left: do not start an upstream call at all
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The request's deadline passed before an upstream call could be made"""
+
+
+def requested_seconds(headers, args, body=None):
+    """Budget the client asked for (header, query parameter or JSON body member), or None. Raises ValueError."""
+    value = headers.get(HEADER) or args.get(PARAMETER)
+    if value is None and isinstance(body, dict):
+        value = body.get(PARAMETER)
+    if value is None or value == "":
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{HEADER} / {PARAMETER} must be a number of seconds")
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"{HEADER} / {PARAMETER} must be between 0 and {MAX_SECONDS} seconds")
+    return seconds
+
+
+def begin(seconds):
+    """Start a budget of seconds for the current context (None: no deadline); returns the token for end()"""
+    return _deadline.set(time.time() + seconds if seconds else None)
+
+
+def end(token):
+    try:
+        _deadline.reset(token)
+    except ValueError:
+        _deadline.set(None)  # ended from a different context
+
+
+def current():
+    """Absolute deadline (time.time()) of the current request, or None"""
+    return _deadline.get()
+
+
+def remaining():
+    """Seconds left before the deadline, or None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def expired():
+    """True once the current request has (almost) no time left"""
+    left = remaining()
+    return left is not None and left < MIN_UPSTREAM_SECONDS
+
+
+def clamp(deadline):
+    """The earlier of deadline and the request's deadline"""
+    request_deadline = _deadline.get()
+    return deadline if request_deadline is None else min(deadline, request_deadline)
+
+
+def shorten(timeout):
+    """
+    A requests timeout (seconds or (connect, read)) cut to the time left.
+    Raises DeadlineExceeded if there is (almost) none left.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left < MIN_UPSTREAM_SECONDS:
+        raise DeadlineExceeded("Request deadline exceeded before the GeoServer call")
+    if isinstance(timeout, tuple):
+        return tuple(left if value is None else min(value, left) for value in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+def bind(function, deadline):
+    """Wrap function to run with deadline as the current deadline (for worker threads)"""
+
+    def run(*args, **kwargs):
+        token = _deadline.set(deadline)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _deadline.reset(token)
+
+    return run
@@ -0,0 +1,338 @@
+"""
+Per-request stage timings for /api/performance and /api/metrics.
+
+Each API request gets a RequestTimer that collects the time spent in each
+stage: parsing the request body, waiting on GeoServer, decoding GeoServer's
+JSON, assembling the result and serializing the response. Finished requests
+are kept in a bounded ring buffer per endpoint (and per endpoint and layer
+for multi-layer queries), from which percentiles are computed on demand.
+
+The current timer lives in a context variable, so code deep in the call
+stack (geoserver_client, the JSON provider) can add to it without it being
+passed around. Layer queries run on a thread pool; bind_layer() carries the
+timer over to the worker thread.
+"""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+STAGES = ("parse", "upstream", "decode", "assemble", "serialize")
+BUFFER_SIZE = 1024  # finished requests kept per endpoint and per (endpoint, layer)
+PERCENTILES = (50, 95, 99)
+
+_current = contextvars.ContextVar("request_timer", default=None)
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class RequestTimer:
+    """Stage times (ms) of one request, or of one layer within a request"""
+
+    def __init__(self, endpoint, layer_id=None, parent=None):
+        self.endpoint = endpoint
+        self.layer_id = layer_id
+        self.parent = parent
+        self.started = time.perf_counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.upstream_bytes = 0
+        self.upstream_calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, stage, ms):
+        with self._lock:
+            self.stages[stage] += ms
+        if self.parent is not None:
+            self.parent.add(stage, ms)
+
+    def add_upstream(self, ms, size, calls=1):
+        with self._lock:
+            self.stages["upstream"] += ms
+            self.upstream_bytes += size
+            self.upstream_calls += calls
+        if self.parent is not None:
+            self.parent.add_upstream(ms, size, calls)
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.upstream_bytes += size
+        if self.parent is not None:
+            self.parent.add_bytes(size)
+
+    def elapsed(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def sample(self, error):
+        """
+        Finished sample for the ring buffer. Stages that ran concurrently on
+        several layers are summed, so "assemble" is whatever is left of the
+        wall-clock time (never negative).
+        """
+        total = self.elapsed()
+        with self._lock:
+            stages = dict(self.stages)
+            upstream_bytes = self.upstream_bytes
+            upstream_calls = self.upstream_calls
+        measured = sum(ms for stage, ms in stages.items() if stage != "assemble")
+        stages["assemble"] += max(0.0, total - measured - stages["assemble"])
+        return {
+            "total": total,
+            "stages": stages,
+            "error": error,
+            "upstreamBytes": upstream_bytes,
+            "upstreamCalls": upstream_calls
+        }
+
+
+def current():
+    """Timer of the request being handled on this thread, or None"""
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    """Time a block as stage name of the current request (no-op outside requests)"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, (time.perf_counter() - started) * 1000)
+
+
+def record_upstream(ms, size):
+    """Called by geoserver_client for every GeoServer call"""
+    timer = _current.get()
+    if timer is not None:
+        timer.add_upstream(ms, size)
+
+
+def record_upstream_bytes(size):
+    """Called by geoserver_client for bytes of streamed responses read after the call"""
+    timer = _current.get()
+    if timer is not None:
+        timer.add_bytes(size)
+
+
+class MetricsRegistry:
+    """Ring buffers of finished request samples per endpoint and per layer"""
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._layers = {}
+        self._totals = {}  # cumulative counters per endpoint, for Prometheus
+        self.started = time.time()
+
+    def begin(self, endpoint):
+        """Start timing a request; returns the timer and the token for finish()"""
+        timer = RequestTimer(endpoint)
+        return timer, _current.set(timer)
+
+    def finish(self, timer, error, token=None):
+        """Store a request's sample and detach its timer from the context"""
+        sample = timer.sample(error)
+        with self._lock:
+            self._endpoints.setdefault(timer.endpoint, deque(maxlen=self.buffer_size)).append(sample)
+            totals = self._totals.setdefault(timer.endpoint, {"requests": 0, "errors": 0, "seconds": 0.0, "upstreamBytes": 0})
+            totals["requests"] += 1
+            totals["errors"] += 1 if error else 0
+            totals["seconds"] += sample["total"] / 1000
+            totals["upstreamBytes"] += sample["upstreamBytes"]
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                _current.set(None)  # finished from a different context (streamed responses)
+
+    def bind_layer(self, layer_id, function):
+        """
+        Wrap function(layer_id, ...) to run on a worker thread with a timer
+        for layer_id that rolls up into the current request's timer.
+        Results whose "success" is False count as layer errors.
+        """
+        parent = _current.get()
+        if parent is None:
+            return function
+
+        def run(*args, **kwargs):
+            # A fresh context per task so the layer timer never leaks into the pool thread's next task
+            return contextvars.Context().run(self._run_layer, parent, layer_id, function, args, kwargs)
+
+        return run
+
+    def _run_layer(self, parent, layer_id, function, args, kwargs):
+        timer = RequestTimer(parent.endpoint, layer_id, parent=parent)
+        _current.set(timer)
+        error = True
+        try:
+            result = function(*args, **kwargs)
+            error = isinstance(result, dict) and result.get("success") is False
+            return result
+        finally:
+            sample = timer.sample(error)
+            with self._lock:
+                key = (parent.endpoint, layer_id)
+                self._layers.setdefault(key, deque(maxlen=self.buffer_size)).append(sample)
+
+    def snapshot(self):
+        """Percentiles per endpoint (with per-layer breakdowns) as a JSON-able dict"""
+        with self._lock:
+            endpoints = {endpoint: list(samples) for endpoint, samples in self._endpoints.items()}
+            layers = {key: list(samples) for key, samples in self._layers.items()}
+            totals = {endpoint: dict(counters) for endpoint, counters in self._totals.items()}
+
+        result = {}
+        for endpoint, samples in endpoints.items():
+            summary = _summarize(samples)
+            summary["lifetime"] = totals.get(endpoint)
+            summary["layers"] = {layer_id: _summarize(layer_samples)
+                                 for (layer_endpoint, layer_id), layer_samples in layers.items()
+                                 if layer_endpoint == endpoint}
+            result[endpoint] = summary
+        return result
+
+    def prometheus(self, geoserver_stats=None, coalescing=None, compression=None, prefetch=None, breakers=None):
+        """Prometheus text exposition of the same data"""
+        with self._lock:
+            endpoints = {endpoint: list(samples) for endpoint, samples in self._endpoints.items()}
+            layers = {key: list(samples) for key, samples in self._layers.items()}
+            totals = {endpoint: dict(counters) for endpoint, counters in self._totals.items()}
+
+        lines = []
+
+        def metric(name, kind, help_text, rows):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in rows:
+                label_text = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value:.6g}" if label_text else f"{name} {value:.6g}")
+
+        metric("gis_api_requests_total", "counter", "API requests handled",
+               [({"endpoint": endpoint}, counters["requests"]) for endpoint, counters in totals.items()])
+        metric("gis_api_request_errors_total", "counter", "API requests answered with HTTP 4xx/5xx",
+               [({"endpoint": endpoint}, counters["errors"]) for endpoint, counters in totals.items()])
+        metric("gis_api_upstream_bytes_total", "counter", "Bytes received from GeoServer while handling API requests",
+               [({"endpoint": endpoint}, counters["upstreamBytes"]) for endpoint, counters in totals.items()])
+
+        rows = []
+        for endpoint, samples in endpoints.items():
+            if samples:
+                values = [sample["total"] / 1000 for sample in samples]
+                rows.extend(({"endpoint": endpoint, "quantile": str(pct / 100)}, percentile(values, pct)) for pct in PERCENTILES)
+        metric("gis_api_request_duration_seconds", "summary", f"Request duration over the last {self.buffer_size} requests", rows)
+        lines.extend(f'gis_api_request_duration_seconds_count{{endpoint="{_escape(endpoint)}"}} {counters["requests"]}'
+                     for endpoint, counters in totals.items())
+        lines.extend(f'gis_api_request_duration_seconds_sum{{endpoint="{_escape(endpoint)}"}} {counters["seconds"]:.6g}'
+                     for endpoint, counters in totals.items())
+
+        rows = []
+        for endpoint, samples in endpoints.items():
+            for stage_name in STAGES:
+                values = [sample["stages"][stage_name] / 1000 for sample in samples]
+                if values:
+                    rows.extend(({"endpoint": endpoint, "stage": stage_name, "quantile": str(pct / 100)}, percentile(values, pct))
+                                for pct in PERCENTILES)
+        metric("gis_api_stage_duration_seconds", "gauge", "Time per request spent in each stage (quantiles over the ring buffer)", rows)
+
+        rows = []
+        error_rows = []
+        for (endpoint, layer_id), samples in layers.items():
+            if samples:
+                values = [sample["total"] / 1000 for sample in samples]
+                rows.extend(({"endpoint": endpoint, "layer": layer_id, "quantile": str(pct / 100)}, percentile(values, pct))
+                            for pct in PERCENTILES)
+                error_rows.append(({"endpoint": endpoint, "layer": layer_id}, sum(1 for sample in samples if sample["error"]) / len(samples)))
+        metric("gis_api_layer_duration_seconds", "gauge", "Per-layer query duration (quantiles over the ring buffer)", rows)
+        metric("gis_api_layer_error_ratio", "gauge", "Share of failed layer queries in the ring buffer", error_rows)
+
+        if geoserver_stats:
+            metric("gis_geoserver_calls_total", "counter", "GeoServer calls per operation",
+                   [({"operation": operation}, stats["calls"]) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_errors_total", "counter", "Failed GeoServer calls per operation",
+                   [({"operation": operation}, stats["errors"]) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_retries_total", "counter", "Retried GeoServer calls per operation",
+                   [({"operation": operation}, stats["retries"]) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_bytes_total", "counter", "Bytes received from GeoServer per operation",
+                   [({"operation": operation}, stats["bytes"]) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_seconds_total", "counter", "Time spent in GeoServer calls per operation",
+                   [({"operation": operation}, stats["total_ms"] / 1000) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_hedged_total", "counter", "GeoServer calls that sent a hedged duplicate request",
+                   [({"operation": operation}, stats["hedged"]) for operation, stats in geoserver_stats.items()])
+            metric("gis_geoserver_hedge_wins_total", "counter", "Hedged calls answered by the duplicate request",
+                   [({"operation": operation}, stats["hedge_wins"]) for operation, stats in geoserver_stats.items()])
+
+        if breakers:
+            metric("gis_geoserver_circuit_state", "gauge", "Circuit breaker state per operation (0 closed, 1 half-open, 2 open)",
+                   [({"operation": operation}, status["stateValue"]) for operation, status in breakers.items()])
+            metric("gis_geoserver_circuit_opened_total", "counter", "Times the circuit breaker opened",
+                   [({"operation": operation}, status["opened"]) for operation, status in breakers.items()])
+            metric("gis_geoserver_circuit_rejected_total", "counter", "Calls rejected while the circuit breaker was open",
+                   [({"operation": operation}, status["rejected"]) for operation, status in breakers.items()])
+
+        if coalescing:
+            metric("gis_geoserver_coalesced_total", "counter", "Requests that shared an identical in-flight GeoServer call",
+                   [({"operation": operation}, stats["coalesced"]) for operation, stats in coalescing.items()])
+
+        if compression:
+            encodings = compression["encodings"]
+            metric("gis_api_compressed_responses_total", "counter", "Responses compressed per Content-Encoding",
+                   [({"encoding": encoding}, stats["responses"]) for encoding, stats in encodings.items()])
+            metric("gis_api_compression_input_bytes_total", "counter", "Response bytes before compression",
+                   [({"encoding": encoding}, stats["bytesIn"]) for encoding, stats in encodings.items()])
+            metric("gis_api_compression_output_bytes_total", "counter", "Response bytes after compression",
+                   [({"encoding": encoding}, stats["bytesOut"]) for encoding, stats in encodings.items()])
+
+        if prefetch:
+            metric("gis_api_prefetches_total", "counter", "Background page prefetches by outcome",
+                   [({"outcome": outcome}, prefetch[name]) for outcome, name in
+                    (("scheduled", "scheduled"), ("skipped_busy", "skippedBusy"), ("superseded", "superseded"), ("failed", "failed"),
+                     ("hit", "hits"), ("wasted", "wasted"))])
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._layers.clear()
+            self._totals.clear()
+
+
+def _summarize(samples):
+    if not samples:
+        return {"count": 0}
+    totals = [sample["total"] for sample in samples]
+    errors = sum(1 for sample in samples if sample["error"])
+    summary = {
+        "count": len(samples),
+        "errors": errors,
+        "errorRate": errors / len(samples),
+        "totalMs": {f"p{pct}": percentile(totals, pct) for pct in PERCENTILES},
+        "stagesMs": {},
+        "upstreamBytes": sum(sample["upstreamBytes"] for sample in samples),
+        "upstreamCalls": sum(sample["upstreamCalls"] for sample in samples)
+    }
+    summary["totalMs"]["mean"] = sum(totals) / len(totals)
+    for stage_name in STAGES:
+        values = [sample["stages"][stage_name] for sample in samples]
+        stage_summary = {f"p{pct}": percentile(values, pct) for pct in PERCENTILES}
+        stage_summary["mean"] = sum(values) / len(values)
+        summary["stagesMs"][stage_name] = stage_summary
+    return summary
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
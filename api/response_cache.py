@@ -0,0 +1,139 @@
+"""
+In-process LRU + TTL cache for WFS GetFeature responses.
+
+Entries are the raw response bodies, keyed by the normalized request
+(layer, CQL filter, start index, page size, output format and any other
+parameters). Each entry has its own TTL. The cache keeps the total size
+of cached bodies under a byte budget by evicting the least recently used
+entries. Cached bodies are returned as CachedResponse objects, which
+can be used like the requests.Response they were built from.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from feature_count import normalize_filter
+
+DEFAULT_TTL = 120  # Seconds
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Parameters that are part of the key explicitly; everything else is appended sorted
+_KEY_PARAMS = ("typename", "cql_filter", "startindex", "maxfeatures", "outputformat")
+
+
+def make_key(params):
+    """Normalized cache key for a GetFeature parameter dict"""
+    lowered = {str(name).lower(): str(value) for name, value in params.items()}
+    layer_id = lowered.get("typename", "")
+    cql_filter = normalize_filter(lowered.get("cql_filter"))
+    start_index = int(lowered.get("startindex") or 0)
+    page_size = lowered.get("maxfeatures") or lowered.get("count") or ""
+    output_format = lowered.get("outputformat", "").lower()
+    others = tuple(sorted((name, value) for name, value in lowered.items()
+                          if name not in _KEY_PARAMS and name != "count"))
+    return (layer_id, cql_filter, start_index, page_size, output_format, others)
+
+
+class CachedResponse:
+    """The parts of a requests.Response that callers use, held in memory"""
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.status_code, response.content,
+                   {"content-type": response.headers.get("content-type", "application/json")})
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with per-entry TTL and a total byte budget"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, default_ttl=DEFAULT_TTL, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self._entries = OrderedDict()  # key -> (expires_at, layer_id, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "purged": 0, "rejected": 0}
+
+    def get(self, key):
+        """Cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[3]
+
+    def contains(self, key):
+        """Whether an unexpired entry exists for key, without counting a lookup or refreshing its LRU position"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    def put(self, key, value, size, layer_id=None, ttl=None):
+        """Store value (size bytes) for ttl seconds, evicting LRU entries to stay in budget"""
+        if size > self.max_entry_bytes:
+            with self._lock:
+                self._stats["rejected"] += 1
+            return False
+        expires_at = time.time() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, layer_id, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+        return True
+
+    def purge_layer(self, layer_id):
+        """Drop every entry for layer_id, returning how many were removed"""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry[1] == layer_id]
+            for key in keys:
+                self._remove(key)
+            self._stats["purged"] += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._stats["purged"] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["maxBytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRatio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
@@ -0,0 +1,76 @@
+"""
+Single-flight deduplication of identical concurrent upstream calls.
+
+When several requests need the same GeoServer response at the same time
+(a dashboard opening, many users on the same page), only the first one
+(the leader) makes the call. Requests arriving with the same key while it
+is in flight wait for it and share its result, or its exception. Nothing
+is kept once the call finishes: caching is the response caches' job, this
+only covers the window in which the result does not exist yet.
+"""
+
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key, function):
+        """
+        function() for the first caller with key; concurrent callers with the
+        same key wait and get the same return value (or exception).
+        Returns (result, shared) where shared is True for those followers.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+                self.stats["calls"] += 1
+            else:
+                call.waiters += 1
+                leader = False
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                print(f"DEBUG: {self.name}: {call.waiters} identical concurrent request(s) shared one upstream call")
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def status(self):
+        with self._lock:
+            return {**self.stats, "inFlight": len(self._calls)}
@@ -0,0 +1,73 @@
+"""
+Validation of client query geometries and the CQL filters built from them.
+
+Query geometries arrive as WKT and used to be pasted into the CQL filter
+unchecked, so a malformed or self-intersecting polygon was only rejected
+by GeoServer, once per geometry field name tried. parse_wkt() checks the
+WKT locally instead (parsed once, then cached), and intersects_filter()
+puts a BBOX of the geometry's envelope in front of INTERSECTS: GeoServer
+answers the BBOX from its spatial index and only runs the exact
+intersection test on the candidates it leaves.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from shapely import wkt as shapely_wkt
+from shapely.errors import ShapelyError
+from shapely.validation import explain_validity
+
+MAX_WKT_LENGTH = 1024 * 1024  # Characters; longer geometries would not fit a GeoServer request anyway
+
+
+class InvalidGeometry(ValueError):
+    """The query geometry is not usable WKT"""
+
+
+def parse_wkt(text):
+    """
+    Shapely geometry for a client's WKT. Raises InvalidGeometry for
+    missing, malformed, empty, non-finite or invalid (e.g.
+    self-intersecting) geometries.
+    """
+    # Checked before the cache, which would fail on unhashable input (a JSON list or object)
+    if not isinstance(text, str) or not text.strip():
+        raise InvalidGeometry("Geometry (WKT) is required")
+    if len(text) > MAX_WKT_LENGTH:
+        raise InvalidGeometry(f"Geometry WKT is longer than {MAX_WKT_LENGTH} characters")
+    return _parse(text)
+
+
+@lru_cache(maxsize=256)
+def _parse(text):
+    try:
+        geometry = shapely_wkt.loads(text)
+    except (ShapelyError, ValueError, TypeError) as e:
+        raise InvalidGeometry(f"Invalid WKT: {e}")
+    if geometry.is_empty:
+        raise InvalidGeometry("Geometry is empty")
+    if not np.isfinite(shapely.get_coordinates(geometry)).all():
+        raise InvalidGeometry("Geometry has non-finite coordinates")
+    if not geometry.is_valid:
+        raise InvalidGeometry(f"Invalid geometry: {explain_validity(geometry)}")
+    return geometry
+
+
+def bbox_filter(field_name, bounds):
+    minx, miny, maxx, maxy = bounds
+    return f"BBOX({field_name}, {minx!r}, {miny!r}, {maxx!r}, {maxy!r})"
+
+
+def intersects_filter(field_name, wkt):
+    """CQL filter for features intersecting wkt, prefiltered by its envelope"""
+    return f"{bbox_filter(field_name, parse_wkt(wkt).bounds)} AND INTERSECTS({field_name}, {wkt})"
+
+
+def intersects_any_filter(field_name, wkts):
+    """CQL filter for features intersecting any of wkts, prefiltered by their combined envelope"""
+    if len(wkts) == 1:
+        return intersects_filter(field_name, wkts[0])
+    bounds = [float(value) for value in shapely.total_bounds([parse_wkt(wkt) for wkt in wkts])]
+    terms = " OR ".join(f"INTERSECTS({field_name}, {wkt})" for wkt in wkts)
+    return f"{bbox_filter(field_name, bounds)} AND ({terms})"
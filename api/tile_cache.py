@@ -0,0 +1,385 @@
+"""
+Disk-backed WMS tile cache with metatiling.
+
+GetMap requests are snapped onto a fixed tile grid per SRS. Missing tiles
+are rendered by GeoServer a metatile at a time (METATILE x METATILE tiles
+in one GetMap call), cut up locally and stored on disk. Worker processes
+sharing the directory render each metatile once, under a file lock. A
+request that is exactly one grid tile is answered with the stored tile
+as-is. Any other request is mosaicked from the tiles that cover it and resampled to the
+requested size. The cache directory is kept under a size cap by deleting
+the least recently used tiles: a tile's access time is set whenever it is
+served, while its modification time stays the time it was rendered, which
+the TTL is measured from.
+"""
+
+import hashlib
+import io
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from PIL import Image
+
+import geoserver_client
+
+try:
+    import fcntl
+except ImportError:  # Windows: the API runs in one process there, so the thread locks are enough
+    fcntl = None
+
+TILE_SIZE = 256
+METATILE = 4  # Metatiles are METATILE x METATILE tiles rendered in one upstream call
+MAX_ZOOM = 22
+MAX_TILES_PER_REQUEST = 64  # Larger requests go straight to GeoServer
+RESOLUTION_TOLERANCE = 0.01  # Relative difference at which a request counts as grid-aligned
+LOCK_FILES = 256  # Metatiles are hashed onto this many lock files shared by all worker processes
+LOCK_DIRECTORY = ".locks"
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_TTL = 24 * 3600  # Seconds before a stored tile is rendered again
+
+# Tile grids: bounds and the resolution (units per pixel) of zoom level 0
+_MERCATOR_EXTENT = 20037508.342789244
+GRIDS = {
+    "EPSG:4326": {"bounds": (-180.0, -90.0, 180.0, 90.0), "resolution": 180.0 / TILE_SIZE},
+    "EPSG:3857": {"bounds": (-_MERCATOR_EXTENT, -_MERCATOR_EXTENT, _MERCATOR_EXTENT, _MERCATOR_EXTENT),
+                  "resolution": 2 * _MERCATOR_EXTENT / TILE_SIZE},
+}
+GRIDS["EPSG:900913"] = GRIDS["EPSG:3857"]
+
+FORMATS = {"image/png": "PNG", "image/jpeg": "JPEG"}
+
+# Parameters that vary per request and are not part of the tile variant
+_REQUEST_PARAMS = {"bbox", "width", "height", "service", "request"}
+
+
+class TileCache:
+    """Snaps GetMap requests onto tile grids and serves them from disk"""
+
+    def __init__(self, wms_url, cache_dir, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.wms_url = wms_url
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._metatile_locks = {}
+        self._bytes = None  # computed lazily from the directory
+        self._evicting = False
+        self.stats = {"hits": 0, "misses": 0, "metatiles": 0, "passthrough": 0, "evicted": 0, "errors": 0}
+
+    def get_map(self, params):
+        """
+        Image bytes and content type for a GetMap parameter dict, or None
+        if the request cannot be served from the grid (unsupported SRS,
+        version, format or size) or rendering failed.
+        """
+        plan = self._plan(params)
+        if plan is None:
+            self._count("passthrough")
+            return None
+
+        try:
+            tiles = {}
+            for x, y in plan["tiles"]:
+                tile = self._read_tile(plan, x, y)
+                if tile is None:
+                    self._render_metatile(plan, x, y)
+                    tile = self._read_tile(plan, x, y)
+                    if tile is None:
+                        return None
+                    self._count("misses")
+                else:
+                    self._count("hits")
+                tiles[(x, y)] = tile
+        except (requests.RequestException, OSError, ValueError) as e:
+            print(f"DEBUG: Tile cache could not render {params.get('layers')}: {e}")
+            self._count("errors")
+            return None
+
+        if plan["exact"]:
+            return tiles[plan["tiles"][0]], plan["format"]
+        return self._mosaic(plan, tiles), plan["format"]
+
+    def _plan(self, params):
+        lowered = {str(name).lower(): str(value) for name, value in params.items()}
+        if lowered.get("request", "GetMap").lower() != "getmap":
+            return None
+        srs = (lowered.get("srs") or lowered.get("crs") or "").upper()
+        grid = GRIDS.get(srs)
+        image_format = lowered.get("format", "image/png").lower()
+        if grid is None or image_format not in FORMATS:
+            return None
+        if srs == "EPSG:4326" and lowered.get("version", "1.1.1") == "1.3.0":
+            return None  # WMS 1.3.0 uses lat/lon axis order for EPSG:4326
+        try:
+            minx, miny, maxx, maxy = (float(value) for value in lowered["bbox"].split(","))
+            width = int(lowered.get("width", TILE_SIZE))
+            height = int(lowered.get("height", TILE_SIZE))
+        except (KeyError, ValueError):
+            return None
+        bounds = grid["bounds"]
+        if width <= 0 or height <= 0 or maxx <= minx or maxy <= miny:
+            return None
+        if minx < bounds[0] or miny < bounds[1] or maxx > bounds[2] or maxy > bounds[3]:
+            return None
+
+        # Finest zoom level whose resolution is at least as fine as the request's
+        requested_resolution = min((maxx - minx) / width, (maxy - miny) / height)
+        zoom = max(0, math.ceil(math.log2(grid["resolution"] / requested_resolution) - RESOLUTION_TOLERANCE))
+        if zoom > MAX_ZOOM:
+            return None
+        resolution = grid["resolution"] / (2 ** zoom)
+        span = resolution * TILE_SIZE
+
+        first_x = int(math.floor((minx - bounds[0]) / span + 1e-9))
+        last_x = int(math.ceil((maxx - bounds[0]) / span - 1e-9)) - 1
+        first_y = int(math.floor((bounds[3] - maxy) / span + 1e-9))
+        last_y = int(math.ceil((bounds[3] - miny) / span - 1e-9)) - 1
+        tiles = [(x, y) for y in range(first_y, last_y + 1) for x in range(first_x, last_x + 1)]
+        if not tiles or len(tiles) > MAX_TILES_PER_REQUEST:
+            return None
+
+        variant = {name: value for name, value in lowered.items() if name not in _REQUEST_PARAMS}
+        variant_key = hashlib.sha1(repr(sorted(variant.items())).encode("utf-8")).hexdigest()[:16]
+        exact = (len(tiles) == 1 and width == TILE_SIZE and height == TILE_SIZE
+                 and abs(resolution - requested_resolution) <= resolution * RESOLUTION_TOLERANCE)
+
+        return {
+            "params": lowered,
+            "srs": srs,
+            "bounds": bounds,
+            "zoom": zoom,
+            "resolution": resolution,
+            "bbox": (minx, miny, maxx, maxy),
+            "width": width,
+            "height": height,
+            "format": image_format,
+            "variant": variant_key,
+            "tiles": tiles,
+            "exact": exact
+        }
+
+    def _tile_path(self, plan, x, y):
+        extension = "png" if plan["format"] == "image/png" else "jpg"
+        return os.path.join(self.cache_dir, plan["variant"], str(plan["zoom"]), str(x), f"{y}.{extension}")
+
+    def _read_tile(self, plan, x, y):
+        path = self._tile_path(plan, x, y)
+        try:
+            now = time.time()
+            rendered_at = os.path.getmtime(path)
+            if now - rendered_at > self.ttl:
+                return None
+            with open(path, "rb") as tile_file:
+                data = tile_file.read()
+            os.utime(path, (now, rendered_at))  # Mark as used for eviction (noatime mounts never would)
+            return data
+        except OSError:
+            return None
+
+    def _render_metatile(self, plan, x, y):
+        """Render the metatile holding tile (x, y) upstream and store its tiles (once, even under concurrency)"""
+        meta_x, meta_y = x // METATILE, y // METATILE
+        lock_key = (plan["variant"], plan["zoom"], meta_x, meta_y)
+        with self._lock:
+            lock = self._metatile_locks.setdefault(lock_key, threading.Lock())
+        with lock, self._process_lock(lock_key):
+            # Another request (or worker process) may have rendered it while we waited. Check the tile
+            # itself: other tiles of the metatile may have been evicted or have expired at different times.
+            if self._read_tile(plan, x, y) is not None:
+                return
+            try:
+                self._fetch_metatile(plan, meta_x, meta_y)
+            finally:
+                with self._lock:
+                    self._metatile_locks.pop(lock_key, None)
+
+    @contextmanager
+    def _process_lock(self, lock_key):
+        """
+        Exclusive lock on the metatile across worker processes (which share
+        the cache directory), through flock on one of LOCK_FILES lock files
+        """
+        if fcntl is None:
+            yield
+            return
+        digest = hashlib.sha1(repr(lock_key).encode("utf-8")).digest()
+        directory = os.path.join(self.cache_dir, LOCK_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{int.from_bytes(digest[:4], 'big') % LOCK_FILES}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetch_metatile(self, plan, meta_x, meta_y):
+        bounds = plan["bounds"]
+        span = plan["resolution"] * TILE_SIZE
+        # Clip the metatile to the grid so it never asks for an area outside it
+        tiles_across = int(round((bounds[2] - bounds[0]) / span))
+        tiles_down = int(round((bounds[3] - bounds[1]) / span))
+        first_x, first_y = meta_x * METATILE, meta_y * METATILE
+        count_x = max(1, min(METATILE, tiles_across - first_x))
+        count_y = max(1, min(METATILE, tiles_down - first_y))
+
+        minx = bounds[0] + first_x * span
+        maxy = bounds[3] - first_y * span
+        params = dict(plan["params"])
+        params.update({
+            "service": "WMS",
+            "request": "GetMap",
+            "bbox": f"{minx},{maxy - count_y * span},{minx + count_x * span},{maxy}",
+            "width": str(count_x * TILE_SIZE),
+            "height": str(count_y * TILE_SIZE)
+        })
+        print(f"DEBUG: Rendering {count_x}x{count_y} metatile z{plan['zoom']} ({meta_x}, {meta_y})")
+        response = geoserver_client.get(self.wms_url, params=params, operation="wms_getmap")
+        if response.status_code != 200 or "image" not in response.headers.get("content-type", ""):
+            raise ValueError(f"GetMap returned HTTP {response.status_code} ({response.headers.get('content-type')})")
+        self._count("metatiles")
+
+        image = Image.open(io.BytesIO(response.content))
+        image.load()
+        written = 0
+        for dy in range(count_y):
+            for dx in range(count_x):
+                tile = image.crop((dx * TILE_SIZE, dy * TILE_SIZE, (dx + 1) * TILE_SIZE, (dy + 1) * TILE_SIZE))
+                written += self._write_tile(plan, first_x + dx, first_y + dy, tile)
+        self._add_bytes(written)
+
+    def _write_tile(self, plan, x, y, tile):
+        output = io.BytesIO()
+        image_format = FORMATS[plan["format"]]
+        if image_format == "JPEG" and tile.mode != "RGB":
+            tile = tile.convert("RGB")
+        tile.save(output, image_format)
+        data = output.getvalue()
+
+        path = self._tile_path(plan, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique temporary file per writer, even across worker processes
+        handle, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, "wb") as tile_file:
+                tile_file.write(data)
+            os.replace(temporary_path, path)  # readers never see a partial tile
+        except BaseException:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise
+        return len(data)
+
+    def _mosaic(self, plan, tiles):
+        """Cut the requested bbox out of the covering tiles and resample to the requested size"""
+        xs = [x for x, _ in plan["tiles"]]
+        ys = [y for _, y in plan["tiles"]]
+        canvas = Image.new("RGBA", ((max(xs) - min(xs) + 1) * TILE_SIZE, (max(ys) - min(ys) + 1) * TILE_SIZE))
+        for (x, y), data in tiles.items():
+            tile = Image.open(io.BytesIO(data)).convert("RGBA")
+            canvas.paste(tile, ((x - min(xs)) * TILE_SIZE, (y - min(ys)) * TILE_SIZE))
+
+        bounds = plan["bounds"]
+        resolution = plan["resolution"]
+        origin_x = bounds[0] + min(xs) * TILE_SIZE * resolution
+        origin_y = bounds[3] - min(ys) * TILE_SIZE * resolution
+        minx, miny, maxx, maxy = plan["bbox"]
+        box = ((minx - origin_x) / resolution, (origin_y - maxy) / resolution,
+               (maxx - origin_x) / resolution, (origin_y - miny) / resolution)
+        image = canvas.resize((plan["width"], plan["height"]), Image.BILINEAR, box=box)
+
+        output = io.BytesIO()
+        if plan["format"] == "image/jpeg":
+            image.convert("RGB").save(output, "JPEG", quality=90)
+        else:
+            image.save(output, "PNG")
+        return output.getvalue()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _add_bytes(self, written):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._directory_size()
+            else:
+                self._bytes += written
+            if self._bytes <= self.max_bytes or self._evicting:
+                return
+            self._evicting = True
+        threading.Thread(target=self._evict, name="tile-cache-evict", daemon=True).start()
+
+    def _tile_paths(self):
+        """Paths of the stored tiles (not lock files or tiles still being written)"""
+        for root, directories, files in os.walk(self.cache_dir):
+            if root == self.cache_dir and LOCK_DIRECTORY in directories:
+                directories.remove(LOCK_DIRECTORY)
+            for name in files:
+                if not name.endswith(".tmp"):
+                    yield os.path.join(root, name)
+
+    def _directory_size(self):
+        total = 0
+        for path in self._tile_paths():
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def _evict(self):
+        """Delete the least recently used tiles until the cache is back under 90% of its cap"""
+        try:
+            tiles = []
+            for path in self._tile_paths():
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                tiles.append((info.st_atime, info.st_size, path))
+            tiles.sort()
+            total = sum(size for _, size, _ in tiles)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _, size, path in tiles:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            print(f"DEBUG: Tile cache evicted {removed} tiles, {total} bytes left")
+            with self._lock:
+                self._bytes = total
+                self.stats["evicted"] += removed
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def clear(self):
+        """Delete every stored tile"""
+        for path in list(self._tile_paths()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._bytes = 0
+
+    def status(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["bytes"] = self._bytes
+        stats["maxBytes"] = self.max_bytes
+        stats["directory"] = self.cache_dir
+        return stats
@@ -0,0 +1,39 @@
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "api"))
+
+# One feature per geometry type the API can return, plus a feature without geometry
+# or properties. All geometries lie inside vector tile z5/16/15 (lon 0..11.25, lat 0..11.18).
+FEATURES = [
+    {"type": "Feature", "id": "Layer.1", "geometry": {"type": "Point", "coordinates": [5.0, 5.0]},
+     "properties": {"name": "point", "count": 3, "score": 1.5, "active": True, "tags": ["a", "b"]}},
+    {"type": "Feature", "id": "Layer.2", "geometry": {"type": "Polygon", "coordinates": [
+        [[1, 1], [10, 1], [10, 10], [1, 10], [1, 1]],
+        [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]],
+        [[6, 6], [8, 6], [8, 8], [6, 8], [6, 6]]]},
+     "properties": {"name": "polygon with holes", "count": -7, "score": 0.25, "active": False, "tags": {"k": 1}}},
+    {"type": "Feature", "id": "Layer.3", "geometry": {"type": "MultiPolygon", "coordinates": [
+        [[[1, 1], [2, 1], [2, 2], [1, 2], [1, 1]]],
+        [[[5, 5], [9, 5], [9, 9], [5, 9], [5, 5]], [[6, 6], [7, 6], [7, 7], [6, 7], [6, 6]]]]},
+     "properties": {"name": "multipolygon", "count": 2 ** 40, "score": -3.0, "active": True, "tags": None}},
+    {"type": "Feature", "id": "Layer.4", "geometry": {"type": "MultiLineString", "coordinates": [
+        [[1, 1], [3, 3], [5, 1]], [[6, 6], [9, 9]]]},
+     "properties": {"name": "multilinestring", "count": 0, "score": 1e-9, "active": False, "tags": []}},
+    {"type": "Feature", "id": "Layer.5", "geometry": {"type": "GeometryCollection", "geometries": [
+        {"type": "Point", "coordinates": [1, 2]},
+        {"type": "LineString", "coordinates": [[1, 1], [3, 4]]},
+        {"type": "Polygon", "coordinates": [[[2, 2], [6, 2], [6, 6], [2, 2]]]}]},
+     "properties": {"name": "geometrycollection", "count": 1, "score": 2.0, "active": True, "tags": [1]}},
+    {"type": "Feature", "id": "Layer.6", "geometry": None,
+     "properties": {"name": "no geometry", "count": None, "score": None, "active": None, "tags": None}},
+]
+
+
+@pytest.fixture
+def features():
+    """A fresh copy of FEATURES, so a test cannot change another's input"""
+    return copy.deepcopy(FEATURES)
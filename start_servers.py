@@ -2,16 +2,32 @@
 """
 Quick start script for the GIS Web Application
 This script starts both the Flask backend and React frontend servers.
+
+Development (default): runs api/app.py on the Flask development server.
+Production: python start_servers.py --production [--workers 4 --threads 8 --preload]
+runs the API under gunicorn (process workers with threads each) or, on
+Windows, under waitress (one process, threads only). Add --async to run
+gevent workers instead, where requests waiting on GeoServer are cheap
+coroutines rather than threads. Send SIGHUP to this script to reload the
+workers gracefully.
 """
 
+import argparse
 import subprocess
 import sys
 import time
 import os
 import signal
 import threading
+import json
+import secrets
+import shutil
+import tempfile
 from pathlib import Path
 
+# Seconds to wait for the API's startup cache warm-up before reporting it started anyway
+READY_TIMEOUT = int(os.environ.get("API_READY_TIMEOUT", "120"))
+
 def find_npm():
     """Find npm executable on Windows"""
     # Common npm locations on Windows
@@ -121,21 +137,60 @@ def install_dependencies():
     
     return True
 
+def ready_directory(env):
+    """Create the directory the API's processes report readiness in and pass it on as API_READY_DIR"""
+    env["API_READY_DIR"] = tempfile.mkdtemp(prefix="api-ready-")
+    return env["API_READY_DIR"]
+
+def wait_until_ready(process, ready_dir, workers=1, timeout=READY_TIMEOUT):
+    """
+    Wait until every worker process has finished its cache warm-up, which
+    each one reports by writing <pid>.json to ready_dir (see
+    api/cache_warmup.py). Returns False if the server exited or did not
+    become ready within timeout seconds. Removes ready_dir.
+    """
+    deadline = time.time() + timeout
+    print(f"⏳ Waiting for {workers} API process(es) to warm their caches...")
+    try:
+        while time.time() < deadline:
+            if process.poll() is not None:
+                return False
+            reports = []
+            for path in Path(ready_dir).glob("*.json"):
+                try:
+                    reports.append(json.loads(path.read_text()))
+                except (OSError, ValueError):
+                    pass
+            if len(reports) >= workers:
+                failed = sum(report.get("failed") or 0 for report in reports)
+                print(f"✅ Cache warm-up done in {max(report.get('seconds') or 0 for report in reports):.1f}s"
+                      + (f" ({failed} steps failed)" if failed else ""))
+                return True
+            time.sleep(0.5)
+        print(f"⚠️ The API has not finished warming its caches after {timeout}s")
+        return False
+    finally:
+        shutil.rmtree(ready_dir, ignore_errors=True)
+
 def start_backend():
     """Start the Flask backend server"""
     print("\n🚀 Starting Flask backend server...")
     try:
         # Change to api directory and start Flask
         os.chdir('api')
+        env = dict(os.environ)
+        ready_dir = ready_directory(env)
         process = subprocess.Popen([sys.executable, 'app.py'], 
                                  stdout=subprocess.PIPE, 
                                  stderr=subprocess.PIPE,
-                                 text=True)
+                                 text=True,
+                                 env=env)
         
         # Wait a moment for server to start
         time.sleep(3)
         
-        # Check if server is running
+        # Wait for the cache warm-up, then check the server is still running
+        wait_until_ready(process, ready_dir)
         if process.poll() is None:
             print("✅ Flask backend server started on http://localhost:5000")
             return process
@@ -147,6 +202,117 @@ def start_backend():
         print(f"❌ Error starting Flask server: {e}")
         return None
 
+# Production server defaults, overridable by environment variables or command-line flags
+PRODUCTION_DEFAULTS = {
+    "bind": os.environ.get("API_BIND", "0.0.0.0:5000"),
+    "workers": int(os.environ.get("API_WORKERS", str(min(2 * (os.cpu_count() or 1) + 1, 9)))),
+    "threads": int(os.environ.get("API_THREADS", "8")),
+    "async": os.environ.get("API_WORKER_CLASS", "gthread") == "gevent",
+    "worker_connections": int(os.environ.get("API_WORKER_CONNECTIONS", "1000")),  # concurrent requests per async worker
+    "preload": os.environ.get("API_PRELOAD", "false").lower() == "true",
+    "timeout": int(os.environ.get("API_WORKER_TIMEOUT", "120")),  # seconds before a stuck worker is restarted
+    "graceful_timeout": int(os.environ.get("API_GRACEFUL_TIMEOUT", "30")),  # seconds workers get to finish on reload/stop
+    "max_requests": int(os.environ.get("API_MAX_REQUESTS", "0")),  # recycle workers after this many requests (0 = never)
+    "debug": os.environ.get("API_DEBUG", "false").lower() == "true",
+}
+
+def production_command(options):
+    """Command line for the production WSGI server, run from the api directory"""
+    if os.name == "nt":
+        # gunicorn needs fork; waitress serves from one process with a thread pool
+        host, _, port = options.bind.rpartition(":")
+        return [sys.executable, '-m', 'waitress',
+                f'--host={host or "0.0.0.0"}', f'--port={port}',
+                f'--threads={options.workers * options.threads}',
+                'app:app']
+    command = [sys.executable, '-m', 'gunicorn',
+               '--config', 'gunicorn.conf.py',
+               '--bind', options.bind,
+               '--workers', str(options.workers)]
+    if options.async_workers:
+        command += ['--worker-class', 'gevent', '--worker-connections', str(options.worker_connections)]
+    else:
+        command += ['--worker-class', 'gthread', '--threads', str(options.threads)]
+    command += ['--timeout', str(options.timeout),
+               '--graceful-timeout', str(options.graceful_timeout),
+               '--access-logfile', '-']
+    if options.preload:
+        command.append('--preload')
+    if options.max_requests:
+        command += ['--max-requests', str(options.max_requests),
+                    '--max-requests-jitter', str(max(1, options.max_requests // 10))]
+    return command + ['app:app']
+
+def start_production_backend(options):
+    """Start the API under a multi-worker WSGI server"""
+    server = "waitress" if os.name == "nt" else "gunicorn"
+    print(f"\n🚀 Starting API with {server} on {options.bind}...")
+    if os.name == "nt":
+        print(f"   {options.workers * options.threads} threads in one process (process workers need gunicorn, which does not run on Windows)")
+    elif options.async_workers:
+        print(f"   {options.workers} gevent workers x {options.worker_connections} connections, preload {'on' if options.preload else 'off'}, "
+              f"graceful timeout {options.graceful_timeout}s")
+    else:
+        print(f"   {options.workers} workers x {options.threads} threads, preload {'on' if options.preload else 'off'}, "
+              f"graceful timeout {options.graceful_timeout}s")
+    
+    env = dict(os.environ)
+    env["FLASK_DEBUG"] = "1" if options.debug else "0"
+    # Every worker must sign pagination cursors with the same key
+    env.setdefault("CURSOR_SECRET", secrets.token_hex(32))
+    ready_dir = ready_directory(env)
+    if options.preload and os.name != "nt":
+        # Background threads are started in each worker after the fork (see api/gunicorn.conf.py)
+        env["API_START_BACKGROUND"] = "false"
+    if options.async_workers and os.name != "nt":
+        # gunicorn.conf.py patches the standard library for gevent before the app is imported.
+        # Layer queries are coroutines too, so let each worker run as many as it has connections.
+        env["API_WORKER_CLASS"] = "gevent"
+        env.setdefault("LAYER_QUERY_WORKERS", str(options.worker_connections))
+        env.setdefault("GEOSERVER_POOL_SIZE", "128")
+        env.setdefault("GEOSERVER_HEDGE_WORKERS", "256")
+    try:
+        # Output is inherited, not piped: a pipe nobody reads would eventually block the workers
+        process = subprocess.Popen(production_command(options), cwd='api', env=env)
+        time.sleep(3)
+        wait_until_ready(process, ready_dir, 1 if os.name == "nt" else options.workers, options.ready_timeout)
+        if process.poll() is None:
+            print(f"✅ API server started on http://{options.bind} (pid {process.pid})")
+            return process
+        print(f"❌ {server} exited with code {process.returncode}")
+        return None
+    except Exception as e:
+        print(f"❌ Error starting {server}: {e}")
+        return None
+
+def forward_reload_signal(process):
+    """Reload workers gracefully when this script receives SIGHUP (gunicorn only)"""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    
+    def reload(signum, frame):
+        print("\n🔄 Reloading API workers gracefully...")
+        process.send_signal(signal.SIGHUP)
+    
+    signal.signal(signal.SIGHUP, reload)
+    print(f"💡 Reload workers without downtime: kill -HUP {os.getpid()}")
+
+def check_production_dependencies(options):
+    """Check the Python packages the production server needs"""
+    server = "waitress" if os.name == "nt" else "gunicorn"
+    try:
+        import flask
+        import requests
+        __import__(server)
+        if options.async_workers and os.name != "nt":
+            import gevent
+        print(f"✅ Python dependencies found ({server})")
+        return True
+    except ImportError as e:
+        print(f"❌ Python dependency missing: {e}")
+        print("Run: pip install -r api/requirements.txt")
+        return False
+
 def start_frontend():
     """Start the React frontend server"""
     print("\n🌐 React frontend server not started automatically.")
@@ -154,7 +320,7 @@ def start_frontend():
     print("   The frontend will be available at: http://localhost:3000")
     return None
 
-def monitor_processes(backend_process, frontend_process):
+def monitor_processes(backend_process, frontend_process, stop_timeout=5):
     """Monitor the running processes"""
     print("\n📊 Monitoring backend server...")
     print("Press Ctrl+C to stop the server")
@@ -175,7 +341,7 @@ def monitor_processes(backend_process, frontend_process):
         if backend_process:
             backend_process.terminate()
             try:
-                backend_process.wait(timeout=5)
+                backend_process.wait(timeout=stop_timeout)
                 print("✅ Backend server stopped")
             except subprocess.TimeoutExpired:
                 backend_process.kill()
@@ -183,8 +349,55 @@ def monitor_processes(backend_process, frontend_process):
         
         print("👋 Backend server stopped")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Start the GIS Web Application backend")
+    parser.add_argument("--production", action="store_true",
+                        help="serve the API with a multi-worker WSGI server instead of the Flask development server")
+    parser.add_argument("--bind", default=PRODUCTION_DEFAULTS["bind"], help="host:port to listen on (production)")
+    parser.add_argument("--workers", type=int, default=PRODUCTION_DEFAULTS["workers"], help="worker processes (production)")
+    parser.add_argument("--threads", type=int, default=PRODUCTION_DEFAULTS["threads"], help="threads per worker (production)")
+    parser.add_argument("--async", dest="async_workers", action="store_true", default=PRODUCTION_DEFAULTS["async"],
+                        help="gevent workers: each handles many concurrent requests waiting on GeoServer (production)")
+    parser.add_argument("--worker-connections", type=int, default=PRODUCTION_DEFAULTS["worker_connections"],
+                        help="concurrent requests per async worker (production)")
+    parser.add_argument("--preload", action="store_true", default=PRODUCTION_DEFAULTS["preload"],
+                        help="import the app once before forking workers (faster start, shared memory)")
+    parser.add_argument("--timeout", type=int, default=PRODUCTION_DEFAULTS["timeout"], help="seconds before a stuck worker is restarted")
+    parser.add_argument("--graceful-timeout", type=int, default=PRODUCTION_DEFAULTS["graceful_timeout"],
+                        help="seconds workers get to finish in-flight requests on reload or stop")
+    parser.add_argument("--max-requests", type=int, default=PRODUCTION_DEFAULTS["max_requests"],
+                        help="restart each worker after this many requests (0 = never)")
+    parser.add_argument("--debug", action="store_true", default=PRODUCTION_DEFAULTS["debug"],
+                        help="enable Flask debug mode in production (off by default)")
+    parser.add_argument("--ready-timeout", type=int, default=READY_TIMEOUT,
+                        help="seconds to wait for the API's cache warm-up before reporting it started")
+    return parser.parse_args()
+
+def main_production(options):
+    """Start only the API, under the production WSGI server"""
+    print("🎯 GIS Web Application - production API server")
+    print("=" * 50)
+    
+    if not Path('api').exists():
+        print("❌ Please run this script from the project root directory")
+        sys.exit(1)
+    if not check_production_dependencies(options):
+        sys.exit(1)
+    
+    backend_process = start_production_backend(options)
+    if not backend_process:
+        print("❌ Failed to start backend server")
+        sys.exit(1)
+    forward_reload_signal(backend_process)
+    monitor_processes(backend_process, None, stop_timeout=options.graceful_timeout + 5)
+
 def main():
     """Main function to start the application"""
+    options = parse_args()
+    if options.production:
+        main_production(options)
+        return
+    
     print("🎯 GIS Web Application Quick Start")
     print("=" * 50)
     
@@ -0,0 +1,93 @@
+import json
+import math
+
+import pyogrio
+import shapely
+from pyogrio.raw import read
+from shapely.geometry import shape
+
+import flatgeobuf
+
+COLUMNS = [
+    ("name", flatgeobuf.STRING),
+    ("count", flatgeobuf.LONG),
+    ("score", flatgeobuf.DOUBLE),
+    ("active", flatgeobuf.BOOL),
+    ("tags", flatgeobuf.JSON),
+]
+
+
+def write_fgb(path, features, columns=COLUMNS, crs="EPSG:4326"):
+    encoder = flatgeobuf.FeatureEncoder(columns)
+    with open(path, "wb") as fgb_file:
+        fgb_file.write(flatgeobuf.encode_header(columns, name="test", crs=crs, features_count=len(features)))
+        for feature in features:
+            fgb_file.write(encoder.encode(feature))
+
+
+def read_fgb(path):
+    meta, _, geometries, field_data = read(path)
+    rows = [dict(zip(meta["fields"], values)) for values in zip(*field_data)]
+    return meta, [None if wkb is None else shapely.from_wkb(wkb) for wkb in geometries], rows
+
+
+def test_flatgeobuf_round_trip_geometries(tmp_path, features):
+    path = str(tmp_path / "features.fgb")
+    write_fgb(path, features)
+    meta, geometries, _ = read_fgb(path)
+
+    assert meta["crs"] == "EPSG:4326"
+    assert len(geometries) == len(features)
+    for feature, geometry in zip(features, geometries):
+        if feature["geometry"] is None:
+            assert geometry is None or geometry.is_empty
+        else:
+            expected = shape(feature["geometry"])
+            assert geometry.geom_type == expected.geom_type
+            assert shapely.equals_exact(geometry, expected, tolerance=1e-12), feature["properties"]["name"]
+
+
+def test_flatgeobuf_round_trip_polygon_holes(tmp_path, features):
+    path = str(tmp_path / "holes.fgb")
+    write_fgb(path, features[1:3])
+    _, geometries, _ = read_fgb(path)
+
+    assert len(geometries[0].interiors) == 2
+    assert [len(polygon.interiors) for polygon in geometries[1].geoms] == [0, 1]
+
+
+def test_flatgeobuf_round_trip_column_types(tmp_path, features):
+    path = str(tmp_path / "columns.fgb")
+    write_fgb(path, features)
+    meta, _, rows = read_fgb(path)
+
+    assert list(meta["fields"]) == [name for name, _ in COLUMNS]
+    assert [str(dtype) for dtype in meta["dtypes"]] == ["object", "int64", "float64", "bool", "object"]
+    for feature, row in zip(features[:-1], rows):
+        properties = feature["properties"]
+        assert row["name"] == properties["name"]
+        assert row["count"] == properties["count"]
+        assert row["score"] == properties["score"]
+        assert bool(row["active"]) is properties["active"]
+        if properties["tags"] is None:
+            assert row["tags"] is None  # null properties are left out of the feature
+        else:
+            assert json.loads(row["tags"]) == properties["tags"]
+
+
+def test_flatgeobuf_null_properties_are_unset(tmp_path, features):
+    path = str(tmp_path / "nulls.fgb")
+    write_fgb(path, features[-1:], columns=[("name", flatgeobuf.STRING), ("score", flatgeobuf.DOUBLE)])
+    _, _, rows = read_fgb(path)
+
+    assert rows[0]["name"] == "no geometry"
+    assert math.isnan(rows[0]["score"])  # the null property was left out
+
+
+def test_flatgeobuf_header_crs_and_count(tmp_path, features):
+    path = str(tmp_path / "mercator.fgb")
+    write_fgb(path, features[:1], crs="urn:x-ogc:def:crs:EPSG:3857")
+    info = pyogrio.read_info(path)
+
+    assert info["crs"] == "EPSG:3857"
+    assert info["features"] == 1
@@ -0,0 +1,75 @@
+import json
+
+import mapbox_vector_tile
+import shapely
+from shapely.geometry import shape
+
+import vector_tile
+
+# Tile z5/16/15 covers lon 0..11.25, lat 0..11.18; all test features lie inside it
+Z, X, Y = 5, 16, 15
+
+def decode(features):
+    tile_features = vector_tile.tile_geometries(features, Z, X, Y)
+    tile = vector_tile.encode_tile([("layer", tile_features)])
+    decoded = mapbox_vector_tile.decode(tile, default_options={"y_coord_down": True})
+    return tile_features, decoded["layer"]
+
+
+def test_vector_tile_round_trip_geometries(features):
+    tile_features, layer = decode(features)
+
+    assert layer["extent"] == vector_tile.EXTENT
+    assert layer["version"] == 2
+    assert [feature["id"] for feature in layer["features"]] == [1, 2, 3, 4, 5]  # no geometry: left out
+    for (_, expected), feature in zip(tile_features, layer["features"]):
+        geometry = shape(feature["geometry"])
+        assert geometry.normalize().equals_exact(expected.normalize(), tolerance=0), feature["properties"]["name"]
+
+
+def test_vector_tile_geometry_types(features):
+    _, layer = decode(features)
+    types = {feature["properties"]["name"]: feature["geometry"]["type"] for feature in layer["features"]}
+
+    assert types == {
+        "point": "Point",
+        "polygon with holes": "Polygon",
+        "multipolygon": "MultiPolygon",
+        "multilinestring": "MultiLineString",
+        "geometrycollection": "Polygon",  # a collection keeps its parts of the highest dimension
+    }
+
+
+def test_vector_tile_polygon_winding(features):
+    _, layer = decode(features[1:3])
+    polygon = shape(layer["features"][0]["geometry"])
+    multipolygon = shape(layer["features"][1]["geometry"])
+
+    assert len(polygon.interiors) == 2
+    assert [len(part.interiors) for part in multipolygon.geoms] == [0, 1]
+    # Spec: exterior rings have a positive area in tile coordinates (y down), holes a negative one
+    for part in [polygon, *multipolygon.geoms]:
+        assert shapely.is_ccw(part.exterior)
+        assert not any(shapely.is_ccw(interior) for interior in part.interiors)
+
+
+def test_vector_tile_property_types(features):
+    _, layer = decode(features)
+    properties = {feature["properties"]["name"]: feature["properties"] for feature in layer["features"]}
+
+    for feature in features[:-1]:
+        decoded = properties[feature["properties"]["name"]]
+        expected = {key: value for key, value in feature["properties"].items() if value is not None}
+        assert decoded.keys() == expected.keys()
+        for key, value in expected.items():
+            if isinstance(value, (list, dict)):
+                assert decoded[key] == json.dumps(value)  # nested values are stored as JSON strings
+            else:
+                assert decoded[key] == value and type(decoded[key]) is type(value), key
+
+
+def test_vector_tile_drops_features_outside_the_tile():
+    outside = {"type": "Feature", "id": 7, "geometry": {"type": "Point", "coordinates": [-100.0, 40.0]},
+               "properties": {}}
+    assert vector_tile.tile_geometries([outside], Z, X, Y) == []
+    assert vector_tile.encode_tile([("layer", [])]) == b""